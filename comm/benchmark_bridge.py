@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark serial_udp_bridge.py throughput and loop latency.
+
+The bridge is run as a subprocess with a virtual Arduino on a pty as the
+serial device and a synthetic simulator UDP endpoint that replies to every
+sensor datagram with a torque command. The sample sequence number is encoded
+in the steer angle and returned as the torque, so the virtual Arduino can
+match received torques to the samples that caused them.
+
+For each engine, sample rate and payload size, the sustained frame rate,
+bridge CPU time per frame, loop latency percentiles and drop counts are
+reported and saved as JSON for comparison across commits. Torque drops
+include commands coalesced by the bridge torque writer.
+    $ ./benchmark_bridge.py -r 1000,5000 -n 2,8 -d 5
+    $ ./benchmark_bridge.py -c bridge_benchmark_<revision>.json
+"""
+import argparse
+import collections
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import latency
+import protocol
+import virtual_arduino
+
+
+BRIDGE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'serial_udp_bridge.py')
+DEFAULT_RATES = (100, 1000, 5000)
+DEFAULT_FLOATS = (2, 8)
+DEFAULT_ENGINES = ('threads', 'asyncio')
+DEFAULT_DURATION = 5 # seconds
+DEFAULT_UDPTXPORT = 19900
+DEFAULT_UDPRXPORT = 19901
+BRIDGE_STARTUP_TIME = 1.0 # seconds
+BRIDGE_SHUTDOWN_TIMEOUT = 10 # seconds
+SEQUENCE_MODULUS = 2048 # sequence numbers are sent as (n % 2048)/1024
+SEQUENCE_SCALE = 1024
+UDP_BUFFER_SIZE = 64
+UDP_RECEIVE_TIMEOUT = 0.1 # seconds
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+class SequenceArduino(virtual_arduino.VirtualArduino):
+    """Virtual Arduino that encodes the sample sequence number in delta and
+    measures the latency until it is received back as a torque.
+    """
+    def __init__(self, rate, num_floats):
+        virtual_arduino.VirtualArduino.__init__(self, rate, num_floats,
+                                                on_torque=self._torque)
+        self.latency = latency.LatencyHistogram()
+        self._sample_ns = SEQUENCE_MODULUS*[None]
+        self.measuring = False
+
+    def sample(self, n, t):
+        self._sample_ns[n % SEQUENCE_MODULUS] = time.perf_counter_ns()
+        return [(n % SEQUENCE_MODULUS)/SEQUENCE_SCALE] + [0.0]*(self.num_floats - 1)
+
+    def _torque(self, t_ns, torque):
+        if not self.measuring:
+            return
+        i = int(round(torque*SEQUENCE_SCALE)) % SEQUENCE_MODULUS
+        sample_ns = self._sample_ns[i]
+        if sample_ns is not None:
+            self.latency.record(t_ns - sample_ns)
+
+
+class EchoSimulator(threading.Thread):
+    """Synthetic simulator endpoint. Replies to each sensor datagram with a
+    torque equal to the received steer angle.
+    """
+    def __init__(self, rx_port, tx_port):
+        threading.Thread.__init__(self, name='echo simulator thread')
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('localhost', rx_port))
+        self.sock.settimeout(UDP_RECEIVE_TIMEOUT)
+        self.addr = ('localhost', tx_port)
+        self.datagram = protocol.SENSOR_DATAGRAM.struct
+        self.received = 0
+        self._terminate = threading.Event()
+
+    def run(self):
+        buf = bytearray(UDP_BUFFER_SIZE)
+        while not self._terminate.is_set():
+            try:
+                n = self.sock.recv_into(buf)
+            except socket.timeout:
+                continue
+            if n != protocol.SENSOR_DATAGRAM.size:
+                continue
+            self.received += 1
+            _, delta, _, _, _ = self.datagram.unpack_from(buf)
+            self.sock.sendto(protocol.STATE_DATAGRAM.pack(delta, 0.0),
+                             self.addr)
+        self.sock.close()
+
+    def stop(self):
+        self._terminate.set()
+
+
+def cpu_time(pid):
+    """Return the user + system CPU time of a process in seconds."""
+    with open('/proc/{}/stat'.format(pid)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12]))/CLOCK_TICKS
+
+
+def run_case(engine, rate, num_floats, duration, tx_port, rx_port):
+    arduino = SequenceArduino(rate, num_floats)
+    simulator = EchoSimulator(tx_port, rx_port)
+    simulator.start()
+    with tempfile.TemporaryDirectory() as log_dir:
+        bridge = subprocess.Popen(
+            [sys.executable, BRIDGE, arduino.port, '000', '0',
+             '-P', str(tx_port), '-p', str(rx_port), '--engine', engine,
+             '--payload_floats', str(num_floats)],
+            cwd=log_dir, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+        try:
+            time.sleep(BRIDGE_STARTUP_TIME)
+            # warm up for a tenth of the duration before measuring
+            arduino.run(duration/10)
+            arduino.measuring = True
+            samples0 = arduino.samples
+            received0 = simulator.received
+            torques0 = arduino.torques
+            cpu0 = cpu_time(bridge.pid)
+            t0 = time.perf_counter()
+            arduino.run(duration)
+            elapsed = time.perf_counter() - t0
+            cpu = cpu_time(bridge.pid) - cpu0
+            arduino.measuring = False
+        finally:
+            bridge.send_signal(subprocess.signal.SIGINT)
+            try:
+                bridge.wait(BRIDGE_SHUTDOWN_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                bridge.kill()
+            simulator.stop()
+            simulator.join()
+            arduino.close()
+
+    samples = arduino.samples - samples0
+    frames = simulator.received - received0
+    torques = arduino.torques - torques0
+    h = arduino.latency
+    result = collections.OrderedDict()
+    result['engine'] = engine
+    result['rate'] = arduino.rate
+    result['num_floats'] = num_floats
+    result['frame_size'] = arduino.frame.size
+    result['duration'] = elapsed
+    result['samples'] = samples
+    result['frames'] = frames
+    result['frames_per_second'] = frames/elapsed
+    result['cpu_seconds'] = cpu
+    result['cpu_us_per_frame'] = 1e6*cpu/frames if frames else None
+    result['torques'] = torques
+    result['sensor_drops'] = max(0, samples - frames)
+    result['torque_drops'] = max(0, frames - torques)
+    for p, name in ((50, 'p50'), (99, 'p99'), (99.9, 'p999')):
+        v = h.percentile(p)
+        result['latency_{}_ms'.format(name)] = (
+            v/latency.NS_PER_MS if v is not None else None)
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(BRIDGE), stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+COLUMNS = ( # result key, header, width, format
+    ('engine', 'engine', 8, ''),
+    ('rate', 'rate', 8, '.0f'),
+    ('num_floats', 'floats', 6, ''),
+    ('frames_per_second', 'frames/s', 10, '.1f'),
+    ('cpu_us_per_frame', 'cpu us/f', 9, '.2f'),
+    ('latency_p50_ms', 'p50 ms', 8, '.3f'),
+    ('latency_p99_ms', 'p99 ms', 8, '.3f'),
+    ('latency_p999_ms', 'p999 ms', 8, '.3f'),
+    ('sensor_drops', 's drop', 7, ''),
+    ('torque_drops', 't drop', 7, ''),
+)
+
+
+def format_header():
+    return ' '.join('{:>{}}'.format(header, width)
+                    for _, header, width, _ in COLUMNS)
+
+
+def format_row(result):
+    row = []
+    for key, _, width, fmt in COLUMNS:
+        v = result.get(key)
+        if v is None:
+            row.append('{:>{}}'.format('-', width))
+        else:
+            row.append('{:>{}{}}'.format(v, width, fmt))
+    return ' '.join(row)
+
+
+def compare(results, baseline_path):
+    """Print the change in frame rate, CPU per frame and p99 latency with
+    respect to a previously saved benchmark.
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    key = lambda r: (r['engine'], int(round(r['rate'])), r['num_floats'])
+    base = {key(r): r for r in baseline['results']}
+    print('change with respect to {} ({}):'.format(baseline_path,
+                                                   baseline['revision']))
+    for r in results:
+        b = base.get(key(r))
+        if b is None:
+            continue
+        changes = []
+        for k in ('frames_per_second', 'cpu_us_per_frame', 'latency_p99_ms'):
+            if r[k] is None or not b[k]:
+                changes.append('{:>10}'.format('-'))
+            else:
+                changes.append('{:>+9.1f}%'.format(100*(r[k]/b[k] - 1)))
+        print('{:>8} {:>8} {:>6} '.format(*key(r)) + ' '.join(changes))
+
+
+def parse_list(s, type_):
+    return [type_(v) for v in s.split(',')]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=
+        'Benchmark serial_udp_bridge.py throughput and loop latency.')
+    parser.add_argument('-r', '--rates',
+        help='comma separated sample rates in Hz ({})'.format(
+            ','.join(map(str, DEFAULT_RATES))),
+        default=DEFAULT_RATES, type=lambda s: parse_list(s, float))
+    parser.add_argument('-n', '--num_floats',
+        help='comma separated payload sizes in floats ({})'.format(
+            ','.join(map(str, DEFAULT_FLOATS))),
+        default=DEFAULT_FLOATS, type=lambda s: parse_list(s, int))
+    parser.add_argument('-e', '--engines',
+        help='comma separated bridge engines ({})'.format(
+            ','.join(DEFAULT_ENGINES)),
+        default=DEFAULT_ENGINES, type=lambda s: parse_list(s, str))
+    parser.add_argument('-d', '--duration',
+        help='measurement time per case in seconds ({})'.format(
+            DEFAULT_DURATION),
+        default=DEFAULT_DURATION, type=float)
+    parser.add_argument('-P', '--udp_txport',
+        help='bridge udp tx port ({})'.format(DEFAULT_UDPTXPORT),
+        default=DEFAULT_UDPTXPORT, type=int)
+    parser.add_argument('-p', '--udp_rxport',
+        help='bridge udp rx port ({})'.format(DEFAULT_UDPRXPORT),
+        default=DEFAULT_UDPRXPORT, type=int)
+    parser.add_argument('-o', '--output',
+        help='JSON results file (bridge_benchmark_<revision>.json)',
+        default=None)
+    parser.add_argument('-c', '--compare',
+        help='JSON results file of a previous run to compare against',
+        default=None)
+    args = parser.parse_args()
+
+    revision = git_revision()
+    output = args.output
+    if output is None:
+        output = 'bridge_benchmark_{}.json'.format(revision)
+
+    results = []
+    print(format_header())
+    for engine in args.engines:
+        for num_floats in args.num_floats:
+            for rate in args.rates:
+                r = run_case(engine, rate, num_floats, args.duration,
+                             args.udp_txport, args.udp_rxport)
+                results.append(r)
+                print(format_row(r))
+                sys.stdout.flush()
+
+    with open(output, 'w') as f:
+        json.dump(collections.OrderedDict([
+            ('revision', revision),
+            ('time', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())),
+            ('python', sys.version.split()[0]),
+            ('results', results)]), f, indent=2)
+    print('results saved to {}'.format(output))
+
+    if args.compare is not None:
+        compare(results, args.compare)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Binary log format for bridge sensor and actuator data.
+
+A log file consists of:
+ - the magic bytes LOG_MAGIC
+ - a header, a uint32 length followed by a JSON document with the format
+   version, the log start time (unixtime) and the fields, types and units of
+   each record stream
+ - blocks of records, each a block header (stream id, record count) followed
+   by count fixed size records of that stream
+ - a footer block with stream id FOOTER_ID and the log end time (unixtime)
+
+All values are little endian. Records of a stream have the same size, so a
+block can be read directly into a NumPy structured array.
+"""
+import json
+import struct
+
+import numpy as np
+
+import protocol
+
+
+LOG_MAGIC = b'BSGLOG\x00\x01'
+LOG_VERSION = 1
+FOOTER_ID = 0xff
+
+_LENGTH = struct.Struct('<I')
+_BLOCK = struct.Struct('<BI') # stream id, record count
+_FOOTER = struct.Struct('<q') # unixtime
+
+SENSOR_FIELDS = protocol.SENSOR_FIELDS
+SENSOR_UNITS = protocol.SENSOR_UNITS
+ACTUATOR_FIELDS = ('torque', 'phi')
+ACTUATOR_UNITS = ('N-m', 'rad')
+
+
+class Stream(object):
+    """A stream of fixed size records, each a float64 timestamp followed by
+    float32 field values.
+    """
+    def __init__(self, stream_id, name, fields, units):
+        assert len(fields) == len(units)
+        self.id = stream_id
+        self.name = name
+        self.fields = tuple(fields)
+        self.units = tuple(units)
+        self.struct = struct.Struct('<d{}f'.format(len(fields)))
+
+    @property
+    def record_size(self):
+        return self.struct.size
+
+    def pack(self, timestamp, values):
+        return self.struct.pack(timestamp, *values)
+
+    def describe(self):
+        fields = [{'name': 'time', 'type': '<f8', 'unit': 's'}]
+        fields += [{'name': f, 'type': '<f4', 'unit': u}
+                   for f, u in zip(self.fields, self.units)]
+        return {'id': self.id, 'name': self.name, 'fields': fields}
+
+
+SENSOR_STREAM = Stream(0, 'sensor', SENSOR_FIELDS, SENSOR_UNITS)
+ACTUATOR_STREAM = Stream(1, 'actuator', ACTUATOR_FIELDS, ACTUATOR_UNITS)
+STREAMS = (SENSOR_STREAM, ACTUATOR_STREAM)
+
+
+def write_header(f, start_time, streams=STREAMS):
+    header = json.dumps({
+        'version': LOG_VERSION,
+        'start_time': int(start_time),
+        'streams': [s.describe() for s in streams],
+    }).encode('utf-8')
+    f.write(LOG_MAGIC + _LENGTH.pack(len(header)) + header)
+
+
+def write_block(f, stream, records):
+    """Write a block of packed records, as returned by Stream.pack()."""
+    if not records:
+        return 0
+    d = _BLOCK.pack(stream.id, len(records)) + b''.join(records)
+    f.write(d)
+    return len(d)
+
+
+def write_footer(f, end_time):
+    f.write(_BLOCK.pack(FOOTER_ID, 0) + _FOOTER.pack(int(end_time)))
+
+
+def is_binary_log(path):
+    with open(path, 'rb') as f:
+        return f.read(len(LOG_MAGIC)) == LOG_MAGIC
+
+
+def read_log(path):
+    """Read a binary log file.
+
+    Returns the header dict, the end time (None if the log has no footer)
+    and a dict mapping stream names to NumPy structured arrays with a field
+    per column. A truncated final block is ignored.
+    """
+    raw = np.fromfile(path, dtype=np.uint8)
+    if raw[:len(LOG_MAGIC)].tobytes() != LOG_MAGIC:
+        raise ValueError('{} is not a binary log file'.format(path))
+    offset = len(LOG_MAGIC)
+    length, = _LENGTH.unpack_from(raw, offset)
+    offset += _LENGTH.size
+    header = json.loads(raw[offset:offset + length].tobytes().decode('utf-8'))
+    offset += length
+    if header['version'] != LOG_VERSION:
+        msg = 'Unsupported log version {} in {}'
+        raise ValueError(msg.format(header['version'], path))
+
+    dtypes = {}
+    names = {}
+    for s in header['streams']:
+        dtypes[s['id']] = np.dtype([(str(c['name']), c['type'])
+                                    for c in s['fields']])
+        names[s['id']] = s['name']
+    blocks = {i: [] for i in dtypes}
+    end_time = None
+    size = len(raw)
+    while offset + _BLOCK.size <= size:
+        stream_id, count = _BLOCK.unpack_from(raw, offset)
+        offset += _BLOCK.size
+        if stream_id == FOOTER_ID:
+            if offset + _FOOTER.size <= size:
+                end_time, = _FOOTER.unpack_from(raw, offset)
+            break
+        dtype = dtypes[stream_id]
+        count = min(count, (size - offset)//dtype.itemsize)
+        blocks[stream_id].append(np.frombuffer(raw, dtype, count, offset))
+        offset += count*dtype.itemsize
+
+    streams = {}
+    for i, b in blocks.items():
+        streams[names[i]] = np.concatenate(b) if b else np.zeros(0, dtypes[i])
+    return header, end_time, streams
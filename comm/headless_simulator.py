@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Headless bicycle simulator speaking the bridge UDP protocol.
+
+Implements the simulation loop of the Unity3d BicycleSimulator (Schwab,
+Recuero 2013) without Unity: sensor datagrams are received on the UDP tx port
+of the bridge, the lean dynamics of the benchmark bicycle are driven by the
+measured steer angle and rate, and the handlebar feedback torque and lean
+angle are sent to the UDP rx port of the bridge.
+
+The steer angle and rate are constant during a step, so the lean dynamics
+are discretized exactly. A step, including the feedback torque, is a single
+3x4 matrix vector product, with the matrix interpolated from a speed schedule
+precomputed once per step size, so a varying wheel rate costs no more than a
+constant one. Speeds outside the schedule are discretized exactly.
+
+By default the simulation steps every SIM_PERIOD seconds like the Unity
+simulator. In lockstep mode, each sensor datagram advances the simulation by
+one period and is answered immediately, so closed loop tests run as fast as
+the bridge can deliver samples:
+    $ ./headless_simulator.py
+    $ ./headless_simulator.py --lockstep
+"""
+import argparse
+import os
+import socket
+import sys
+import time
+
+import numpy as np
+from scipy import linalg as sla
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'scripts'))
+import bicycle_model as bm
+import simulation
+import stability
+
+import protocol
+from serial_udp_bridge import (DEFAULT_UDPHOST, DEFAULT_UDPTXPORT,
+                               DEFAULT_UDPRXPORT, PRINT_LOOP_PERIOD,
+                               UDP_BUFFER_SIZE)
+
+
+SIM_PERIOD = 0.020 # seconds, BicycleSimulator._sim_period_ms
+SIM_TIMEOUT = 2 # periods without sensor data after which steps are skipped
+STEP_CACHE_SIZE = 64 # max number of cached step matrices or schedules
+FALL_LEAN = np.pi/2 # rad, lean angle at which the bicycle has fallen
+
+
+def step_matrices(v, h):
+    """Return the 3x4 step matrices S (n, 3, 4) at n speeds v such that for
+    z = [leanrate, lean, steerrate, steer], S z = [leanrate, lean, torque]
+    after a step of h seconds with constant steer angle and rate. torque is
+    the feedback torque of the Unity simulator at the end of the step.
+    """
+    v = np.asarray(v, dtype=np.float64)
+    A = stability.state_matrices(v)
+    # lean subsystem x = [leanrate, lean] with input u = [steerrate, steer],
+    # the exponential of the augmented matrix is the step matrix of z
+    F = np.zeros((len(v), 4, 4))
+    F[:, 0] = A[:, 0, [0, 2, 1, 3]]
+    F[:, 1, 0] = 1
+    P = sla.expm(F*h)
+
+    # leanaccel = A[0] q, with q = [leanrate, steerrate, lean, steer]
+    leanaccel = F[:, 0]
+    C = v[:, None, None]*bm.C1
+    K = bm.G*bm.K0 + (v*v)[:, None, None]*bm.K2
+    torque = -(bm.M[1, 0]*leanaccel +
+               np.stack((C[:, 1, 0], K[:, 1, 0], C[:, 1, 1], K[:, 1, 1]),
+                        axis=1))
+    return np.concatenate((P[:, :2], np.matmul(torque[:, None], P)), axis=1)
+
+
+def step_matrix(v, h):
+    """Return the 3x4 step matrix S at speed v, see step_matrices()."""
+    return step_matrices([v], h)[0]
+
+
+class LeanSimulator(object):
+    """Lean dynamics of the benchmark bicycle with the steer angle and rate
+    given by the handlebar sensors, as in BicycleSimulator.cs.
+
+    When the lean angle exceeds FALL_LEAN the bicycle has fallen and the
+    simulation restarts upright, as the Unity simulator does on request.
+    """
+    def __init__(self, period=SIM_PERIOD):
+        self.period = period
+        self.z = np.zeros(4) # leanrate, lean, steerrate, steer
+        self.torque = 0.0
+        self.elapsed = 0.0
+        self.steps = 0
+        self.falls = 0
+        self._cache = {}
+        self._schedules = {}
+
+    @property
+    def lean(self):
+        return self.z[1]
+
+    def step(self, delta, deltad, wheelrate, h=None):
+        """Advance the simulation by h seconds (one period if None) and return
+        the feedback torque and lean angle.
+        """
+        if h is None:
+            h = self.period
+        self.z[2] = deltad
+        self.z[3] = delta
+        if h > 0:
+            v = bm.speed(wheelrate)
+            schedule = self._schedule(h)
+            if schedule.covers(v):
+                S = schedule(v)
+            else:
+                S = self._step_matrix(v, h)
+            leanrate, lean, self.torque = S.dot(self.z)
+            self.z[0] = leanrate
+            self.z[1] = lean
+            self.elapsed += h
+            self.steps += 1
+            if abs(lean) > FALL_LEAN:
+                self.z[:2] = 0
+                self.torque = 0.0
+                self.falls += 1
+        return self.torque, self.z[1]
+
+    def _schedule(self, h):
+        s = self._schedules.get(h)
+        if s is None:
+            if len(self._schedules) >= STEP_CACHE_SIZE:
+                self._schedules.clear()
+            s = self._schedules[h] = simulation.SpeedSchedule(
+                lambda v: step_matrices(v, h))
+        return s
+
+    def _step_matrix(self, v, h):
+        key = (v, h)
+        S = self._cache.get(key)
+        if S is None:
+            if len(self._cache) >= STEP_CACHE_SIZE:
+                self._cache.clear()
+            S = self._cache[key] = step_matrix(v, h)
+        return S
+
+
+class UdpSimulator(object):
+    """Run a LeanSimulator with sensor datagrams received on rx_addr and
+    (torque, lean) datagrams sent to tx_addr.
+    """
+    def __init__(self, rx_addr, tx_addr, period=SIM_PERIOD, lockstep=False,
+                 verbose=True):
+        self.sim = LeanSimulator(period)
+        self.lockstep = lockstep
+        self.verbose = verbose
+        self.tx_addr = tx_addr
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(rx_addr)
+        self.sensor = (0.0, 0.0, 0.0) # delta, deltad, wheelrate
+        self.received = 0
+        self.invalid = 0
+        self.sent = 0
+        self.skipped = 0
+        self._buf = bytearray(UDP_BUFFER_SIZE)
+        self._datagram = protocol.SENSOR_DATAGRAM.struct
+        self._last_received = None
+
+    def run(self, duration=None):
+        """Run until duration (seconds) has elapsed or until interrupted."""
+        start = time.perf_counter()
+        stop = None if duration is None else start + duration
+        last_print = start
+        next_step = start + self.sim.period
+        while stop is None or time.perf_counter() < stop:
+            now = time.perf_counter()
+            if self.lockstep:
+                timeout = PRINT_LOOP_PERIOD
+            else:
+                timeout = max(0, next_step - now)
+            if stop is not None:
+                timeout = min(timeout, max(0, stop - now))
+            received = self._receive(timeout)
+            now = time.perf_counter()
+            if self.lockstep:
+                if received:
+                    self._step(self.sim.period)
+            elif now >= next_step:
+                self._step(self._step_size(now))
+                next_step += self.sim.period
+                if next_step < now:
+                    # fell behind, do not try to catch up
+                    next_step = now + self.sim.period
+            if self.verbose and now - last_print >= PRINT_LOOP_PERIOD:
+                last_print = now
+                print(self.status())
+
+    def close(self):
+        self.sock.close()
+
+    def status(self):
+        delta, deltad, _ = self.sensor
+        return '{:= 8.3f}\t{:= 8.4f}\t{:= 8.4f}\t{:= 8.4f}\t{:= 8.4f}'.format(
+            self.sim.elapsed, self.sim.torque, self.sim.lean, delta, deltad)
+
+    def summary(self):
+        return ('{} sensor datagrams received, {} invalid, {} steps, {} '
+                'skipped, {} datagrams sent, {:.3f} s simulated, {} '
+                'falls'.format(self.received, self.invalid, self.sim.steps,
+                               self.skipped, self.sent, self.sim.elapsed,
+                               self.sim.falls))
+
+    def _receive(self, timeout):
+        """Receive available sensor datagrams, waiting at most timeout
+        seconds for the first. Returns True if a valid datagram was received.
+        """
+        received = False
+        self.sock.settimeout(timeout)
+        while True:
+            try:
+                n = self.sock.recv_into(self._buf)
+            except (socket.timeout, BlockingIOError):
+                break
+            if (n != self._datagram.size or
+                self._buf[0:1] != protocol.START_CHAR or
+                self._buf[n - 1:n] != protocol.END_CHAR):
+                self.invalid += 1
+            else:
+                _, delta, deltad, wheelrate, _ = self._datagram.unpack_from(
+                    self._buf)
+                self.sensor = (delta, deltad, wheelrate)
+                self._last_received = time.perf_counter()
+                self.received += 1
+                received = True
+                if self.lockstep:
+                    break
+            self.sock.setblocking(False)
+        return received
+
+    def _step_size(self, now):
+        # As in BicycleSimulator.cs, steps are skipped if no sensor data is
+        # received for a while and take the nominal period otherwise.
+        if (self._last_received is None or
+            now - self._last_received > SIM_TIMEOUT*self.sim.period):
+            self.skipped += 1
+            return 0
+        return self.sim.period
+
+    def _step(self, h):
+        torque, lean = self.sim.step(*self.sensor, h=h)
+        self.sock.sendto(protocol.STATE_DATAGRAM.pack(torque, lean),
+                         self.tx_addr)
+        self.sent += 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=
+        'Headless bicycle simulator speaking the bridge UDP protocol.')
+    parser.add_argument('-H', '--udp_host',
+        help='udp host ip ({})'.format(DEFAULT_UDPHOST),
+        default=DEFAULT_UDPHOST)
+    parser.add_argument('-P', '--udp_sensorport',
+        help='udp port of sensor datagrams ({})'.format(DEFAULT_UDPTXPORT),
+        default=DEFAULT_UDPTXPORT, type=int)
+    parser.add_argument('-p', '--udp_actuatorport',
+        help='udp port of actuator datagrams ({})'.format(DEFAULT_UDPRXPORT),
+        default=DEFAULT_UDPRXPORT, type=int)
+    parser.add_argument('-t', '--period',
+        help='simulation period in seconds ({})'.format(SIM_PERIOD),
+        default=SIM_PERIOD, type=float)
+    parser.add_argument('-l', '--lockstep',
+        help='step once for each sensor datagram instead of every period',
+        action='store_true')
+    parser.add_argument('-d', '--duration',
+        help='run time in seconds (run until interrupted)',
+        default=None, type=float)
+    parser.add_argument('-q', '--quiet',
+        help='do not print the simulation state',
+        action='store_true')
+    args = parser.parse_args()
+
+    simulator = UdpSimulator((args.udp_host, args.udp_sensorport),
+                             (args.udp_host, args.udp_actuatorport),
+                             args.period, args.lockstep, not args.quiet)
+    print('receiving sensor data on port {}, sending actuator data to port '
+          '{}{}'.format(args.udp_sensorport, args.udp_actuatorport,
+                        ', lockstep' if args.lockstep else ''))
+    sys.stdout.flush()
+    try:
+        simulator.run(args.duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.close()
+    print(simulator.summary())
+    sys.exit(0)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Latency instrumentation for the sensor -> simulator -> actuator loop.
+
+Timestamps are integer nanoseconds from time.perf_counter_ns(). Latencies
+are recorded in log-linear (HDR style) histograms with a bounded relative
+error, so percentiles can be reported for long sessions in constant memory.
+"""
+import collections
+import json
+import math
+
+
+HISTOGRAM_PRECISION_BITS = 7 # relative bucket width of 2**-(7 - 1) ~ 1.6%
+NS_PER_MS = 1e6
+NS_PER_S = 1e9
+
+
+class LatencyHistogram(object):
+    """Histogram of non-negative integer values with buckets of constant
+    relative width.
+
+    Values below 2**precision_bits are recorded exactly. Larger values are
+    recorded in buckets whose width is 2**-(precision_bits - 1) times the
+    value.
+    """
+    def __init__(self, precision_bits=HISTOGRAM_PRECISION_BITS):
+        self._bits = precision_bits
+        self._half = 1 << (precision_bits - 1)
+        self._counts = [0] * ((64 - precision_bits + 2) * self._half)
+        self.count = 0
+        self.min = None
+        self.max = None
+        self._sum = 0
+
+    def record(self, value):
+        value = max(0, int(value))
+        shift = max(0, value.bit_length() - self._bits)
+        self._counts[(value >> shift) + shift*self._half] += 1
+        self.count += 1
+        self._sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        if not self.count:
+            return None
+        return self._sum / self.count
+
+    def percentile(self, p):
+        """Return the value at percentile p (0-100), as the upper bound of
+        the bucket containing it.
+        """
+        if not self.count:
+            return None
+        target = max(1, math.ceil(p/100 * self.count))
+        total = 0
+        for i, c in enumerate(self._counts):
+            total += c
+            if total >= target:
+                return min(self._bucket_upper(i), self.max)
+        return self.max
+
+    def _bucket_upper(self, index):
+        shift = max(0, index // self._half - 1)
+        return ((index - shift*self._half + 1) << shift) - 1
+
+
+class RunningStats(object):
+    """Mean and standard deviation of a sequence (Welford's algorithm)."""
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def record(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+
+    @property
+    def std(self):
+        if self.count < 2:
+            return None
+        return math.sqrt(self._m2 / (self.count - 1))
+
+
+class StageStats(object):
+    """Latency of a stage and jitter of the interval between successive
+    stage completions.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.latency = LatencyHistogram()
+        self.interval = RunningStats()
+        self._last = None
+
+    def record(self, start_ns, end_ns):
+        self.latency.record(end_ns - start_ns)
+        if self._last is not None:
+            self.interval.record(end_ns - self._last)
+        self._last = end_ns
+
+    def to_dict(self):
+        h = self.latency
+        d = collections.OrderedDict(count=h.count)
+        if h.count:
+            d['min_ms'] = h.min / NS_PER_MS
+            d['mean_ms'] = h.mean / NS_PER_MS
+            for p in (50, 90, 99, 99.9):
+                d['p{}_ms'.format(p)] = h.percentile(p) / NS_PER_MS
+            d['max_ms'] = h.max / NS_PER_MS
+        if self.interval.count > 1:
+            d['interval_mean_ms'] = self.interval.mean / NS_PER_MS
+            d['jitter_ms'] = self.interval.std / NS_PER_MS
+        return d
+
+
+class LatencyMonitor(object):
+    """Latency of the stages of the bridge loop.
+
+    decode: serial bytes read -> frame decoded
+    send: frame decoded -> sensor datagram sent
+    simulator: last sensor datagram sent -> actuator datagram received
+    write: actuator datagram received -> torque written to serial
+    loop: serial bytes of last sent sample read -> torque written to serial
+
+    sensor() and actuator() may be called from different threads.
+    """
+    STAGES = ('decode', 'send', 'simulator', 'write', 'loop')
+
+    def __init__(self):
+        self.stages = collections.OrderedDict(
+            (s, StageStats(s)) for s in LatencyMonitor.STAGES)
+        self._last_read = None
+        self._last_sent = None
+
+    def sensor(self, read_ns, decoded_ns, sent_ns):
+        self.stages['decode'].record(read_ns, decoded_ns)
+        self.stages['send'].record(decoded_ns, sent_ns)
+        self._last_read = read_ns
+        self._last_sent = sent_ns
+
+    def actuator(self, received_ns, written_ns):
+        read_ns = self._last_read
+        sent_ns = self._last_sent
+        self.stages['write'].record(received_ns, written_ns)
+        if sent_ns is not None:
+            self.stages['simulator'].record(sent_ns, received_ns)
+            self.stages['loop'].record(read_ns, written_ns)
+
+    def to_dict(self):
+        return collections.OrderedDict(
+            (name, s.to_dict()) for name, s in self.stages.items())
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    def report(self):
+        """Return a table of stage latency and jitter, in milliseconds."""
+        columns = ('count', 'mean_ms', 'p50_ms', 'p99_ms', 'p99.9_ms',
+                   'max_ms', 'jitter_ms')
+        lines = ['{:>10}'.format('stage') +
+                 ''.join('{:>11}'.format(c.replace('_ms', ''))
+                         for c in columns)]
+        for name, d in self.to_dict().items():
+            values = []
+            for c in columns:
+                v = d.get(c)
+                if v is None:
+                    values.append('{:>11}'.format('-'))
+                elif c == 'count':
+                    values.append('{:>11}'.format(v))
+                else:
+                    values.append('{:>11.3f}'.format(v))
+            lines.append('{:>10}'.format(name) + ''.join(values))
+        return '\n'.join(lines)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Frame formats of the Arduino serial link and the simulator UDP link.
+
+Every frame is a start character, a payload of float values and an end
+character, packed without padding in native byte order. The struct codecs are
+compiled once on import and shared by the bridge, the comm test tools and the
+log parser.
+
+The sensor frame payload follows the Sample struct in the Arduino sources
+(BsgBikeSim2014/sample.h). check_sample_header() verifies that the definition
+here still matches. Run this module to check it:
+    $ ./protocol.py
+"""
+import os
+import re
+import struct
+import sys
+
+
+START_CHAR = b's'
+END_CHAR = b'e'
+
+SAMPLE_HEADER = os.path.normpath(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    os.pardir, 'BsgBikeSim2014', 'sample.h'))
+SAMPLE_STRUCT_NAME = 'Sample'
+C_TYPE_FORMATS = {'char': 'c', 'float': 'f'}
+
+# Full sensor sample, the Arduino sends a prefix of these fields
+SENSOR_FIELDS = ('delta', 'deltad', 'cadence', 'brake')
+SENSOR_UNITS = ('rad', 'rad/s', 'rpm', '')
+# Names of the sensor fields in the Arduino sources
+SAMPLE_HEADER_FIELDS = ('delta', 'deltaDot', 'cadence', 'brake')
+SENSOR_DATAGRAM_FIELDS = ('delta', 'deltad', 'wheelrate')
+STATE_FIELDS = ('torque', 'lean')
+TORQUE_FIELDS = ('torque',)
+
+
+class Frame(object):
+    """A start character, float payload fields and an end character.
+
+    pack() and unpack() use a precompiled struct.Struct of the whole frame,
+    payload is a precompiled struct.Struct of the payload only. unpack()
+    returns None if the data has the wrong size or framing characters.
+    """
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = tuple(fields)
+        self.payload = struct.Struct('=' + len(fields)*'f')
+        self.struct = struct.Struct('=c{}c'.format(len(fields)*'f'))
+
+    @property
+    def size(self):
+        return self.struct.size
+
+    def pack(self, *values):
+        return self.struct.pack(START_CHAR, *values, END_CHAR)
+
+    def unpack(self, data):
+        if len(data) != self.struct.size:
+            return None
+        values = self.struct.unpack(data)
+        if values[0] != START_CHAR or values[-1] != END_CHAR:
+            return None
+        return values[1:-1]
+
+
+def sensor_frame(num_floats):
+    """Return the serial sensor frame with num_floats payload values. Values
+    beyond the sensor fields are named float<i>.
+    """
+    fields = SENSOR_FIELDS[:num_floats]
+    fields += tuple('float{}'.format(i)
+                    for i in range(len(fields), num_floats))
+    return Frame('sensor', fields)
+
+
+SENSOR_FRAME = sensor_frame(2) # serial, Arduino -> bridge
+TORQUE_FRAME = Frame('torque', TORQUE_FIELDS) # serial, bridge -> Arduino
+SENSOR_DATAGRAM = Frame('sensor datagram', SENSOR_DATAGRAM_FIELDS) # udp
+STATE_DATAGRAM = Frame('state datagram', STATE_FIELDS) # udp
+
+
+def parse_struct(path, name=SAMPLE_STRUCT_NAME):
+    """Return a list of (C type, member name) of a struct in a C header."""
+    with open(path) as f:
+        source = f.read()
+    source = re.sub(r'//[^\n]*|/\*.*?\*/', '', source, flags=re.DOTALL)
+    m = re.search(r'struct\s+{}\s*{{(.*?)}}'.format(name), source, re.DOTALL)
+    if m is None:
+        raise ValueError('struct {} not found in {}'.format(name, path))
+    members = []
+    for declaration in m.group(1).split(';'):
+        words = declaration.split()
+        if not words:
+            continue
+        if len(words) != 2:
+            msg = 'Unsupported member declaration in {}: {}'
+            raise ValueError(msg.format(path, ' '.join(words)))
+        members.append(tuple(words))
+    return members
+
+
+def check_sample_header(frame=SENSOR_FRAME, path=SAMPLE_HEADER):
+    """Raise ValueError if the Sample struct in the Arduino sources does not
+    match the framing and the leading fields of a sensor frame.
+    """
+    members = parse_struct(path)
+    fmt = ''
+    for ctype, _ in members:
+        if ctype not in C_TYPE_FORMATS:
+            msg = 'Unsupported type {} in {}'
+            raise ValueError(msg.format(ctype, path))
+        fmt += C_TYPE_FORMATS[ctype]
+    names = [n for _, n in members[1:-1]]
+    header_names = dict(zip(SENSOR_FIELDS, SAMPLE_HEADER_FIELDS))
+    expected = [header_names.get(f, f) for f in frame.fields]
+    if fmt != frame.struct.format[1:] or names != expected:
+        msg = 'Sample struct in {} ({}: {}) does not match {} frame ({}: {})'
+        raise ValueError(msg.format(path, fmt, ', '.join(names), frame.name,
+                                    frame.struct.format, ', '.join(expected)))
+
+
+if __name__ == "__main__":
+    for frame in (SENSOR_FRAME, TORQUE_FRAME, SENSOR_DATAGRAM, STATE_DATAGRAM):
+        print('{:>16}: {:>8} {:>3} bytes  {}'.format(
+            frame.name, frame.struct.format, frame.size,
+            ', '.join(frame.fields)))
+    try:
+        check_sample_header()
+    except (OSError, ValueError) as e:
+        print(e)
+        sys.exit(1)
+    print('{} matches the sensor frame'.format(SAMPLE_HEADER))
+    sys.exit(0)
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Replay the sensor stream of a bridge log to the simulator UDP port.
+
+The log is read with parse_data.parse_log, so binary and legacy marshal logs
+are supported. Sensor samples are sent as the datagrams the bridge sends,
+following the logged timestamps at real time, at a multiple of real time or
+as fast as possible. The delay of each datagram with respect to its schedule
+is measured, and replies from the simulator on the UDP rx port are counted
+and timed to show how far the consumer falls behind:
+    $ ./replay_log.py log_150618_123728_UTC_001_1 -s 10
+"""
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'scripts'))
+import parse_data
+
+import latency
+import protocol
+from serial_udp_bridge import (DEFAULT_UDPHOST, DEFAULT_UDPTXPORT,
+                               DEFAULT_UDPRXPORT, DEFAULT_WHEEL_RATE,
+                               RAD_PER_DEG, UDP_BUFFER_SIZE,
+                               UDP_RECEIVE_TIMEOUT)
+
+
+DEFAULT_SPEED = 1.0 # multiple of real time
+SPIN_TIME = 0.0005 # seconds, wait time below which the schedule is busy waited
+
+
+def sensor_datagrams(sensor, wheel_rate=DEFAULT_WHEEL_RATE):
+    """Return the sensor datagrams of a parse_data.Sensor as a bytes object
+    of consecutive protocol.SENSOR_DATAGRAM frames, packed in a single pass.
+    """
+    frame = np.dtype([('start', 'S1'), ('delta', '=f4'), ('deltad', '=f4'),
+                      ('wheelrate', '=f4'), ('end', 'S1')])
+    assert frame.itemsize == protocol.SENSOR_DATAGRAM.size
+    datagrams = np.empty(sensor.shape[0], frame)
+    datagrams['start'] = protocol.START_CHAR
+    datagrams['end'] = protocol.END_CHAR
+    datagrams['wheelrate'] = wheel_rate
+    for f in ('delta', 'deltad'):
+        values = sensor.get_field(f).astype(np.float64)
+        if parse_data.units(f).startswith('deg'):
+            values *= RAD_PER_DEG
+        datagrams[f] = values
+    return datagrams.tobytes()
+
+
+class ReplyListener(threading.Thread):
+    """Count simulator replies and time them with respect to the most recent
+    replayed datagram.
+    """
+    def __init__(self, sock, replay):
+        threading.Thread.__init__(self, name='reply listener thread')
+        self.sock = sock
+        self.sock.settimeout(UDP_RECEIVE_TIMEOUT)
+        self.replay = replay
+        self.stats = latency.StageStats('reply')
+        self.invalid = 0
+        self._terminate = threading.Event()
+
+    def run(self):
+        buf = bytearray(UDP_BUFFER_SIZE)
+        while not self._terminate.is_set():
+            try:
+                n = self.sock.recv_into(buf)
+            except socket.timeout:
+                continue
+            received_ns = time.perf_counter_ns()
+            if protocol.STATE_DATAGRAM.unpack(buf[:n]) is None:
+                self.invalid += 1
+                continue
+            sent_ns = self.replay.last_sent_ns
+            if sent_ns is not None:
+                self.stats.record(sent_ns, received_ns)
+        self.sock.close()
+
+    def stop(self):
+        self._terminate.set()
+
+
+class Replay(object):
+    """Send the sensor stream of a log to addr at speed times real time, or
+    as fast as possible if speed is None.
+    """
+    def __init__(self, sensor, addr, speed=DEFAULT_SPEED):
+        self.addr = addr
+        self.speed = speed
+        self.time = np.asarray(sensor.time, np.float64) - sensor.time[0]
+        self.datagrams = sensor_datagrams(sensor)
+        self.sent = 0
+        self.last_sent_ns = None
+        self.duration = None
+        self.lag = latency.LatencyHistogram()
+
+    @property
+    def log_duration(self):
+        return self.time[-1] if len(self.time) else 0.0
+
+    def run(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        size = protocol.SENSOR_DATAGRAM.size
+        start = time.perf_counter()
+        try:
+            with memoryview(self.datagrams) as view:
+                for i, t in enumerate(self.time):
+                    if self.speed is not None:
+                        target = start + t/self.speed
+                        self._wait(target)
+                        self.lag.record(
+                            (time.perf_counter() - target)*latency.NS_PER_S)
+                    self.last_sent_ns = time.perf_counter_ns()
+                    sock.sendto(view[i*size:(i + 1)*size], self.addr)
+                    self.sent += 1
+        finally:
+            self.duration = time.perf_counter() - start
+            sock.close()
+
+    @staticmethod
+    def _wait(target):
+        delay = target - time.perf_counter()
+        if delay > SPIN_TIME:
+            time.sleep(delay - SPIN_TIME)
+        while time.perf_counter() < target:
+            pass
+
+
+def report(replay, listener):
+    lines = []
+    rate = replay.sent/replay.duration if replay.duration else 0
+    replayed = replay.time[replay.sent - 1] if replay.sent else 0
+    lines.append('{} of {} samples sent in {:.3f} s, {:.1f} samples/s, '
+                 '{:.2f}x real time'.format(
+                     replay.sent, len(replay.time), replay.duration, rate,
+                     replayed/replay.duration if replay.duration else 0))
+    h = replay.lag
+    if h.count:
+        lines.append('send lag (ms): mean {:.3f}, p50 {:.3f}, p99 {:.3f}, '
+                     'max {:.3f}'.format(
+                         h.mean/latency.NS_PER_MS,
+                         h.percentile(50)/latency.NS_PER_MS,
+                         h.percentile(99)/latency.NS_PER_MS,
+                         h.max/latency.NS_PER_MS))
+    if listener is not None:
+        d = listener.stats.to_dict()
+        msg = '{} replies received'.format(d['count'])
+        if listener.invalid:
+            msg += ', {} invalid'.format(listener.invalid)
+        if replay.duration:
+            msg += ', {:.1f} replies/s'.format(d['count']/replay.duration)
+        lines.append(msg)
+        if d['count']:
+            lines.append('reply delay after last sample (ms): mean {:.3f}, '
+                         'p50 {:.3f}, p99 {:.3f}, max {:.3f}'.format(
+                             d['mean_ms'], d['p50_ms'], d['p99_ms'],
+                             d['max_ms']))
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=
+        'Replay the sensor stream of a bridge log to the simulator UDP port.')
+    parser.add_argument('log',
+        help='bridge log file')
+    parser.add_argument('-s', '--speed',
+        help='replay speed as a multiple of real time ({})'.format(
+            DEFAULT_SPEED),
+        default=DEFAULT_SPEED, type=float)
+    parser.add_argument('-f', '--fast',
+        help='replay as fast as possible',
+        action='store_true')
+    parser.add_argument('-H', '--udp_host',
+        help='udp remote host ip ({})'.format(DEFAULT_UDPHOST),
+        default=DEFAULT_UDPHOST)
+    parser.add_argument('-P', '--udp_txport',
+        help='udp tx port ({})'.format(DEFAULT_UDPTXPORT),
+        default=DEFAULT_UDPTXPORT, type=int)
+    parser.add_argument('-p', '--udp_rxport',
+        help='udp rx port for simulator replies ({})'.format(
+            DEFAULT_UDPRXPORT),
+        default=DEFAULT_UDPRXPORT, type=int)
+    parser.add_argument('--no_listen',
+        help='do not listen for simulator replies',
+        action='store_true')
+    args = parser.parse_args()
+
+    if args.speed <= 0:
+        parser.error('speed must be positive')
+
+    try:
+        sensor, _ = parse_data.parse_log(args.log)
+    except (OSError, ValueError) as e:
+        print(e)
+        sys.exit(1)
+    replay = Replay(sensor, (args.udp_host, args.udp_txport),
+                    None if args.fast else args.speed)
+
+    listener = None
+    if not args.no_listen:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.bind((args.udp_host, args.udp_rxport))
+        except OSError as e:
+            print('Not listening for replies on port {}: {}'.format(
+                args.udp_rxport, e))
+            sock.close()
+        else:
+            listener = ReplyListener(sock, replay)
+            listener.start()
+
+    print('replaying {} samples ({:.1f} s) from {} to port {} {}'.format(
+        len(replay.time), replay.log_duration, args.log, args.udp_txport,
+        'as fast as possible' if args.fast else
+        'at {}x real time'.format(args.speed)))
+    try:
+        replay.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if listener is not None:
+            # wait for replies to samples sent last
+            time.sleep(UDP_RECEIVE_TIMEOUT)
+            listener.stop()
+            listener.join()
+    print(report(replay, listener))
+    sys.exit(0)
@@ -4,17 +4,13 @@
 import os
 import sys
 import socket
-import struct
 
-SERIAL_START_CHAR = b's'
-SERIAL_END_CHAR = b'e'
+import protocol
 
 def transmit_sensors(port, args):
     num_args = len(args)
     args = [float(a) for a in args]
-    args.append(SERIAL_END_CHAR)
-    packet = struct.pack('=c{}fc'.format(num_args),
-                         SERIAL_START_CHAR, *args)
+    packet = protocol.sensor_frame(num_args).pack(*args)
     print(len(packet), packet)
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.sendto(packet, ("localhost", port))
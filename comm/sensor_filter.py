@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming lowpass filter of sensor samples for the serial to UDP bridge.
+
+Samples are filtered with the second-order sections of the sos mode of
+generate_filter_coeffcients.py, the filter that would otherwise be generated
+for the Arduino, so the bridge can filter a raw sensor stream without
+reflashing the firmware. The filter state is kept between calls, so all
+samples of a serial read are filtered in one call. With a decimation factor
+N only every N-th filtered sample is output, at 1/N of the serial sample
+rate, and the cutoff must be below the Nyquist frequency of the output rate.
+Non-finite values, from corrupted frames, would make all later outputs NaN,
+so they are replaced by the previous finite value of their column.
+"""
+import os
+import sys
+
+import numpy as np
+from scipy import signal
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'scripts'))
+import generate_filter_coeffcients as gfc
+
+
+class SensorFilter(object):
+    """Lowpass filter of each column of a stream of samples, decimated by
+    decimation. sos are second-order sections (sections, 6). The filter
+    starts in the steady state of the first sample.
+    """
+    def __init__(self, sos, decimation=1):
+        if decimation < 1:
+            raise ValueError('decimation must be at least 1')
+        self.sos = np.asarray(sos, dtype=np.float64)
+        self.decimation = decimation
+        self.samples = 0 # number of filtered samples
+        self.outputs = 0 # number of output samples
+        self.held = 0 # number of samples with non-finite values held
+        self._zi = None
+        self._last = None # last input sample
+
+    @classmethod
+    def lowpass(cls, filter_name, order, cutoff_freq, sample_freq,
+                decimation=1):
+        """Return a SensorFilter with the coefficients generate() uses for
+        the same arguments in sos mode. Raises ValueError if the cutoff is
+        not below the Nyquist frequency of the output rate.
+        """
+        nyquist = sample_freq/(2*decimation)
+        if not 0 < cutoff_freq < nyquist:
+            msg = 'cutoff {} Hz not below the output Nyquist frequency {} Hz'
+            raise ValueError(msg.format(cutoff_freq, nyquist))
+        sos = gfc.balance_sections(gfc.lowpass_coeffs(
+            gfc.FILTER_TYPES[filter_name], cutoff_freq, sample_freq, order,
+            output='sos'))
+        return cls(sos, decimation)
+
+    def summary(self):
+        msg = '{} sensor samples filtered, {} sent, {} non-finite held'
+        return msg.format(self.samples, self.outputs, self.held)
+
+    def process(self, x):
+        """Filter the samples x (samples, columns) and return the indices of
+        the output samples in x and their filtered values (outputs, columns).
+        """
+        x = np.asarray(x, dtype=np.float64)
+        if not len(x):
+            return np.arange(0), np.empty_like(x)
+        x = self._hold(x)
+        self._last = x[-1]
+        if self._zi is None:
+            self._zi = signal.sosfilt_zi(self.sos)[:, :, None]*x[0]
+        y, self._zi = signal.sosfilt(self.sos, x, axis=0, zi=self._zi)
+        # outputs are samples decimation - 1, 2*decimation - 1, ... of the
+        # stream
+        first = (-self.samples - 1) % self.decimation
+        index = np.arange(first, len(x), self.decimation)
+        self.samples += len(x)
+        self.outputs += len(index)
+        return index, y[index]
+
+    def _hold(self, x):
+        """Return x with non-finite values replaced by the previous finite
+        value of their column, or 0 before the first finite value.
+        """
+        finite = np.isfinite(x)
+        if finite.all():
+            return x
+        self.held += int((~finite).any(axis=1).sum())
+        last = np.zeros(x.shape[1]) if self._last is None else self._last
+        rows = np.where(finite, np.arange(len(x))[:, None], -1)
+        rows = np.maximum.accumulate(rows, axis=0)
+        columns = np.arange(x.shape[1])
+        return np.where(rows >= 0, x[np.maximum(rows, 0), columns], last)
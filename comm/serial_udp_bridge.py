@@ -4,11 +4,15 @@
 Convert serial data in CSV format to XML and send via UDP.
 """
 import argparse
-import marshal
+import asyncio
+import collections
+import concurrent.futures
+import json
 import math
+import os
 import queue
+import signal
 import socket
-import socketserver
 import struct
 import sys
 import threading
@@ -16,6 +20,10 @@ import time
 
 import serial
 
+import binlog
+import latency
+import protocol
+
 #import hanging_threads
 
 
@@ -32,19 +40,42 @@ RAD_PER_DEG = 2*math.pi/360
 WHEEL_RADIUS = 0.3 # m
 DEFAULT_WHEEL_RATE = -1*4/WHEEL_RADIUS # m/s -> rad/s
 
-g_log_queue = queue.Queue() # elements are (timestamp, 'log line')
+LOG_QUEUE_SIZE = 100000 # max number of queued log records
+LOG_FLUSH_SIZE = 65536 # bytes, batch size at which log records are written
+LOG_FLUSH_PERIOD = 1.0 # seconds, max time log records are held before writing
+LOG_POLICY_DROP = 'drop' # drop new log records when the log queue is full
+LOG_POLICY_BLOCK = 'block' # block producers when the log queue is full
 SERIAL_WRITE_TIMEOUT = 0.005 # seconds
 SERIAL_READ_TIMEOUT = 0.001 # seconds, timeout for reading most recent value
                            #          sensor/actuator queue in main thread
+UDP_BUFFER_SIZE = 64 # bytes, max actuator datagram size
+UDP_RECEIVE_TIMEOUT = 0.1 # seconds, actuator thread stop request poll period
+SERIAL_POLL_PERIOD = 0.001 # seconds, serial poll period if the serial port
+                           #          can not be watched by the event loop
 PRINT_LOOP_PERIOD = 0.1 # seconds, approx print loop time period
+ENGINE_THREADS = 'threads' # sensor, actuator and log threads
+ENGINE_ASYNCIO = 'asyncio' # single asyncio event loop
+ASYNC_SWITCH_INTERVAL = 0.0002 # seconds, max time the event loop waits for
+                               # the GIL held by the log writer thread
+LATENCY_REPORT_PERIOD = 10 # seconds, period of latency statistics output
+RIG_REQUIRED_KEYS = ('port', 'subject', 'feedback', 'udp_txport',
+                     'udp_rxport')
+RIG_KEYS = RIG_REQUIRED_KEYS + ('name', 'baudrate', 'udp_host', 'torque_rate',
+                                'payload_floats', 'log_dir', 'filter',
+                                'filter_order', 'filter_cutoff', 'sample_rate',
+                                'decimation')
+
+SERIAL_START_CHAR = protocol.START_CHAR
+SERIAL_END_CHAR = protocol.END_CHAR
+SERIAL_PAYLOAD_FLOATS = len(protocol.SENSOR_FRAME.fields)
+FRAME_DECODER_MAX_RUN = 256 # max frames checked for alignment at once
 
-# TODO: Read these values from Arduino sources
-SERIAL_START_CHAR = b's'
-SERIAL_END_CHAR = b'e'
-SERIAL_PAYLOAD_SIZE = 8 # 2 * sizeof(float)
+FILTER_TYPES = ('butter', 'cheby1', 'cheby2') # sensor filter types
+DEFAULT_FILTER_ORDER = 2
+DEFAULT_SAMPLE_RATE = 50.0 # Hz, serial sample rate of the firmware,
+                           #     SAMPLING_FREQ/SERIAL_TX_PRE
 
 DEFAULT_FLOAT_FORMAT = ':= 8.4f'
-MARSHAL_VERSION = 4
 
 
 #def info(type, value, tb):
@@ -58,46 +89,218 @@ MARSHAL_VERSION = 4
 
 
 def encode_torque(torque):
-    return struct.pack('=cfc', SERIAL_START_CHAR, torque, SERIAL_END_CHAR)
+    return protocol.TORQUE_FRAME.pack(torque)
 
 def decode_state(data):
-    if len(data) != 10: # 2*sizeof(float) + 2*sizeof(char)
+    return protocol.STATE_DATAGRAM.unpack(data)
+
+def encode_sensor(sample):
+    return protocol.SENSOR_DATAGRAM.pack(sample.delta, sample.deltad,
+                                         DEFAULT_WHEEL_RATE)
+
+def saturate_torque(torque):
+    """Scale a torque command and limit it to TORQUE_LIMIT. NaN values are
+    returned unchanged.
+    """
+    torque *= TORQUE_SCALING_FACTOR
+    if abs(torque) > TORQUE_LIMIT:
+        torque = math.copysign(TORQUE_LIMIT, torque)
+    return torque
+
+def log_sensor(timestamp, sample, log_queue=None):
+    if log_queue is None:
+        log_queue = g_log_queue
+    d = binlog.SENSOR_STREAM.pack(timestamp, sample.to_list())
+    log_queue.put_record((binlog.SENSOR_STREAM, d))
+
+def log_actuator(timestamp, torque, lean, log_queue=None):
+    if log_queue is None:
+        log_queue = g_log_queue
+    d = binlog.ACTUATOR_STREAM.pack(timestamp, (torque, lean))
+    log_queue.put_record((binlog.ACTUATOR_STREAM, d))
+
+
+def receive_state(data, received_ns, writer, start_time, log_queue=None):
+    """Decode an actuator datagram, pass the saturated torque to the torque
+    writer and log the command to log_queue (g_log_queue if None). Returns
+    the saturated torque or None if the datagram is invalid.
+    """
+    state = decode_state(data)
+    if state is None:
+        print('Invalid state received: ({}) {}'.format(len(data), bytes(data)))
         return None
-    prefix_char, torque, lean, suffix_char = struct.unpack('=cffc', data)
-    if prefix_char == SERIAL_START_CHAR and suffix_char == SERIAL_END_CHAR:
-        return torque, lean
-    return None
-
-
-class UdpHandler(socketserver.BaseRequestHandler):
-    def handle(self):
-        data = self.request[0].strip()
-        state = decode_state(data)
-        if state is None:
-            print('Invalid state received: ({}) {}'.format(len(data), data))
+
+    torque, lean = state
+    saturated = saturate_torque(torque)
+    if not math.isnan(saturated):
+        writer.put(saturated, received_ns)
+    log_actuator(time.time() - start_time, torque, lean, log_queue)
+    return saturated
+
+
+class TorqueWriter(object):
+    """Serial writer for the newest torque command.
+
+    Only the newest command is kept as older commands are of no use to the
+    motor. A command replaced before it is written is counted as coalesced
+    and a command not written within the serial write timeout as dropped.
+    If rate is set, the newest command is written at that rate (Hz),
+    otherwise a command is written as soon as possible after it is received.
+    """
+    def __init__(self, serial_port, rate=None, latency=None):
+        self.ser = serial_port
+        self.rate = rate
+        self.latency = latency
+        self.torque = None # newest torque command
+        self.commands = 0
+        self.written = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self._received_ns = None
+        self._pending = False
+
+    def summary(self):
+        msg = '{} torque commands, {} written, {} coalesced, {} dropped'
+        return msg.format(self.commands, self.written, self.coalesced,
+                          self.dropped)
+
+    def _update(self, torque, received_ns):
+        self.commands += 1
+        if self._pending:
+            self.coalesced += 1
+        self.torque = torque
+        self._received_ns = received_ns
+        self._pending = True
+
+    def _take(self):
+        """Return the newest command and its receive time. The receive time
+        is None if the command has already been written.
+        """
+        received_ns = self._received_ns
+        self._received_ns = None
+        self._pending = False
+        return self.torque, received_ns
+
+    def _write(self, torque, received_ns):
+        try:
+            serial_write(self.ser, encode_torque(torque))
+        except serial.SerialTimeoutException:
+            self.dropped += 1
             return
+        self.written += 1
+        if self.latency is not None and received_ns is not None:
+            self.latency.actuator(received_ns, time.perf_counter_ns())
+
+
+class ActuatorWriter(TorqueWriter, threading.Thread):
+    """TorqueWriter running in its own thread."""
+    def __init__(self, serial_port, rate=None, latency=None):
+        threading.Thread.__init__(self, name='actuator writer thread')
+        TorqueWriter.__init__(self, serial_port, rate, latency)
+        self._cond = threading.Condition()
+        self._terminate = False
+
+    def put(self, torque, received_ns):
+        with self._cond:
+            self._update(torque, received_ns)
+            self._cond.notify()
+
+    def run(self):
+        next_time = time.perf_counter()
+        while True:
+            with self._cond:
+                if self.rate is None:
+                    self._cond.wait_for(
+                        lambda: self._pending or self._terminate)
+                else:
+                    next_time = max(next_time + 1/self.rate,
+                                    time.perf_counter())
+                    self._cond.wait_for(lambda: self._terminate,
+                                        next_time - time.perf_counter())
+                if self._terminate:
+                    break
+                torque, received_ns = self._take()
+            if torque is not None:
+                self._write(torque, received_ns)
+
+    def stop(self):
+        """Request ActuatorWriter object to stop."""
+        with self._cond:
+            self._terminate = True
+            self._cond.notify()
+
+
+class AsyncActuatorWriter(TorqueWriter):
+    """TorqueWriter scheduled on an asyncio event loop. Commands received in
+    the same event loop iteration are coalesced.
+    """
+    def __init__(self, serial_port, rate=None, latency=None):
+        TorqueWriter.__init__(self, serial_port, rate, latency)
+        self._loop = None
+        self._handle = None
+        self._next_time = None
+        self._stopped = False
+
+    def start(self, loop):
+        self._loop = loop
+        if self.rate is not None:
+            self._next_time = loop.time()
+            self._tick()
 
-        torque, lean = state
-        self.server.torque = torque * TORQUE_SCALING_FACTOR
-        if not math.isnan(self.server.torque):
-            if abs(self.server.torque) > TORQUE_LIMIT: # saturate torque
-                self.server.torque = math.copysign(TORQUE_LIMIT,
-                                                   self.server.torque)
-            serial_write(self.server.serial, encode_torque(self.server.torque))
-        d = marshal.dumps((time.time() - self.server.start_time,
-                           'actuator', [torque, lean]),
-                          MARSHAL_VERSION)
-        g_log_queue.put(d)
-
-
-class UdpServer(socketserver.UDPServer):
-    def __init__(self, server_address, RequestHandlerClass,
-                 serial_port, start_time ):
-        socketserver.UDPServer.__init__(self, server_address,
-                                        RequestHandlerClass)
-        self.serial = serial_port
+    def put(self, torque, received_ns):
+        scheduled = self._pending
+        self._update(torque, received_ns)
+        if self.rate is None and not scheduled:
+            self._loop.call_soon(self._flush)
+
+    def stop(self):
+        self._stopped = True
+        if self._handle is not None:
+            self._handle.cancel()
+
+    def _flush(self):
+        if self._pending and not self._stopped:
+            self._write(*self._take())
+
+    def _tick(self):
+        torque, received_ns = self._take()
+        if torque is not None:
+            self._write(torque, received_ns)
+        self._next_time = max(self._next_time + 1/self.rate, self._loop.time())
+        self._handle = self._loop.call_at(self._next_time, self._tick)
+
+
+class ActuatorListener(threading.Thread):
+    """Receive actuator datagrams into a preallocated buffer and pass the
+    torque commands to a TorqueWriter.
+    """
+    def __init__(self, addr, writer, start_time):
+        threading.Thread.__init__(self, name='actuator thread')
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(addr)
+        self.sock.settimeout(UDP_RECEIVE_TIMEOUT)
+        self.writer = writer
         self.start_time = start_time
         self.torque = None
+        self._buffer = bytearray(UDP_BUFFER_SIZE)
+        self._terminate = threading.Event()
+
+    def run(self):
+        view = memoryview(self._buffer)
+        while not self._terminate.is_set():
+            try:
+                n = self.sock.recv_into(self._buffer)
+            except socket.timeout:
+                continue
+            torque = receive_state(view[:n], time.perf_counter_ns(),
+                                   self.writer, self.start_time)
+            if torque is not None:
+                self.torque = torque
+        self.sock.close()
+
+    def stop(self):
+        """Request ActuatorListener object to stop."""
+        self._terminate.set()
 
 
 class Sample(object):
@@ -114,16 +317,23 @@ class Sample(object):
         return Sample._size
 
     @classmethod
-    def decode(cls, data):
-        # TODO: Read struct format from Arduino sources
-        if data[0] != SERIAL_START_CHAR:
+    def decode(cls, data, frame=protocol.SENSOR_FRAME):
+        """Decode a sample from a start character followed by the payload."""
+        if data[:1] != SERIAL_START_CHAR:
             msg = "Start character not detected in sample, len {}"
             raise ValueError(msg.format(len(data) - 1))
         try:
-            delta, deltad = struct.unpack('=ff', struct.pack('=8c', *data[1:]))
+            payload = frame.payload.unpack(data[1:])
         except struct.error:
             raise ValueError("Invalid struct size: {}".format(len(data) - 1))
-        return Sample(delta, deltad, 0, 0)
+        return cls.from_payload(payload)
+
+    @classmethod
+    def from_payload(cls, payload):
+        """Create a sample from the values of a sensor frame payload. Fields
+        missing from the payload are zero and extra values are ignored.
+        """
+        return cls(*payload[:cls._size])
 
     def print(self, delim=','):
         return delim.join(str(val) for val in
@@ -147,10 +357,115 @@ class Sample(object):
         return [self.delta, self.deltad, self.cadence, self.brake]
 
 
+class FrameDecoder(object):
+    """Split a serial byte stream into frames of a protocol.Frame.
+
+    Bytes are accumulated in a bytearray and all complete frames in the buffer
+    are decoded in a single call. Runs of aligned, well formed frames are
+    detected with strided slices and unpacked together with
+    Struct.iter_unpack. Anything else is handled by searching for the next end
+    character, which gives the same resynchronization behaviour as the
+    original byte by byte decoder: an end character closes a frame once at
+    least a full payload has been received since the previous frame, the
+    frame being the payload size + 1 bytes preceding it. A frame without the
+    start character is rejected.
+    """
+    def __init__(self, frame=protocol.SENSOR_FRAME):
+        self._frame = frame.struct
+        self._buffer = bytearray()
+        self._start = ord(SERIAL_START_CHAR)
+        self._end = ord(SERIAL_END_CHAR)
+        self.frames = 0 # number of decoded frames
+        self.rejected = 0 # number of frames without a start character
+        self.discarded = 0 # number of bytes skipped while resynchronizing
+
+    @property
+    def frame_size(self):
+        return self._frame.size
+
+    @property
+    def pending(self):
+        """Number of buffered bytes not yet part of a complete frame."""
+        return len(self._buffer)
+
+    def feed(self, data):
+        """Add data to the buffer and return a list of the payloads of all
+        complete frames. Each payload is a tuple of unpacked values.
+        """
+        self._buffer += data
+        buf = self._buffer
+        size = self._frame.size
+        payloads = []
+        start = 0
+        end = len(buf)
+        while end - start >= size:
+            n = 0
+            if (buf[start] == self._start and
+                buf[start + size - 1] == self._end):
+                n = self._aligned_frames(start, end)
+            if n > 0:
+                stop = start + n*size
+                payloads.extend(self._unpack(start, stop))
+                start = stop
+                continue
+
+            # frame is misaligned, search for the next end character
+            i = buf.find(SERIAL_END_CHAR, start + size - 1)
+            if i < 0:
+                # keep at most a full frame of data for the next read
+                keep = max(start, end - (size - 1))
+                self.discarded += keep - start
+                start = keep
+                break
+            frame_start = i - (size - 1)
+            self.discarded += frame_start - start
+            start = i + 1
+            if buf[frame_start:frame_start + 1] != SERIAL_START_CHAR:
+                self.rejected += 1
+                msg = 'Start character not detected in sample, len {}'
+                print('Invalid sample received: {}'.format(
+                    msg.format(size - 2)))
+                continue
+            payloads.extend(self._unpack(frame_start, start))
+        del buf[:start]
+        return payloads
+
+    def _aligned_frames(self, start, end):
+        """Return the number of consecutive well formed frames beginning at
+        index start, up to FRAME_DECODER_MAX_RUN frames.
+        """
+        size = self._frame.size
+        n = min((end - start)//size, FRAME_DECODER_MAX_RUN)
+        stop = start + n*size
+        prefix = bytes(self._buffer[start:stop:size])
+        suffix = bytes(self._buffer[start + size - 1:stop:size])
+        return min(len(prefix) - len(prefix.lstrip(SERIAL_START_CHAR)),
+                   len(suffix) - len(suffix.lstrip(SERIAL_END_CHAR)))
+
+    def _unpack(self, start, stop):
+        size = self._frame.size
+        n = (stop - start)//size
+        self.frames += n
+        with memoryview(self._buffer)[start:stop] as view:
+            return [f[1:-1] for f in self._frame.iter_unpack(view)]
+
+
 class Receiver(object):
-    def __init__(self, serial_port):
-        self.byte_q = [] # queue of bytes/incomplete samples
-        self.sample_q = queue.Queue() # queue of complete samples
+    """Receive samples of payload_floats float values. Values after the
+    sensor fields are ignored.
+
+    If a sensor_filter.SensorFilter is given, the steer angle and rate of
+    all samples of a read are filtered in one call and the output sample of
+    a sample is the filtered sample, or None if the sample is dropped by
+    decimation. Otherwise the output sample is the sample itself.
+    """
+    def __init__(self, serial_port, payload_floats=SERIAL_PAYLOAD_FLOATS,
+                 sensor_filter=None):
+        self.decoder = FrameDecoder(protocol.sensor_frame(payload_floats))
+        self.sensor_filter = sensor_filter
+        # queue of complete samples as (sample, output sample, read time,
+        # decode time) tuples, with times from time.perf_counter_ns()
+        self.sample_q = collections.deque()
         self.ser = serial_port
 
     def receive(self):
@@ -160,95 +475,687 @@ class Receiver(object):
         """
         num_bytes = self.ser.inWaiting()
         if num_bytes > 0:
-            byte_data = struct.unpack('={}c'.format(num_bytes),
-                                      self.ser.read(num_bytes))
-            for b in byte_data:
-                if b == SERIAL_END_CHAR:
-                    if len(self.byte_q) < (SERIAL_PAYLOAD_SIZE + 1):
-                        # this is part of the payload
-                        self.byte_q.append(b)
-                        continue
-                    if len(self.byte_q) > (SERIAL_PAYLOAD_SIZE + 1):
-                        # last end char wasn't received
-                        sample_bytes = self.byte_q[-(SERIAL_PAYLOAD_SIZE + 1):]
-                    else:
-                        sample_bytes = self.byte_q
-                    self.byte_q = []
-                    try:
-                        sample = Sample.decode(sample_bytes)
-                        self.sample_q.put(sample)
-                    except ValueError as ex: #invalid input
-                        print('Invalid sample received: {}'.format(ex))
-                else:
-                    self.byte_q.append(b)
-        return not self.sample_q.empty()
+            data = self.ser.read(num_bytes)
+            read_ns = time.perf_counter_ns()
+            payloads = self.decoder.feed(data)
+            samples = [Sample.from_payload(p) for p in payloads]
+            outputs = self._filter(samples)
+            decoded_ns = time.perf_counter_ns()
+            for sample, output in zip(samples, outputs):
+                self.sample_q.append((sample, output, read_ns, decoded_ns))
+        return len(self.sample_q) > 0
+
+    def _filter(self, samples):
+        if self.sensor_filter is None or not samples:
+            return samples
+        index, values = self.sensor_filter.process(
+            [(s.delta, s.deltad) for s in samples])
+        outputs = [None]*len(samples)
+        for i, (delta, deltad) in zip(index.tolist(), values.tolist()):
+            s = samples[i]
+            outputs[i] = Sample(delta, deltad, s.cadence, s.brake)
+        return outputs
 
 
 class SensorListener(threading.Thread):
-    def __init__(self, serial_port, udp, addr, start_time):
+    """Send the output samples of a Receiver to addr and log all received
+    samples.
+    """
+    def __init__(self, serial_port, udp, addr, start_time, latency=None,
+                 payload_floats=SERIAL_PAYLOAD_FLOATS, sensor_filter=None):
         threading.Thread.__init__(self, name='sensor thread')
         self.ser = serial_port
         self.udp = udp
         self.addr = addr
         self.sample = None
         self.start_time = start_time
+        self.latency = latency
+        self.receiver = Receiver(serial_port, payload_floats, sensor_filter)
+        self._terminate = threading.Event()
 
     def run(self):
-        receiver = Receiver(ser)
-        while self.ser.isOpen():
+        receiver = self.receiver
+        while self.ser.isOpen() and not self._terminate.is_set():
             try:
                 if not receiver.receive():
                     time.sleep(0) # no data ready, yield thread
                     continue
             except OSError: # serial port closed
                 break
-            self.sample = receiver.sample_q.get()
-            self.udp.sendto(struct.pack('=cfffc',
-                SERIAL_START_CHAR, self.sample.delta,
-                self.sample.deltad,
-                DEFAULT_WHEEL_RATE,
-                SERIAL_END_CHAR), self.addr)
-            d = marshal.dumps((time.time() - self.start_time,
-                               'sensor', self.sample.to_list()),
-                              MARSHAL_VERSION)
-            g_log_queue.put(d)
+            sample, output, read_ns, decoded_ns = receiver.sample_q.popleft()
+            if output is not None:
+                self.sample = output
+                self.udp.sendto(encode_sensor(output), self.addr)
+                if self.latency is not None:
+                    self.latency.sensor(read_ns, decoded_ns,
+                                        time.perf_counter_ns())
+            log_sensor(time.time() - self.start_time, sample)
+
+    def stop(self):
+        """Request SensorListener object to stop."""
+        self._terminate.set()
 
 
 def utc_filename():
     return time.strftime('%y%m%d_%H%M%S_UTC', time.gmtime())
 
 
-class Logger(threading.Thread):
-    def __init__(self, subject, feedback_enabled):
-        threading.Thread.__init__(self, name='log thread')
-        self._terminate = threading.Event()
+class LogQueue(queue.Queue):
+    """Bounded queue of (stream, packed record) log records. If the queue is
+    full, new records are dropped or the producer blocks until the logger has
+    caught up, depending on the queue policy.
+    """
+    def __init__(self, maxsize=LOG_QUEUE_SIZE, policy=LOG_POLICY_DROP):
+        queue.Queue.__init__(self, maxsize)
+        self.policy = policy
+        self.dropped = 0
+
+    def put_record(self, record):
+        if self.policy == LOG_POLICY_BLOCK:
+            self.put(record)
+            return
+        try:
+            self.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def get_batch(self, max_size=LOG_FLUSH_SIZE):
+        """Remove and return queued records, up to max_size bytes, without
+        blocking.
+        """
+        batch = []
+        batch_size = 0
+        try:
+            while batch_size < max_size:
+                d = self.get_nowait()
+                batch.append(d)
+                batch_size += len(d[1])
+        except queue.Empty:
+            pass
+        return batch
+
+
+g_log_queue = LogQueue() # elements are (binlog.Stream, packed record)
+
+
+class LogFile(object):
+    """Binary log file for a session, split into multiple files if rotation
+    is enabled.
+
+    Each file has a header with the start time and record layout and a
+    footer with the end time. A new file is started before a batch is
+    written if the current file exceeds rotate_size bytes or has been open
+    for rotate_period seconds, so no file is left without records.
+    Files started within the same second get a .N suffix.
+    Files are written to directory, which is created if it does not exist.
+    """
+    def __init__(self, subject, feedback_enabled,
+                 rotate_size=None, rotate_period=None, directory=None):
         self.subject = subject
         self.feedback_enabled = feedback_enabled
+        self.rotate_size = rotate_size
+        self.rotate_period = rotate_period
+        self.directory = directory
+        self.filenames = []
+        self._log = None
+        self._log_size = 0
+        self._log_start = None
 
-    def run(self):
-        t0 = time.time()
-        timestamp = t0
+    def open(self):
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+        filename = self._filename()
+        print('Logging sensor/actuator data to {}'.format(filename))
+        self._log = open(filename, 'wb')
+        self._log_start = time.time()
+        self._log_size = 0
+        self.filenames.append(filename)
+        binlog.write_header(self._log, self._log_start)
+
+    def write(self, batch):
+        """Write a batch of log records, one block per stream, to a new file
+        if the rotation limits of the current file are exceeded.
+        """
+        if not batch:
+            return
+        if self._should_rotate(time.time()):
+            self.close()
+            self.open()
+        records = {stream: [] for stream in binlog.STREAMS}
+        for stream, d in batch:
+            records[stream].append(d)
+        for stream, r in records.items():
+            self._log_size += binlog.write_block(self._log, stream, r)
+
+    def close(self):
+        if self._log is None:
+            return
+        binlog.write_footer(self._log, time.time())
+        self._log.close()
+        self._log = None
+        print('Data logged to {}'.format(self.filenames[-1]))
+
+    def _filename(self):
         filename = 'log_{}_{}_{}'.format(utc_filename(), self.subject,
                                          self.feedback_enabled)
-        print('Logging sensor/actuator data to {}'.format(filename))
-        with open(filename, 'wb') as log:
-            marshal.dump(int(time.time()), log, MARSHAL_VERSION)
-            while not g_log_queue.empty():
+        if self.directory is not None:
+            filename = os.path.join(self.directory, filename)
+        if filename in self.filenames:
+            # rotated more than once within a second
+            filename += '.{}'.format(len(self.filenames))
+        return filename
+
+    def _should_rotate(self, now):
+        if self.rotate_size is not None and self._log_size >= self.rotate_size:
+            return True
+        if (self.rotate_period is not None and
+            now - self._log_start >= self.rotate_period):
+            return True
+        return False
+
+
+class Logger(threading.Thread):
+    """Write queued log records to file for the duration of a session.
+
+    Records are written in batches when LOG_FLUSH_SIZE bytes are pending or
+    LOG_FLUSH_PERIOD has elapsed.
+    """
+    def __init__(self, subject, feedback_enabled,
+                 rotate_size=None, rotate_period=None):
+        threading.Thread.__init__(self, name='log thread')
+        self._terminate = threading.Event()
+        self.log_file = LogFile(subject, feedback_enabled,
+                                rotate_size, rotate_period)
+
+    @property
+    def filenames(self):
+        return self.log_file.filenames
+
+    def run(self):
+        batch = []
+        batch_size = 0
+        last_flush = time.time()
+        self.log_file.open()
+        try:
+            while not (self._terminate.is_set() and g_log_queue.empty()):
+                timeout = max(0, last_flush + LOG_FLUSH_PERIOD - time.time())
                 try:
-                    d  = g_log_queue.get_nowait()
+                    d = g_log_queue.get(timeout=timeout)
+                    batch.append(d)
+                    batch_size += len(d[1])
+                    while batch_size < LOG_FLUSH_SIZE:
+                        d = g_log_queue.get_nowait()
+                        batch.append(d)
+                        batch_size += len(d[1])
                 except queue.Empty:
-                    # if nothing to write
-                    time.sleep(0) # yield thread
-                    continue
-                log.write(d)
-            marshal.dump(int(time.time()), log, MARSHAL_VERSION)
-        print('Data logged to {}'.format(filename))
+                    pass
+
+                now = time.time()
+                if (batch_size >= LOG_FLUSH_SIZE or
+                    now - last_flush >= LOG_FLUSH_PERIOD):
+                    self.log_file.write(batch)
+                    batch = []
+                    batch_size = 0
+                    last_flush = now
+            self.log_file.write(batch)
+        finally:
+            self.log_file.close()
 
     def terminate(self):
-        """Request Logger object to stop."""
+        """Request Logger object to stop after all queued records are
+        written.
+        """
         self._terminate.set()
 
 
+class AsyncLogQueue(object):
+    """Log queue with a producer on an event loop and a consumer in a log
+    writer thread.
+
+    Records are kept in a deque, whose append and popleft are atomic, so
+    neither side takes a lock per record or holds the GIL for long, which
+    would delay the event loop. If the queue is full, new records are
+    dropped or, with the block policy, flush() is called to write the queued
+    records, as the producer can not wait for the consumer. wake() is called
+    when LOG_FLUSH_SIZE bytes are pending.
+    """
+    def __init__(self, maxsize, policy, flush, wake):
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+        self._records = collections.deque()
+        self._flush = flush
+        self._wake = wake
+        self._pending = 0
+
+    def full(self):
+        return len(self._records) >= self.maxsize
+
+    def empty(self):
+        return not self._records
+
+    def put_record(self, record):
+        if self.full():
+            if self.policy != LOG_POLICY_BLOCK:
+                self.dropped += 1
+                return
+            self._flush()
+        self._records.append(record)
+        self._pending += len(record[1])
+        if self._pending >= LOG_FLUSH_SIZE:
+            self._pending = 0
+            self._wake()
+
+    def get_batch(self, max_size=LOG_FLUSH_SIZE):
+        """Remove and return queued records, up to max_size bytes."""
+        batch = []
+        batch_size = 0
+        popleft = self._records.popleft
+        try:
+            while batch_size < max_size:
+                d = popleft()
+                batch.append(d)
+                batch_size += len(d[1])
+        except IndexError:
+            pass
+        return batch
+
+
+class ActuatorProtocol(asyncio.DatagramProtocol):
+    def __init__(self, bridge):
+        self.bridge = bridge
+
+    def datagram_received(self, data, addr):
+        self.bridge.actuate(data, time.perf_counter_ns())
+
+
+class AsyncBridge(object):
+    """Bridge engine for a single rig on an asyncio event loop.
+
+    Serial data is read when the serial port file descriptor is readable,
+    sensor samples are sent and actuator commands received with datagram
+    endpoints, and logging runs as a task that writes the log file in a log
+    writer thread, so file writes do not block the loop. If the serial port
+    does not provide a file descriptor, it is polled every SERIAL_POLL_PERIOD
+    seconds.
+    Several bridges can be served from the same event loop with
+    run_bridges(), each with its own log queue and log file. If a
+    sensor_filter.SensorFilter is given, the filtered samples are sent.
+    """
+    def __init__(self, serial_port, tx_addr, rx_addr, log_file, start_time,
+                 latency=None, latency_period=LATENCY_REPORT_PERIOD,
+                 torque_rate=None, payload_floats=SERIAL_PAYLOAD_FLOATS,
+                 log_queue=None, name=None, sensor_filter=None):
+        self.ser = serial_port
+        self.tx_addr = tx_addr
+        self.rx_addr = rx_addr
+        self.log_file = log_file
+        self.start_time = start_time
+        self.latency = latency
+        self.latency_period = latency_period
+        self.log_queue = log_queue
+        self.name = name
+        self.receiver = Receiver(serial_port, payload_floats, sensor_filter)
+        self.writer = AsyncActuatorWriter(serial_port, torque_rate, latency)
+        self.sample = None
+        self.torque = None
+        self._tx = None
+        self._stop = None
+        self._log_event = None
+        self._log_executor = None # log writer thread
+        self._log_lock = threading.Lock()
+        self._poll_handle = None
+
+    def run(self):
+        """Run the bridge until interrupted."""
+        run_bridges([self], self.latency_period)
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop.set()
+
+    def wake_log(self):
+        """Wake the log task to write queued records."""
+        self._log_event.set()
+
+    def flush_log(self):
+        """Write all queued log records."""
+        log_queue = self._log_queue()
+        with self._log_lock:
+            batch = log_queue.get_batch()
+            while batch:
+                self.log_file.write(batch)
+                batch = log_queue.get_batch()
+
+    def actuate(self, data, received_ns):
+        torque = receive_state(data, received_ns, self.writer, self.start_time,
+                               self.log_queue)
+        if torque is not None:
+            self.torque = torque
+
+    async def serve(self):
+        """Serve the rig until stop() is called or the serial port is
+        closed.
+        """
+        loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        self._log_event = asyncio.Event()
+        self._tx, _ = await loop.create_datagram_endpoint(
+            asyncio.DatagramProtocol, remote_addr=self.tx_addr)
+        rx, _ = await loop.create_datagram_endpoint(
+            lambda: ActuatorProtocol(self), local_addr=self.rx_addr)
+        self.writer.start(loop)
+        self._log_executor = concurrent.futures.ThreadPoolExecutor(
+            1, thread_name_prefix='log writer')
+        log_task = loop.create_task(self._log_task())
+        self._watch_serial(loop)
+        try:
+            await self._stop.wait()
+        finally:
+            self._unwatch_serial(loop)
+            rx.close() # stop actuator command transmission
+            self.writer.stop()
+            try:
+                serial_write(self.ser, encode_torque(0)) # send 0 torque
+            except (OSError, serial.SerialException) as e:
+                print('{}: zero torque not sent: {}'.format(
+                    self.name or self.ser.port, e))
+            self.ser.close()
+            self._tx.close()
+            log_task.cancel()
+            await asyncio.gather(log_task, return_exceptions=True)
+            self._log_executor.shutdown()
+
+    def _log_queue(self):
+        return g_log_queue if self.log_queue is None else self.log_queue
+
+    def _watch_serial(self, loop):
+        try:
+            fd = self.ser.fileno()
+        except (AttributeError, NotImplementedError):
+            self._poll_serial(loop)
+            return
+        loop.add_reader(fd, self._serial_ready)
+
+    def _unwatch_serial(self, loop):
+        if self._poll_handle is not None:
+            self._poll_handle.cancel()
+        else:
+            loop.remove_reader(self.ser.fileno())
+
+    def _poll_serial(self, loop):
+        self._serial_ready()
+        self._poll_handle = loop.call_later(SERIAL_POLL_PERIOD,
+                                            self._poll_serial, loop)
+
+    def _serial_ready(self):
+        try:
+            self.receiver.receive()
+        except OSError: # serial port closed
+            self.stop()
+            return
+        q = self.receiver.sample_q
+        while q:
+            sample, output, read_ns, decoded_ns = q.popleft()
+            if output is not None:
+                self.sample = output
+                self._tx.sendto(encode_sensor(output))
+                if self.latency is not None:
+                    self.latency.sensor(read_ns, decoded_ns,
+                                        time.perf_counter_ns())
+            log_sensor(time.time() - self.start_time, sample, self.log_queue)
+
+    async def _log_task(self):
+        loop = asyncio.get_running_loop()
+        def in_writer(func):
+            return loop.run_in_executor(self._log_executor, func)
+        await in_writer(self.log_file.open)
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._log_event.wait(),
+                                           LOG_FLUSH_PERIOD)
+                except asyncio.TimeoutError:
+                    pass
+                self._log_event.clear()
+                await in_writer(self.flush_log)
+        finally:
+            await in_writer(self._close_log)
+
+    def _close_log(self):
+        self.flush_log()
+        self.log_file.close()
+
+
+def run_bridges(bridges, latency_period=LATENCY_REPORT_PERIOD):
+    """Serve AsyncBridge objects from a single event loop until interrupted
+    or until all serial ports are closed.
+    """
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(ASYNC_SWITCH_INTERVAL)
+    try:
+        asyncio.run(_serve_bridges(bridges, latency_period))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sys.setswitchinterval(switch_interval)
+
+async def _serve_bridges(bridges, latency_period):
+    loop = asyncio.get_running_loop()
+    def stop():
+        print('Shutting down...')
+        for b in bridges:
+            b.stop()
+    try:
+        loop.add_signal_handler(signal.SIGINT, stop)
+    except NotImplementedError:
+        pass # signal handlers are not available on Windows
+
+    tasks = [loop.create_task(_print_task(bridges))]
+    if any(b.latency is not None for b in bridges):
+        tasks.append(loop.create_task(_latency_task(bridges, latency_period)))
+    try:
+        # a bridge that fails only stops its own rig
+        results = await asyncio.gather(*(b.serve() for b in bridges),
+                                       return_exceptions=True)
+        for b, r in zip(bridges, results):
+            if isinstance(r, Exception):
+                print('{}: stopped with error: {!r}'.format(
+                    b.name or b.ser.port, r))
+    finally:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for b in bridges:
+            if b.latency is not None:
+                print_latency(b.latency, b.name)
+
+async def _print_task(bridges):
+    """Print the states of the bridges. Output is written by a thread of
+    the default executor, so a slow terminal does not block the loop.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(PRINT_LOOP_PERIOD)
+        lines = []
+        for b in bridges:
+            line = format_states(time.time() - b.start_time, b.torque,
+                                 b.sample)
+            if b.name is not None:
+                line = '{}\t{}'.format(b.name, line)
+            lines.append(line)
+        await loop.run_in_executor(None, print, '\n'.join(lines))
+
+async def _latency_task(bridges, latency_period):
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(latency_period)
+        for b in bridges:
+            if b.latency is not None:
+                await loop.run_in_executor(None, print_latency, b.latency,
+                                           b.name)
+
+
+def format_states(t, torque, sample):
+    ff = '{{{}}}'.format(DEFAULT_FLOAT_FORMAT)
+    if torque is not None:
+        act = [ff.format(torque)]
+    else:
+        act = [' - ']
+
+    if sample is not None:
+        sen = sample.ff_list()
+    else:
+        sen = Sample.size() * [' - ']
+    return '\t'.join([ff.format(t)] + act + sen)
+
+
+def print_latency(latency, name=None):
+    if name is None:
+        print('loop latency (ms):')
+    else:
+        print('{} loop latency (ms):'.format(name))
+    print(latency.report())
+
+
+def print_summary(writer, log_queue, receiver, name=None):
+    decoder = receiver.decoder
+    lines = [writer.summary()]
+    if log_queue.dropped:
+        lines.append('{} log records dropped'.format(log_queue.dropped))
+    lines.append('{} sensor frames decoded, {} rejected, {} bytes '
+                 'discarded'.format(decoder.frames, decoder.rejected,
+                                    decoder.discarded))
+    if receiver.sensor_filter is not None:
+        lines.append(receiver.sensor_filter.summary())
+    for line in lines:
+        print(line if name is None else '{}: {}'.format(name, line))
+
+
+def load_rigs(path, args):
+    """Read a JSON list of rig configurations. Each rig is an object with
+    the keys port, subject, feedback, udp_txport and udp_rxport, and
+    optionally name, baudrate, udp_host, torque_rate, payload_floats,
+    log_dir and the sensor filter keys filter, filter_order, filter_cutoff,
+    sample_rate and decimation. Missing optional values are taken from the
+    command line arguments. Logs are written to log_dir, which defaults to
+    the rig name.
+    """
+    with open(path) as f:
+        configs = json.load(f)
+    if not isinstance(configs, list) or not configs:
+        raise ValueError('{}: expected a list of rig configurations'.format(
+            path))
+    rigs = []
+    for i, config in enumerate(configs):
+        rig = {'name': 'rig{}'.format(i),
+               'baudrate': args.baudrate,
+               'udp_host': args.udp_host,
+               'torque_rate': args.torque_rate,
+               'payload_floats': args.payload_floats,
+               'log_dir': None,
+               'filter': args.filter,
+               'filter_order': args.filter_order,
+               'filter_cutoff': args.filter_cutoff,
+               'sample_rate': args.sample_rate,
+               'decimation': args.decimation}
+        unknown = set(config) - set(RIG_KEYS)
+        if unknown:
+            msg = '{}: unknown key(s) {} in rig {}'
+            raise ValueError(msg.format(path, ', '.join(sorted(unknown)), i))
+        missing = set(RIG_REQUIRED_KEYS) - set(config)
+        if missing:
+            msg = '{}: missing key(s) {} in rig {}'
+            raise ValueError(msg.format(path, ', '.join(sorted(missing)), i))
+        rig.update(config)
+        if rig['log_dir'] is None:
+            rig['log_dir'] = rig['name']
+        try:
+            create_filter(rig)
+        except ValueError as e:
+            raise ValueError('{}: {} in rig {}'.format(path, e, i))
+        rigs.append(rig)
+
+    for key in ('name', 'port', 'udp_rxport', 'log_dir'):
+        values = [r[key] for r in rigs]
+        if len(set(values)) != len(values):
+            raise ValueError('{}: rigs must have distinct {}s'.format(path,
+                                                                      key))
+    return rigs
+
+
+def create_filter(config):
+    """Return a sensor_filter.SensorFilter for a rig configuration or the
+    command line arguments as a dict, or None if filter is None. Raises
+    ValueError for an invalid filter. sensor_filter, which needs SciPy and
+    the filter generator, is only imported if a filter is used.
+    """
+    if config['filter'] is None:
+        if config['decimation'] != 1:
+            raise ValueError('decimation requires a filter')
+        return None
+    if config['filter'] not in FILTER_TYPES:
+        raise ValueError('unknown filter {}'.format(config['filter']))
+    if config['filter_cutoff'] is None:
+        raise ValueError('filter requires a filter cutoff')
+    import sensor_filter
+    return sensor_filter.SensorFilter.lowpass(
+        config['filter'], config['filter_order'], config['filter_cutoff'],
+        config['sample_rate'], config['decimation'])
+
+
+def filter_description(config):
+    msg = '{} order {} lowpass at {} Hz, {} Hz samples decimated by {}'
+    return msg.format(
+        config['filter'], config['filter_order'], config['filter_cutoff'],
+        config['sample_rate'], config['decimation'])
+
+
+def run_rigs(rigs, args):
+    """Serve several rigs from a single event loop, each with its own
+    serial port, datagram endpoints, log queue, log file and statistics.
+    If a serial port can not be opened, the ports already opened are closed.
+    """
+    ports = []
+    try:
+        for rig in rigs:
+            ports.append(serial.Serial(rig['port'], rig['baudrate'],
+                                       timeout=0,
+                                       writeTimeout=SERIAL_WRITE_TIMEOUT))
+    except Exception:
+        for ser in ports:
+            ser.close()
+        raise
+
+    t0 = time.time()
+    bridges = []
+    for rig, ser in zip(rigs, ports):
+        log_file = LogFile(rig['subject'], rig['feedback'],
+                           args.log_rotate_size, args.log_rotate_period,
+                           rig['log_dir'])
+        monitor = latency.LatencyMonitor() if args.latency else None
+        bridge = AsyncBridge(ser, (rig['udp_host'], rig['udp_txport']),
+                             (rig['udp_host'], rig['udp_rxport']), log_file,
+                             t0, monitor, args.latency_period,
+                             rig['torque_rate'], rig['payload_floats'],
+                             name=rig['name'],
+                             sensor_filter=create_filter(rig))
+        bridge.log_queue = AsyncLogQueue(args.log_queue_size, args.log_policy,
+                                         bridge.flush_log, bridge.wake_log)
+        bridges.append(bridge)
+        print('{}: serial port {} at {} baud, transmitting UDP data on port '
+              '{}, receiving UDP data on port {}'.format(
+                  rig['name'], rig['port'], rig['baudrate'],
+                  rig['udp_txport'], rig['udp_rxport']))
+        if rig['filter'] is not None:
+            print('{}: filtering sensor data with a {}'.format(
+                rig['name'], filter_description(rig)))
+
+    run_bridges(bridges, args.latency_period)
+    for b in bridges:
+        print_summary(b.writer, b.log_queue, b.receiver, b.name)
+
+
 def serial_write(ser, msg):
     """Windows will throw a SerialException with the message:
     WindowsError(0, 'The operation completed successfully')
@@ -265,11 +1172,11 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=
         'Convert serial data in CSV format to XML and send via UDP and '
         'vice versa.')
-    parser.add_argument('port',
+    parser.add_argument('port', nargs='?',
         help='serial port for communication with arduino')
-    parser.add_argument('subject',
+    parser.add_argument('subject', nargs='?',
         help='note numerical code for test subject in log filename')
-    parser.add_argument('feedback',
+    parser.add_argument('feedback', nargs='?',
         help='note if torque feedback is enabled in log filename')
     parser.add_argument('-b', '--baudrate',
         help='serial port baudrate ({})'.format(DEFAULT_BAUDRATE),
@@ -283,8 +1190,115 @@ if __name__ == "__main__":
     parser.add_argument('-p', '--udp_rxport',
         help='udp rx port ({})'.format(DEFAULT_UDPRXPORT),
         default=DEFAULT_UDPRXPORT, type=int)
+    parser.add_argument('--log_queue_size',
+        help='max number of queued log records ({})'.format(LOG_QUEUE_SIZE),
+        default=LOG_QUEUE_SIZE, type=int)
+    parser.add_argument('--log_policy',
+        help='action when the log queue is full ({})'.format(LOG_POLICY_DROP),
+        choices=(LOG_POLICY_DROP, LOG_POLICY_BLOCK), default=LOG_POLICY_DROP)
+    parser.add_argument('--log_rotate_size',
+        help='start a new log file after this many bytes (no rotation)',
+        default=None, type=int)
+    parser.add_argument('--log_rotate_period',
+        help='start a new log file after this many seconds (no rotation)',
+        default=None, type=float)
+    parser.add_argument('--engine',
+        help='bridge engine ({})'.format(ENGINE_THREADS),
+        choices=(ENGINE_THREADS, ENGINE_ASYNCIO), default=ENGINE_THREADS)
+    parser.add_argument('--latency',
+        help='measure and report loop latency',
+        action='store_true')
+    parser.add_argument('--latency_period',
+        help='latency report period in seconds ({})'.format(
+            LATENCY_REPORT_PERIOD),
+        default=LATENCY_REPORT_PERIOD, type=float)
+    parser.add_argument('--torque_rate',
+        help='write the newest torque command at this rate in Hz '
+             '(write on change)',
+        default=None, type=float)
+    parser.add_argument('--payload_floats',
+        help='number of floats in a serial sample ({})'.format(
+            SERIAL_PAYLOAD_FLOATS),
+        default=SERIAL_PAYLOAD_FLOATS, type=int)
+    parser.add_argument('--filter',
+        help='lowpass filter the steer angle and rate of sensor samples '
+             'with the sos filter of generate_filter_coeffcients.py (no '
+             'filter)',
+        choices=FILTER_TYPES, default=None)
+    parser.add_argument('--filter_order',
+        help='sensor filter order ({})'.format(DEFAULT_FILTER_ORDER),
+        default=DEFAULT_FILTER_ORDER, type=int)
+    parser.add_argument('--filter_cutoff',
+        help='sensor filter cutoff frequency in Hz, required with --filter',
+        default=None, type=float)
+    parser.add_argument('--sample_rate',
+        help='serial sensor sample rate in Hz ({})'.format(
+            DEFAULT_SAMPLE_RATE),
+        default=DEFAULT_SAMPLE_RATE, type=float)
+    parser.add_argument('--decimation',
+        help='send every n-th filtered sample, the UDP sensor rate is the '
+             'sample rate divided by n (1)',
+        default=1, type=int)
+    parser.add_argument('--rigs',
+        help='JSON file with a list of rig configurations to serve from a '
+             'single asyncio event loop, instead of port, subject and '
+             'feedback',
+        default=None)
     args = parser.parse_args()
 
+    if args.rigs is not None:
+        try:
+            rigs = load_rigs(args.rigs, args)
+        except (OSError, ValueError) as e:
+            parser.error(e)
+    elif args.feedback is None:
+        parser.error('port, subject and feedback are required without --rigs')
+    else:
+        rigs = [{'payload_floats': args.payload_floats}]
+
+    for payload_floats in sorted(set(r['payload_floats'] for r in rigs)):
+        try:
+            protocol.check_sample_header(protocol.sensor_frame(payload_floats))
+        except (OSError, ValueError) as e:
+            print('Warning: {}'.format(e))
+
+    if args.rigs is not None:
+        run_rigs(rigs, args)
+        sys.exit(0)
+
+    try:
+        create_filter(vars(args))
+    except ValueError as e:
+        parser.error(e)
+    if args.filter is not None:
+        print('filtering sensor data with a {}'.format(
+            filter_description(vars(args))))
+
+    monitor = latency.LatencyMonitor() if args.latency else None
+
+    if args.engine == ENGINE_ASYNCIO:
+        ser = serial.Serial(args.port, args.baudrate, timeout=0,
+                            writeTimeout=SERIAL_WRITE_TIMEOUT)
+        t0 = time.time()
+        log_file = LogFile(args.subject, args.feedback,
+                           args.log_rotate_size, args.log_rotate_period)
+        bridge = AsyncBridge(ser, (args.udp_host, args.udp_txport),
+                             (args.udp_host, args.udp_rxport), log_file, t0,
+                             monitor, args.latency_period, args.torque_rate,
+                             args.payload_floats,
+                             sensor_filter=create_filter(vars(args)))
+        g_log_queue = AsyncLogQueue(args.log_queue_size, args.log_policy,
+                                    bridge.flush_log, bridge.wake_log)
+        print('{} using serial port {} at {} baud'.format(
+            __file__, args.port, args.baudrate))
+        print('transmitting UDP data on port {}'.format(args.udp_txport))
+        print('receiving UDP data on port {}'.format(args.udp_rxport))
+        bridge.run()
+        print_summary(bridge.writer, g_log_queue, bridge.receiver)
+        sys.exit(0)
+
+    g_log_queue = LogQueue(args.log_queue_size, args.log_policy)
+
     ser = serial.Serial(args.port, args.baudrate,
                         writeTimeout=SERIAL_WRITE_TIMEOUT)
     udp_tx_addr = (args.udp_host, args.udp_txport)
@@ -292,52 +1306,59 @@ if __name__ == "__main__":
     udp_tx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
     t0 = time.time()
-    actuator = UdpServer(udp_rx_addr, UdpHandler, ser, t0)
-    actuator_thread = threading.Thread(target=actuator.serve_forever)
-    actuator_thread.daemon = True
+    writer = ActuatorWriter(ser, args.torque_rate, monitor)
+    actuator = ActuatorListener(udp_rx_addr, writer, t0)
 
-    sensor = SensorListener(ser, udp_tx, udp_tx_addr, t0)
+    sensor = SensorListener(ser, udp_tx, udp_tx_addr, t0, monitor,
+                            args.payload_floats, create_filter(vars(args)))
 
-    log = Logger(args.subject, args.feedback)
+    log = Logger(args.subject, args.feedback,
+                 args.log_rotate_size, args.log_rotate_period)
 
+    log.start()
     sensor.start()
-    actuator_thread.start()
+    writer.start()
+    actuator.start()
 
     print('{} using serial port {} at {} baud'.format(
         __file__, args.port, args.baudrate))
     print('transmitting UDP data on port {}'.format(args.udp_txport))
     print('receiving UDP data on port {}'.format(args.udp_rxport))
 
-    def print_states(start_time):
-        t = time.time() - t0
-        if actuator.torque is not None:
-            act = ['{{{}}}'.format(DEFAULT_FLOAT_FORMAT).format(actuator.torque)]
-        else:
-            act = [' - ']
-
-        if sensor.sample is not None:
-            sen = sensor.sample.ff_list()
-        else:
-            sen = Sample.size() * [' - ']
-        print('\t'.join(['{{{}}}'.format(DEFAULT_FLOAT_FORMAT).format(t)] +
-                        act + sen))
-
     try:
+        latency_time = time.time()
         while True:
             time.sleep(PRINT_LOOP_PERIOD)
-            print_states(t0)
+            print(format_states(time.time() - t0,
+                                actuator.torque, sensor.sample))
+            if (monitor is not None and
+                time.time() - latency_time >= args.latency_period):
+                print_latency(monitor)
+                latency_time = time.time()
     except KeyboardInterrupt:
         print('Shutting down...')
     finally:
-       actuator.shutdown() # stop UdpServer, actuator command transmission
+       actuator.stop() # stop actuator command reception
+       actuator.join() # wait for actuator thread to terminate
+       writer.stop() # stop actuator command transmission
+       writer.join() # wait for actuator writer thread to terminate
        serial_write(ser, encode_torque(0)) # send 0 value actuator torque
-       ser.close() # close serial port, terminating sensor thread
-       log.start() # log all data
-       log.terminate() # request logging thread terminate
+       sensor.stop() # stop sensor data transmission
+       sensor.join() # wait for sensor thread to terminate
+       ser.close() # close serial port
+       print(writer.summary())
+       if monitor is not None:
+           print_latency(monitor)
 
-       # wait for other threads to terminate
+       log.terminate() # request logging thread terminate
        log.join() # wait for logging to complete
-       sensor.join() # wait for sensor thread to terminate
-       actuator_thread.join() # wait for actuator thread to terminate
+       if g_log_queue.dropped:
+           print('{} log records dropped'.format(g_log_queue.dropped))
+
+       decoder = sensor.receiver.decoder
+       print('{} sensor frames decoded, {} rejected, {} bytes discarded'.format(
+           decoder.frames, decoder.rejected, decoder.discarded))
+       if sensor.receiver.sensor_filter is not None:
+           print(sensor.receiver.sensor_filter.summary())
 
        sys.exit(0)
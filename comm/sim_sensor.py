@@ -8,14 +8,13 @@ A virtual serial port can be created using socat with:
 import argparse
 import math
 import serial
-import struct
 import sys
 import time
 
+import protocol
+
 
 DEFAULT_BAUDRATE = 115200
-SERIAL_START_CHAR = b's'
-SERIAL_END_CHAR = b'e'
 SEND_RATE = 50 # Hz
 
 if __name__ == "__main__":
@@ -36,8 +35,7 @@ if __name__ == "__main__":
             dt = time.time() - t0
             delta = 2*math.sin(3*dt)
             deltad = 2*math.cos(4*dt)
-            packet = struct.pack('=cffc', SERIAL_START_CHAR, delta,
-                                 deltad, SERIAL_END_CHAR)
+            packet = protocol.SENSOR_FRAME.pack(delta, deltad)
             ser.write(packet)
     except KeyboardInterrupt:
         pass
@@ -9,8 +9,6 @@ import time
 
 import send_udp
 
-SERIAL_START_CHAR = b's'
-SERIAL_END_CHAR = b'e'
 TRANSMISSION_FREQ = 50 # Hz
 UDP_PORT = 9900
 WHEEL_RADIUS = 0.3 # m
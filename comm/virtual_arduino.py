@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Emulate the BsgBikeSim2014 Arduino on a pseudo terminal.
+
+Sensor samples are sent as 's' + floats + 'e' frames at a configurable rate,
+limited by the byte rate of the emulated serial link, and torque frames
+written by the bridge are decoded and echoed with a timestamp. Faults can be
+injected to exercise the bridge frame decoder. Run the bridge with the port
+printed on startup:
+    $ ./virtual_arduino.py -r 1000
+    $ ./serial_udp_bridge.py /dev/pts/N 000 0
+"""
+import argparse
+import collections
+import math
+import os
+import random
+import select
+import sys
+import time
+import tty
+
+import protocol
+from serial_udp_bridge import FrameDecoder
+
+
+DEFAULT_BAUDRATE = 2000000
+DEFAULT_SAMPLE_RATE = 100 # Hz
+DEFAULT_NUM_FLOATS = 2 # delta, deltad
+BITS_PER_BYTE = 10 # 8N1, start + 8 data + stop bits
+READ_SIZE = 4096 # bytes, max torque data read at once
+
+
+class VirtualArduino(object):
+    """Sensor sample source and torque sink on the master side of a pty.
+
+    Faults:
+    truncate: probability a frame is cut short
+    stray: probability a stray end character is sent before a frame
+    burst_period: period in seconds at which transmission stalls for
+                  burst_length samples, with the stalled samples sent at
+                  once afterwards
+    """
+    def __init__(self, rate=DEFAULT_SAMPLE_RATE, num_floats=DEFAULT_NUM_FLOATS,
+                 baudrate=DEFAULT_BAUDRATE, truncate=0, stray=0,
+                 burst_period=None, burst_length=0, seed=None,
+                 on_torque=None):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.port = os.ttyname(self.slave)
+
+        self.frame = protocol.sensor_frame(num_floats)
+        self.num_floats = num_floats
+        self.byte_rate = baudrate/BITS_PER_BYTE
+        self.max_rate = self.byte_rate/self.frame.size
+        self.rate = min(rate, self.max_rate)
+        self.truncate = truncate
+        self.stray = stray
+        self.burst_period = burst_period
+        self.burst_length = burst_length
+        self.on_torque = on_torque
+        self._random = random.Random(seed)
+        self._decoder = FrameDecoder(protocol.TORQUE_FRAME)
+        self._pending = bytearray()
+
+        self.samples = 0
+        self.bytes_sent = 0
+        self.overruns = 0 # bytes not written as the pty buffer was full
+        self.faults = collections.Counter()
+
+    @property
+    def torques(self):
+        return self._decoder.frames
+
+    def sample(self, n, t):
+        """Return the float values of sample n at time t (seconds)."""
+        w = 2*math.pi*0.5
+        values = [0.1*math.sin(w*t), 0.1*w*math.cos(w*t)]
+        return values[:self.num_floats] + (self.num_floats - 2)*[0.0]
+
+    def run(self, duration=None):
+        """Send samples and receive torques until duration (seconds) has
+        elapsed or until interrupted.
+        """
+        start = time.perf_counter()
+        burst_start = start
+        first = self.samples
+        sent = self.bytes_sent
+        while duration is None or time.perf_counter() - start < duration:
+            now = time.perf_counter()
+            t = now - start
+            n = int(t*self.rate) + 1 - (self.samples - first)
+            for _ in range(n):
+                self._put_sample(self.samples/self.rate)
+
+            stalled = False
+            if self.burst_period is not None:
+                if now - burst_start >= self.burst_period:
+                    burst_start = now
+                stalled = (now - burst_start)*self.rate < self.burst_length
+                if stalled and n > 0:
+                    self.faults['burst'] += n
+            if not stalled:
+                self._send(t, sent)
+
+            timeout = max(0, (self.samples - first)/self.rate - (now - start))
+            readable, _, _ = select.select([self.master], [], [], timeout)
+            if readable:
+                self._receive()
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+    def _put_sample(self, t):
+        frame = self.frame.pack(*self.sample(self.samples, t))
+        self.samples += 1
+        if self.stray and self._random.random() < self.stray:
+            self._pending += protocol.END_CHAR
+            self.faults['stray'] += 1
+        if self.truncate and self._random.random() < self.truncate:
+            frame = frame[:self._random.randrange(1, len(frame))]
+            self.faults['truncate'] += 1
+        self._pending += frame
+
+    def _send(self, t, sent):
+        # limit the number of bytes to the emulated link byte rate
+        budget = int(t*self.byte_rate) - (self.bytes_sent - sent)
+        if budget <= 0 or not self._pending:
+            return
+        try:
+            n = os.write(self.master, self._pending[:budget])
+        except BlockingIOError:
+            n = 0
+        self.bytes_sent += n
+        del self._pending[:n]
+        if len(self._pending) > self.byte_rate:
+            # more than a second of data queued, the bridge is not reading
+            self.overruns += len(self._pending)
+            del self._pending[:]
+
+    def _receive(self):
+        try:
+            data = os.read(self.master, READ_SIZE)
+        except (BlockingIOError, OSError):
+            return
+        t_ns = time.perf_counter_ns()
+        for torque, in self._decoder.feed(data):
+            if self.on_torque is not None:
+                self.on_torque(t_ns, torque)
+
+
+def print_torque(t_ns, torque):
+    print('{:.6f}\t{: .4f}'.format(t_ns/1e9, torque))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=
+        'Emulate the BsgBikeSim2014 Arduino on a pseudo terminal.')
+    parser.add_argument('-r', '--rate',
+        help='sample rate in Hz ({})'.format(DEFAULT_SAMPLE_RATE),
+        default=DEFAULT_SAMPLE_RATE, type=float)
+    parser.add_argument('-n', '--num_floats',
+        help='number of floats per sample ({})'.format(DEFAULT_NUM_FLOATS),
+        default=DEFAULT_NUM_FLOATS, type=int)
+    parser.add_argument('-b', '--baudrate',
+        help='emulated serial baudrate ({})'.format(DEFAULT_BAUDRATE),
+        default=DEFAULT_BAUDRATE, type=int)
+    parser.add_argument('-d', '--duration',
+        help='run time in seconds (run until interrupted)',
+        default=None, type=float)
+    parser.add_argument('--truncate',
+        help='probability a frame is truncated (0)',
+        default=0, type=float)
+    parser.add_argument('--stray',
+        help='probability of a stray end character before a frame (0)',
+        default=0, type=float)
+    parser.add_argument('--burst_period',
+        help='period in seconds of transmission stalls (no stalls)',
+        default=None, type=float)
+    parser.add_argument('--burst_length',
+        help='number of samples sent in a burst after a stall (0)',
+        default=0, type=int)
+    parser.add_argument('--seed',
+        help='random seed for fault injection',
+        default=None, type=int)
+    parser.add_argument('-q', '--quiet',
+        help='do not echo received torques',
+        action='store_true')
+    args = parser.parse_args()
+
+    arduino = VirtualArduino(args.rate, args.num_floats, args.baudrate,
+                             args.truncate, args.stray, args.burst_period,
+                             args.burst_length, args.seed,
+                             None if args.quiet else print_torque)
+    if arduino.rate < args.rate:
+        print('sample rate limited to {:.1f} Hz by {} baud link'.format(
+            arduino.rate, args.baudrate))
+    print('emulating arduino on {} at {:.1f} Hz'.format(arduino.port,
+                                                        arduino.rate))
+    sys.stdout.flush()
+    try:
+        arduino.run(args.duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        arduino.close()
+    print('{} samples sent, {} torques received, {} bytes overrun'.format(
+        arduino.samples, arduino.torques, arduino.overruns))
+    if arduino.faults:
+        print('faults injected: {}'.format(', '.join(
+            '{} {}'.format(v, k) for k, v in sorted(arduino.faults.items()))))
+    sys.exit(0)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Linearized benchmark bicycle model (Meijaard et al. 2007) as used by the
+Unity3d bicycle simulator.
+
+The state is [leanrate, steerrate, lean, steer] and the input is the steer
+torque. The model is discretized exactly for a zero-order hold input.
+"""
+import numpy as np
+from numpy import linalg as la
+from scipy import linalg as sla
+
+
+STATES = ['leanrate', 'steerrate', 'lean', 'steer']
+G = 9.81
+REAR_RADIUS = 0.3 # benchmark bicycle rear wheel radius
+STEER_AXIS_TILT = np.pi/10
+TRAIL = 0.08
+WHEELBASE = 1.02
+M = np.array([
+    [80.81722, 2.31941332208709],
+    [2.31941332208709, 0.29784188199686]
+])
+C1 = np.array([
+    [0, 33.86641391492494],
+    [-0.85035641456978, 1.68540397397560]
+])
+K0 = np.array([
+    [-80.95, -2.59951685249872],
+    [-2.59951685249872, -0.80329488458618]
+])
+K2 = np.array([
+    [0, 76.59734589573222],
+    [0, 2.65431523794604]
+])
+
+
+def speed(wheelrate):
+    """Return the forward speed for a rear wheel rate in rad/s."""
+    return -wheelrate*REAR_RADIUS
+
+
+def damping(v):
+    return v*C1
+
+
+def stiffness(v, g=G):
+    return g*K0 + v*v*K2
+
+
+def state_matrices(v, g=G):
+    """Return the state and input matrices A (4x4) and B (4x1) at speed v."""
+    A = np.vstack((la.solve(-M, np.hstack((damping(v), stiffness(v, g)))),
+                   np.hstack((np.eye(2), np.zeros((2, 2))))))
+    B = np.vstack((la.solve(M, np.array([[0], [1]])),
+                   np.array([[0], [0]])))
+    return A, B
+
+
+def discretize(A, B, h):
+    """Return the zero-order hold discretization Phi, Gamma of x' = Ax + Bu
+    for time step h, so that x[k + 1] = Phi x[k] + Gamma u[k].
+    """
+    n, m = B.shape
+    F = np.zeros((n + m, n + m))
+    F[:n, :n] = A
+    F[:n, n:] = B
+    E = sla.expm(F*h)
+    return E[:n, :n], E[:n, n:]
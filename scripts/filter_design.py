@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Evaluate lowpass filter designs for the steer angle and steer rate on
+recorded logs.
+
+The sensor fields FIELDS are loaded from logs with parse_data and every
+design of a filter family (butter, cheby1, cheby2), order and cutoff is run
+over each log with sosfilt in second-order sections. A design is scored by
+ - its residual noise, the RMS of the filtered signal above the noise
+   frequency relative to that of the unfiltered signal, the max over FIELDS
+ - its delay, the max group delay in the loop band up to the loop frequency
+Filtering delay adds to the latency of the haptic loop, so the winner is the
+design with the least delay among those with a residual noise of at most
+max_noise. Designs are evaluated in a pool of processes, the designs on the
+Pareto front of delay and noise are printed and the sources of the winner
+can be generated with generate_filter_coeffcients.py, by default as
+second-order sections as they were scored:
+    $ ./filter_design.py ../logs/log_*
+    $ ./filter_design.py --max_noise 0.05 --generate ../logs/log_*
+    $ ./filter_design.py --generate --mode q15 ../logs/log_*
+
+Designs are evaluated at the sample rate of the logs, which must be that of
+the generated filter.
+"""
+import argparse
+import collections
+import functools
+import os
+import sys
+from concurrent import futures
+
+import numpy as np
+from scipy import signal
+
+import generate_filter_coeffcients as gfc
+import parse_data
+
+
+FIELDS = ('delta', 'deltad')
+FAMILIES = ('butter', 'cheby1', 'cheby2')
+DEFAULT_MAX_ORDER = 6
+DEFAULT_NUM_CUTOFFS = 16 # cutoffs from the loop frequency to MAX_CUTOFF
+MAX_CUTOFF = 0.9 # fraction of the Nyquist frequency
+DEFAULT_LOOP_FREQ = 5.0 # Hz, upper frequency of the haptic loop band
+DEFAULT_NOISE_FREQ = 10.0 # Hz, lower frequency of the noise band
+DEFAULT_MAX_NOISE = 0.1 # max residual noise RMS relative to unfiltered
+SAMPLE_RATE_TOLERANCE = 0.01 # max relative sample rate difference of logs
+WELCH_SEGMENT = 256 # samples per PSD segment
+GROUP_DELAY_POINTS = 64 # frequencies in the loop band
+DESIGNS_PER_TASK = 8 # designs per process pool task
+DEFAULT_MODE = 'sos' # output mode of generated sources
+
+Design = collections.namedtuple('Design', 'family order cutoff')
+
+
+def load_signals(paths, fields=FIELDS):
+    """Return the sample rate and a list with an array (samples, fields) of
+    the sensor fields of each log. Raises ValueError if a log has fewer than
+    2 samples or if the sample rates of the logs differ.
+    """
+    rates = []
+    signals = []
+    for path in paths:
+        sensor, _ = parse_data.parse_log(path)
+        if sensor.shape[0] < 2:
+            raise ValueError('{}: no sensor data'.format(path))
+        rates.append(1/np.median(np.diff(sensor.time.astype(np.float64))))
+        signals.append(np.column_stack([sensor.get_field(f)
+                                        for f in fields]).astype(np.float64))
+    if not signals:
+        raise ValueError('no logs')
+    fs = float(np.median(rates))
+    for path, rate in zip(paths, rates):
+        if abs(rate - fs) > SAMPLE_RATE_TOLERANCE*fs:
+            raise ValueError('{}: sample rate {:.2f} Hz differs from {:.2f} '
+                             'Hz'.format(path, rate, fs))
+    return fs, signals
+
+
+def designs(fs, max_order=DEFAULT_MAX_ORDER, num_cutoffs=DEFAULT_NUM_CUTOFFS,
+            loop_freq=DEFAULT_LOOP_FREQ):
+    """Return the designs of all families, orders up to max_order and
+    num_cutoffs cutoffs spaced geometrically from the loop frequency to
+    MAX_CUTOFF times the Nyquist frequency.
+    """
+    cutoffs = np.geomspace(loop_freq, MAX_CUTOFF*fs/2, num_cutoffs)
+    return [Design(family, order, float(cutoff)) for family in FAMILIES
+            for order in range(1, max_order + 1) for cutoff in cutoffs]
+
+
+def design_sos(design, fs):
+    return gfc.lowpass_coeffs(gfc.FILTER_TYPES[design.family], design.cutoff,
+                              fs, design.order, output='sos')
+
+
+def noise_power(x, fs, noise_freq=DEFAULT_NOISE_FREQ):
+    """Return the power of each column of x (samples, columns) above the
+    noise frequency.
+    """
+    f, pxx = signal.welch(x, fs, nperseg=min(WELCH_SEGMENT, len(x)), axis=0)
+    return pxx[f >= noise_freq].sum(axis=0)*(f[1] - f[0])
+
+
+def group_delay(sos, fs, loop_freq=DEFAULT_LOOP_FREQ):
+    """Return the max group delay in s of second-order sections in the loop
+    band.
+    """
+    w = np.linspace(0, loop_freq, GROUP_DELAY_POINTS)
+    delay = np.zeros_like(w)
+    for section in sos:
+        delay += signal.group_delay((section[:3], section[3:]), w=w, fs=fs)[1]
+    return float(delay.max()/fs)
+
+
+def evaluate(design, fs, signals, reference, loop_freq=DEFAULT_LOOP_FREQ,
+             noise_freq=DEFAULT_NOISE_FREQ):
+    """Return a dict with the design, its delay and the residual noise of
+    each field for the signals of load_signals(). reference is the summed
+    noise_power() of the unfiltered signals. Filters start in the steady
+    state of the first sample of each log.
+    """
+    sos = design_sos(design, fs)
+    zi = signal.sosfilt_zi(sos)[:, :, None]
+    power = np.zeros(len(reference))
+    for x in signals:
+        y, _ = signal.sosfilt(sos, x, axis=0, zi=zi*x[0])
+        power += noise_power(y, fs, noise_freq)*len(x)
+    noise = np.sqrt(power/reference)
+    return {
+        'design': design,
+        'delay': group_delay(sos, fs, loop_freq),
+        'noise': dict(zip(FIELDS, noise.tolist())),
+        'max_noise': float(noise.max()),
+    }
+
+
+def run(designs, fs, signals, loop_freq=DEFAULT_LOOP_FREQ,
+        noise_freq=DEFAULT_NOISE_FREQ, processes=None):
+    """Return the evaluate() results of designs, in order. Designs are
+    evaluated in a pool of processes, by default one per CPU.
+    """
+    reference = sum(noise_power(x, fs, noise_freq)*len(x) for x in signals)
+    score = functools.partial(evaluate, fs=fs, signals=signals,
+                              reference=reference, loop_freq=loop_freq,
+                              noise_freq=noise_freq)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes == 1 or len(designs) <= 1:
+        return [score(d) for d in designs]
+    with futures.ProcessPoolExecutor(processes) as pool:
+        return list(pool.map(score, designs, chunksize=DESIGNS_PER_TASK))
+
+
+def pareto_front(results):
+    """Return the results not exceeded in both delay and residual noise by
+    another result, in order of increasing delay.
+    """
+    front = []
+    for r in sorted(results, key=lambda r: (r['delay'], r['max_noise'])):
+        if not front or r['max_noise'] < front[-1]['max_noise']:
+            front.append(r)
+    return front
+
+
+def select(results, max_noise=DEFAULT_MAX_NOISE):
+    """Return the result with the least delay and a residual noise of at
+    most max_noise, or None.
+    """
+    candidates = [r for r in results if r['max_noise'] <= max_noise]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda r: (r['delay'], r['max_noise']))
+
+
+def format_table(results, winner=None):
+    lines = ['{:<7}  {:>5}  {:>11}  {:>10}  {}'.format(
+        'family', 'order', 'cutoff [Hz]', 'delay [ms]',
+        '  '.join('{:>8}'.format(f) for f in FIELDS))]
+    for r in results:
+        d = r['design']
+        lines.append('{:<7}  {:>5}  {:>11.3f}  {:>10.3f}  {}{}'.format(
+            d.family, d.order, d.cutoff, r['delay']*1e3,
+            '  '.join('{:>8.4f}'.format(r['noise'][f]) for f in FIELDS),
+            '  <-' if r is winner else ''))
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=
+        'Evaluate lowpass filter designs on recorded sensor logs.')
+    parser.add_argument('paths', nargs='+', help='log files')
+    parser.add_argument('--max_order',
+        help='max filter order ({})'.format(DEFAULT_MAX_ORDER),
+        default=DEFAULT_MAX_ORDER, type=int)
+    parser.add_argument('-n', '--num_cutoffs',
+        help='number of cutoff frequencies ({})'.format(DEFAULT_NUM_CUTOFFS),
+        default=DEFAULT_NUM_CUTOFFS, type=int)
+    parser.add_argument('--loop_freq',
+        help='upper frequency of the loop band in Hz ({})'.format(
+            DEFAULT_LOOP_FREQ),
+        default=DEFAULT_LOOP_FREQ, type=float)
+    parser.add_argument('--noise_freq',
+        help='lower frequency of the noise band in Hz ({})'.format(
+            DEFAULT_NOISE_FREQ),
+        default=DEFAULT_NOISE_FREQ, type=float)
+    parser.add_argument('--max_noise',
+        help='max residual noise relative to unfiltered ({})'.format(
+            DEFAULT_MAX_NOISE),
+        default=DEFAULT_MAX_NOISE, type=float)
+    parser.add_argument('-j', '--processes',
+        help='number of worker processes (number of CPUs)',
+        default=None, type=int)
+    parser.add_argument('--generate',
+        help='generate the Arduino sources of the winning design',
+        action='store_true')
+    parser.add_argument('-m', '--mode',
+        help='output mode of the generated sources ({})'.format(DEFAULT_MODE),
+        default=DEFAULT_MODE, choices=gfc.OUTPUT_MODES)
+    args = parser.parse_args()
+
+    try:
+        fs, signals = load_signals(args.paths)
+    except (OSError, ValueError) as e:
+        print(e)
+        sys.exit(1)
+    if not args.loop_freq < args.noise_freq < fs/2:
+        print('loop and noise frequencies must increase up to the Nyquist '
+              'frequency {:.2f} Hz'.format(fs/2))
+        sys.exit(1)
+    print('{} logs, {} samples at {:.2f} Hz'.format(
+        len(signals), sum(len(x) for x in signals), fs))
+
+    results = run(designs(fs, args.max_order, args.num_cutoffs,
+                          args.loop_freq),
+                  fs, signals, args.loop_freq, args.noise_freq, args.processes)
+    winner = select(results, args.max_noise)
+    print(format_table(pareto_front(results), winner))
+    if winner is None:
+        print('no design with a residual noise of at most {}'.format(
+            args.max_noise))
+        sys.exit(1)
+    d = winner['design']
+    print('winner: {} order {} cutoff {:.3f} Hz, delay {:.3f} ms'.format(
+        d.family, d.order, d.cutoff, winner['delay']*1e3))
+    if args.generate:
+        try:
+            gfc.generate(d.family, d.order, d.cutoff, fs, args.mode)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        suffix = args.mode if args.mode in gfc.FIXED_POINT else ''
+        print('generated {}lowpass{}.cpp/.h'.format(d.family, suffix))
+    sys.exit(0)
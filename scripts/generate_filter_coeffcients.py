@@ -1,64 +1,221 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+"""
+Generate Arduino sources of lowpass filters from the templates in templates/.
+
+Output modes:
+ - ba: direct form with double a/b coefficients
+ - sos: float second-order sections in transposed direct form II, scaled
+   to the same DC gain
+ - q15/q31: second-order sections in direct form I with 16/32 bit integer
+   samples and coefficients, FixedPoint.shift fraction bits, rounding and
+   saturation
+lowpass_reference.py has a Python reference of each mode.
+    $ ./generate_filter_coeffcients.py 2 4 200
+    $ ./generate_filter_coeffcients.py --mode q15 2 4 200
+"""
+import argparse
 import os
 import sys
 import jinja2
+import numpy as np
 from scipy.signal import butter, cheby1, cheby2
 
 
-def lowpass_coeffs(filter_type, cutoff, fs, order):
+FILTER_TYPES = {'butter': butter, 'cheby1': cheby1, 'cheby2': cheby2}
+PASSBAND_RIPPLE = 1.0 # dB, max passband ripple of cheby1 filters
+STOPBAND_ATTENUATION = 40.0 # dB, min stopband attenuation of cheby2 filters
+MAX_GAIN_ERROR = 0.01 # max relative DC gain error of quantized filters
+OUTPUT_MODES = ('ba', 'sos', 'q15', 'q31')
+TEMPLATE_VARIANTS = {'ba': '', 'sos': '_sos', 'q15': '_fixed', 'q31': '_fixed'}
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          '../BsgBikeSim2014')
+
+
+class FixedPoint(object):
+    """Integer format of samples and coefficients with bits bits, summed in
+    an accumulator of acc_bits bits. Coefficients have shift fraction bits,
+    so they are in [-2, 2).
+    """
+    def __init__(self, name, bits, acc_bits):
+        self.name = name
+        self.bits = bits
+        self.acc_bits = acc_bits
+        self.shift = bits - 2
+        self.min = -2**(bits - 1)
+        self.max = 2**(bits - 1) - 1
+        self.acc_min = -2**(acc_bits - 1)
+        self.acc_max = 2**(acc_bits - 1) - 1
+        self.ctype = 'int{}_t'.format(bits)
+        self.acc_ctype = 'int{}_t'.format(acc_bits)
+
+
+FIXED_POINT = {
+    'q15': FixedPoint('q15', 16, 32),
+    'q31': FixedPoint('q31', 32, 64),
+}
+
+
+def lowpass_coeffs(filter_type, cutoff, fs, order, output='ba'):
+    """Return the coefficients of a digital lowpass filter, (b, a) or, with
+    output='sos', second-order sections. For cheby2 filters the cutoff is
+    the stopband edge.
+    """
     nyq = 0.5*fs
     normal_cutoff = cutoff/nyq
-    b, a = butter(order, normal_cutoff, btype='low', analog=False)
-    return b, a
+    if filter_type is cheby1:
+        return cheby1(order, PASSBAND_RIPPLE, normal_cutoff, btype='low',
+                      analog=False, output=output)
+    if filter_type is cheby2:
+        return cheby2(order, STOPBAND_ATTENUATION, normal_cutoff, btype='low',
+                      analog=False, output=output)
+    return filter_type(order, normal_cutoff, btype='low', analog=False,
+                       output=output)
+
+
+def balance_sections(sos):
+    """Return second-order sections scaled to the same DC gain, which keeps
+    the b coefficients and the signals between sections in range.
+    """
+    sos = np.array(sos, dtype=np.float64)
+    gain = sos[:, :3].sum(axis=1)/sos[:, 3:].sum(axis=1)
+    sos[:, :3] *= (np.prod(gain)**(1/len(sos))/gain)[:, None]
+    return sos
+
+
+def sos_coeffs(sos):
+    """Return the b0, b1, b2, a1, a2 coefficients (sections, 5) of
+    second-order sections as float32, the coefficients of the sos mode.
+    """
+    return np.asarray(sos, dtype=np.float64)[:, [0, 1, 2, 4, 5]].astype(
+        np.float32)
+
+
+def dc_gain(sos):
+    """Return the DC gain of second-order sections."""
+    sos = np.asarray(sos, dtype=np.float64)
+    return float(np.prod(sos[:, :3].sum(axis=1)/sos[:, 3:].sum(axis=1)))
+
+
+def quantize(sos, fmt, max_gain_error=MAX_GAIN_ERROR):
+    """Return the b0, b1, b2, a1, a2 coefficients of second-order sections
+    rounded to the FixedPoint format fmt, a list of lists of ints. Raises
+    ValueError if a coefficient is out of range, if a pole of the rounded
+    sections is not inside the unit circle or if their DC gain differs from
+    that of sos by more than max_gain_error, relative.
+    """
+    sos = np.asarray(sos, dtype=np.float64)
+    c = np.round(sos[:, [0, 1, 2, 4, 5]]*2**fmt.shift)
+    if np.any(c < fmt.min) or np.any(c > fmt.max):
+        raise ValueError('coefficients out of range of {}'.format(fmt.name))
+    rounded = np.insert(c/2**fmt.shift, 3, 1, axis=1)
+    radius = max(np.abs(np.roots(s[3:])).max() for s in rounded)
+    if radius >= 1:
+        raise ValueError('{} filter unstable, pole radius {:.6f}'.format(
+            fmt.name, radius))
+    error = abs(dc_gain(rounded)/dc_gain(sos) - 1)
+    if error > max_gain_error:
+        raise ValueError('{} filter DC gain error {:.3g} exceeds {}'.format(
+            fmt.name, error, max_gain_error))
+    return c.astype(np.int64).tolist()
+
+
+def float_literal(c):
+    """Return a C++ float literal of the float32 value c."""
+    return '{!r}f'.format(float(np.float32(c)))
+
+
+def generate(filter_name, order, cutoff_freq, sample_freq, mode='ba',
+             source_dir=SOURCE_DIR):
+    """Generate the Arduino sources of a lowpass filter of type filter_name,
+    a key of FILTER_TYPES, in an output mode of OUTPUT_MODES. Fixed-point
+    sources are named after the mode, e.g. butterlowpassq15.cpp with class
+    ButterLowpassQ15.
+    """
+    template_dict = {
+        'cutoff_freq': cutoff_freq,
+        'sample_freq': sample_freq,
+        'order': order
+    }
+    filter_type = FILTER_TYPES[filter_name]
+    template_dict['filter_name'] = filter_name.title()
+    suffix = ''
+    if mode == 'ba':
+        b, a = lowpass_coeffs(filter_type, cutoff_freq, sample_freq, order)
+        template_dict['a'] = ','.join(map(str, a))
+        template_dict['b'] = ','.join(map(str, b))
+    else:
+        sos = balance_sections(lowpass_coeffs(filter_type, cutoff_freq,
+                                              sample_freq, order,
+                                              output='sos'))
+        template_dict['sections'] = len(sos)
+        if mode == 'sos':
+            template_dict['coeffs'] = [', '.join(map(float_literal, row))
+                                       for row in sos_coeffs(sos)]
+        else:
+            fmt = FIXED_POINT[mode]
+            suffix = mode
+            template_dict.update({
+                'mode': mode.upper(),
+                'sample_type': fmt.ctype,
+                'acc_type': fmt.acc_ctype,
+                'shift': fmt.shift,
+                'sample_min': fmt.min,
+                'sample_max': fmt.max,
+                'coeffs': [', '.join(map(str, row))
+                           for row in quantize(sos, fmt)],
+            })
+    for ext in ('.cpp', '.h'):
+        generate_source(filter_name.lower(), ext, template_dict, mode,
+                        suffix, source_dir)
 
 
-def generate_source(filename_base, ext, template_dict):
-    if filename_base is 'median':
+def generate_source(filename_base, ext, template_dict, mode='ba', suffix='',
+                    source_dir=SOURCE_DIR):
+    if filename_base == 'median':
         template = template_setup(ext, filename_base)
     else:
-        template = template_setup(ext)
-    scripts_dir = os.path.dirname(os.path.abspath(__file__))
-    source_dir = os.path.join(scripts_dir, '../BsgBikeSim2014')
-    filename = os.path.join(source_dir, filename_base + 'lowpass' + ext)
+        template = template_setup(ext, mode=mode)
+    filename = os.path.join(source_dir,
+                            filename_base + 'lowpass' + suffix + ext)
     with open(filename, 'w') as f:
         f.write(template.render(template_dict))
 
 
-def template_setup(ext, filename_base=None):
+def template_setup(ext, filename_base=None, mode='ba'):
     template_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
                                 'templates')
     template_loader = jinja2.FileSystemLoader(template_dir)
     template_env = jinja2.Environment(loader=template_loader)
     if filename_base is None:
         filename_base = 'filter'
-    return template_env.get_template('{}lowpass{}.in'.format(filename_base,
-                                                             ext))
+    return template_env.get_template('{}lowpass{}{}.in'.format(
+        filename_base, TEMPLATE_VARIANTS[mode], ext))
 
 
 if __name__ == "__main__":
-    usage = 'generate arduino source files for filters\n'
-    usage += '{0} <order> <cutoff_freq> <sample_freq>'.format(__file__)
-
-    if len(sys.argv) < 4:
-        print(usage)
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description=
+        'Generate Arduino source files for lowpass filters.')
+    parser.add_argument('order', type=int, help='filter order')
+    parser.add_argument('cutoff_freq', type=float, help='cutoff in Hz')
+    parser.add_argument('sample_freq', type=float, help='sample rate in Hz')
+    parser.add_argument('-t', '--type',
+        help='filter type (butter)',
+        default='butter', choices=sorted(FILTER_TYPES))
+    parser.add_argument('-m', '--mode',
+        help='output mode (ba)',
+        default='ba', choices=OUTPUT_MODES)
+    parser.add_argument('-o', '--output_dir',
+        help='directory of the generated sources ({})'.format(
+            os.path.normpath(SOURCE_DIR)),
+        default=SOURCE_DIR)
+    args = parser.parse_args()
 
-    order = int(sys.argv[1])
-    cutoff_freq = float(sys.argv[2])
-    sample_freq = float(sys.argv[3])
-    template_dict = {
-        'cutoff_freq': cutoff_freq,
-        'sample_freq': sample_freq,
-        'order': order
-    }
     #generate_source('median', '.h', template_dict)
-
-    for filter_type, filter_name in zip((butter,),
-                                        ('butter',)):
-        b, a = lowpass_coeffs(filter_type, cutoff_freq, sample_freq, order)
-        template_dict['filter_name'] = filter_name.title()
-        template_dict['a'] = ','.join(map(str, a))
-        template_dict['b'] = ','.join(map(str, b))
-        generate_source(filter_name.lower(), '.cpp', template_dict)
-        generate_source(filter_name.lower(), '.h', template_dict)
+    try:
+        generate(args.type, args.order, args.cutoff_freq, args.sample_freq,
+                 args.mode, args.output_dir)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    sys.exit(0)
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Python reference of the lowpass filters generated by
+generate_filter_coeffcients.py.
+
+Each class repeats the operations of the generated C++ class of an output
+mode in the same order and precision, so for the same samples it returns
+bit for bit the same output:
+ - DirectFormLowpass: ba mode, double is float32 on the AVR
+ - SosLowpass: sos mode, float32 second-order sections
+ - FixedPointLowpass: q15 and q31 modes, integer second-order sections.
+   Raises OverflowError where the C++ accumulator would overflow, for which
+   the C++ behaviour is undefined.
+Float results match compilers that round every operation to float or
+double, as avr-gcc does, not those that contract to fused multiply-adds.
+
+The check filters a test signal with each mode and prints the max error
+relative to a float64 filter and to full scale. With --cpp the generated
+sources are compiled with the host C++ compiler and their output is compared
+bit for bit with the reference:
+    $ ./lowpass_reference.py 2 4 200
+    $ ./lowpass_reference.py --cpp --type cheby1 4 10 200
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+from scipy import signal
+
+import generate_filter_coeffcients as gfc
+
+
+HOST_DOUBLE = np.float64 # double of the host C++ compiler
+CXX = os.environ.get('CXX', 'c++')
+CXXFLAGS = ['-O2', '-std=c++11', '-ffp-contract=off']
+DEFAULT_SAMPLES = 4000
+SIGNAL_LEVEL = 0.5 # test signal amplitude, fraction of full scale
+
+
+class DirectFormLowpass(object):
+    """Reference of the ba mode class. dtype is the type of double on the
+    target.
+    """
+    def __init__(self, b, a, dtype=np.float32):
+        self._dtype = dtype
+        self._b = [dtype(c) for c in b]
+        self._a = [dtype(c) for c in a]
+        self._size = len(self._b)
+        self._x = [dtype(0)]*self._size
+        self._y = [dtype(0)]*self._size
+        self._n = 0
+
+    def filter(self, sample):
+        b, a, x, y = self._b, self._a, self._x, self._y
+        n, size = self._n, self._size
+        x[n] = self._dtype(np.float32(sample))
+        y[n] = b[0]*x[n]
+        for i in range(1, size):
+            j = (n - i + size) % size
+            y[n] = y[n] + (b[i]*x[j] - a[i]*y[j])
+        result = np.float32(y[n])
+        self._n = (n + 1) % size
+        return result
+
+
+class SosLowpass(object):
+    """Reference of the sos mode class, coefficients (sections, 5) are b0,
+    b1, b2, a1, a2 of gfc.sos_coeffs().
+    """
+    def __init__(self, coeffs):
+        self._coeffs = [[np.float32(c) for c in row] for row in coeffs]
+        self._z = [[np.float32(0), np.float32(0)] for _ in self._coeffs]
+
+    def filter(self, sample):
+        x = np.float32(sample)
+        for c, z in zip(self._coeffs, self._z):
+            y = c[0]*x + z[0]
+            z[0] = c[1]*x - c[3]*y + z[1]
+            z[1] = c[2]*x - c[4]*y
+            x = y
+        return x
+
+
+class FixedPointLowpass(object):
+    """Reference of the q15 and q31 mode classes, coefficients (sections, 5)
+    are the b0, b1, b2, a1, a2 of gfc.quantize() with the FixedPoint format
+    fmt.
+    """
+    def __init__(self, coeffs, fmt):
+        self._coeffs = [[int(c) for c in row] for row in coeffs]
+        self._fmt = fmt
+        self._x = [[0, 0] for _ in self._coeffs]
+        self._y = [[0, 0] for _ in self._coeffs]
+
+    def _check(self, acc):
+        if not self._fmt.acc_min <= acc <= self._fmt.acc_max:
+            raise OverflowError('{} accumulator overflow'.format(
+                self._fmt.acc_ctype))
+        return acc
+
+    def filter(self, sample):
+        fmt = self._fmt
+        x = int(sample)
+        if not fmt.min <= x <= fmt.max:
+            raise ValueError('sample {} out of range of {}'.format(x,
+                                                                   fmt.name))
+        check = self._check
+        for c, xs, ys in zip(self._coeffs, self._x, self._y):
+            # same order of evaluation as the C++ expression
+            acc = check(check(c[0]*x) + check(c[1]*xs[0]))
+            acc = check(acc + check(c[2]*xs[1]))
+            acc = check(acc - check(c[3]*ys[0]))
+            acc = check(acc - check(c[4]*ys[1]))
+            acc = check(acc + (1 << (fmt.shift - 1))) >> fmt.shift
+            acc = min(max(acc, fmt.min), fmt.max)
+            xs[1] = xs[0]
+            xs[0] = x
+            ys[1] = ys[0]
+            ys[0] = acc
+            x = acc
+        return x
+
+
+def reference(filter_name, order, cutoff_freq, sample_freq, mode='ba',
+              dtype=np.float32):
+    """Return the reference of the filter generate() generates with the same
+    arguments. dtype is the type of double of the ba mode.
+    """
+    filter_type = gfc.FILTER_TYPES[filter_name]
+    if mode == 'ba':
+        b, a = gfc.lowpass_coeffs(filter_type, cutoff_freq, sample_freq,
+                                  order)
+        return DirectFormLowpass(b, a, dtype)
+    sos = gfc.balance_sections(gfc.lowpass_coeffs(
+        filter_type, cutoff_freq, sample_freq, order, output='sos'))
+    if mode == 'sos':
+        return SosLowpass(gfc.sos_coeffs(sos))
+    fmt = gfc.FIXED_POINT[mode]
+    return FixedPointLowpass(gfc.quantize(sos, fmt), fmt)
+
+
+def filter_samples(lowpass, samples):
+    """Return the outputs of lowpass for samples, float32 or int64."""
+    y = [lowpass.filter(s) for s in samples]
+    return np.array(y, dtype=np.int64 if isinstance(
+        lowpass, FixedPointLowpass) else np.float32)
+
+
+def test_signal(n, cutoff_freq, sample_freq, seed=0):
+    """Return n samples in [-1, 1] of a step, a sine at half the cutoff
+    frequency and noise.
+    """
+    rng = np.random.RandomState(seed)
+    t = np.arange(n)/sample_freq
+    x = (0.5*(t >= 0.1*t[-1]) + 0.3*np.sin(np.pi*cutoff_freq*t) +
+         0.2*rng.uniform(-1, 1, n))
+    return np.clip(x, -1, 1)
+
+
+def scaled_samples(x, mode):
+    """Return samples x in [-1, 1] at SIGNAL_LEVEL of the full scale of
+    mode, float32 or ints.
+    """
+    if mode in gfc.FIXED_POINT:
+        fmt = gfc.FIXED_POINT[mode]
+        return np.round(x*SIGNAL_LEVEL*fmt.max).astype(np.int64)
+    return (x*SIGNAL_LEVEL).astype(np.float32)
+
+
+def full_scale(mode):
+    return gfc.FIXED_POINT[mode].max if mode in gfc.FIXED_POINT else 1.0
+
+
+_MAIN = '''#include <stdio.h>
+#include <stdlib.h>
+#include "{header}"
+
+int main() {{
+    {cls} lowpass;
+    char line[64];
+    while (fgets(line, sizeof line, stdin)) {{
+        {statement}
+    }}
+    return 0;
+}}
+'''
+
+
+def run_cpp(filter_name, order, cutoff_freq, sample_freq, mode, samples):
+    """Generate, compile and run the C++ filter of mode on the host and
+    return its outputs for samples. Floats are passed in hexadecimal, so
+    they are exact.
+    """
+    suffix = mode if mode in gfc.FIXED_POINT else ''
+    base = filter_name.lower() + 'lowpass' + suffix
+    cls = filter_name.title() + 'Lowpass' + suffix.upper()
+    if mode in gfc.FIXED_POINT:
+        statement = ('printf("%lld\\n", (long long)lowpass.filter('
+                     'strtoll(line, 0, 10)));')
+        lines = ['{}\n'.format(int(s)) for s in samples]
+    else:
+        statement = 'printf("%a\\n", (double)lowpass.filter(strtof(line, 0)));'
+        lines = ['{}\n'.format(float(s).hex()) for s in samples]
+    with tempfile.TemporaryDirectory() as tmp:
+        gfc.generate(filter_name, order, cutoff_freq, sample_freq, mode, tmp)
+        with open(os.path.join(tmp, 'main.cpp'), 'w') as f:
+            f.write(_MAIN.format(header=base + '.h', cls=cls,
+                                 statement=statement))
+        program = os.path.join(tmp, 'lowpass')
+        subprocess.run([CXX] + CXXFLAGS + ['-o', program,
+                        os.path.join(tmp, 'main.cpp'),
+                        os.path.join(tmp, base + '.cpp')], check=True)
+        output = subprocess.run([program], input=''.join(lines), check=True,
+                                stdout=subprocess.PIPE,
+                                universal_newlines=True).stdout.split()
+    if mode in gfc.FIXED_POINT:
+        return np.array([int(y) for y in output], dtype=np.int64)
+    return np.array([float.fromhex(y) for y in output], dtype=np.float32)
+
+
+def check(filter_name, order, cutoff_freq, sample_freq, n=DEFAULT_SAMPLES,
+          cpp=False):
+    """Print the error of the reference of each mode relative to a float64
+    filter and, if cpp is set, if the compiled C++ output is bit exact.
+    """
+    x = test_signal(n, cutoff_freq, sample_freq)
+    b, a = gfc.lowpass_coeffs(gfc.FILTER_TYPES[filter_name], cutoff_freq,
+                              sample_freq, order)
+    print('{:<4}  {:>12}  {:>12}  {}'.format('mode', 'max error', 'rel. error',
+                                             'C++'))
+    for mode in gfc.OUTPUT_MODES:
+        samples = scaled_samples(x, mode)
+        exact = signal.lfilter(b, a, samples.astype(np.float64))
+        try:
+            lowpass = reference(filter_name, order, cutoff_freq, sample_freq,
+                                mode)
+            y = filter_samples(lowpass, samples)
+        except (OverflowError, ValueError) as e:
+            print('{:<4}  {}'.format(mode, e))
+            continue
+        error = np.abs(y - exact).max()
+        result = '-'
+        if cpp:
+            if mode == 'ba':
+                y = filter_samples(reference(filter_name, order, cutoff_freq,
+                                             sample_freq, mode, HOST_DOUBLE),
+                                   samples)
+            y_cpp = run_cpp(filter_name, order, cutoff_freq, sample_freq,
+                            mode, samples)
+            if y.dtype == np.float32: # compare bits, not values
+                y, y_cpp = y.view(np.int32), y_cpp.view(np.int32)
+            result = 'bit exact' if np.array_equal(y, y_cpp) else 'DIFFERS'
+        print('{:<4}  {:>12.4e}  {:>12.4e}  {}'.format(
+            mode, error, error/full_scale(mode), result))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=
+        'Compare the Python references of the generated lowpass filters.')
+    parser.add_argument('order', type=int, help='filter order')
+    parser.add_argument('cutoff_freq', type=float, help='cutoff in Hz')
+    parser.add_argument('sample_freq', type=float, help='sample rate in Hz')
+    parser.add_argument('-t', '--type',
+        help='filter type (butter)',
+        default='butter', choices=sorted(gfc.FILTER_TYPES))
+    parser.add_argument('-n', '--samples',
+        help='number of test samples ({})'.format(DEFAULT_SAMPLES),
+        default=DEFAULT_SAMPLES, type=int)
+    parser.add_argument('--cpp',
+        help='compile the generated sources with $CXX ({}) and compare '
+             'their output'.format(CXX),
+        action='store_true')
+    args = parser.parse_args()
+
+    check(args.type, args.order, args.cutoff_freq, args.sample_freq,
+          args.samples, args.cpp)
+    sys.exit(0)
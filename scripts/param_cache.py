@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Disk cache for results computed from model parameters.
+
+Results are stored as NumPy .npz files named after the result and a hash of
+the parameters they were computed from, so a change of parameters, grid or
+code version gives a new file. The cache directory is $BSG_CACHE_DIR,
+$XDG_CACHE_HOME/bsgbikesim or ~/.cache/bsgbikesim.
+"""
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+
+CACHE_ENV = 'BSG_CACHE_DIR'
+CACHE_NAME = 'bsgbikesim'
+HASH_LENGTH = 16 # hex digits of the parameter hash in cache filenames
+
+
+def cache_dir():
+    path = os.environ.get(CACHE_ENV)
+    if path is None:
+        base = os.environ.get('XDG_CACHE_HOME',
+                              os.path.join(os.path.expanduser('~'), '.cache'))
+        path = os.path.join(base, CACHE_NAME)
+    return path
+
+
+def param_hash(*params):
+    """Return a hex digest of parameters, which may be arrays, numbers,
+    strings or sequences of these.
+    """
+    h = hashlib.sha1()
+    def update(p):
+        if isinstance(p, np.ndarray):
+            h.update('{}{}'.format(p.dtype.str, p.shape).encode('utf-8'))
+            h.update(np.ascontiguousarray(p).tobytes())
+        elif isinstance(p, (list, tuple)):
+            h.update('{}{}'.format(type(p).__name__, len(p)).encode('utf-8'))
+            for q in p:
+                update(q)
+        else:
+            h.update(repr(p).encode('utf-8'))
+    for p in params:
+        update(p)
+    return h.hexdigest()
+
+
+def file_hash(path):
+    """Return a hex digest of the contents of a file, e.g. of the script
+    computing a result, so that cached results change with the script.
+    """
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def cache_path(name, key):
+    return os.path.join(cache_dir(),
+                        '{}_{}.npz'.format(name, key[:HASH_LENGTH]))
+
+
+def load(name, key):
+    """Return a dict of the arrays cached for name and key, or None."""
+    try:
+        with np.load(cache_path(name, key)) as f:
+            return {k: f[k] for k in f.files}
+    except (OSError, ValueError):
+        return None
+
+
+def save(name, key, **arrays):
+    """Cache arrays for name and key. The file is written atomically, so
+    concurrent processes never read a partial file.
+    """
+    path = cache_path(name, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(suffix='.npz', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return path
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import abc
+import array
 import bisect
 import collections
 import marshal
@@ -10,6 +11,7 @@ import re
 import time
 
 import numpy as np
+import numpy.lib.recfunctions as rfn
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 import matplotlib.patches as mpatches
@@ -19,24 +21,40 @@ from scipy import signal
 
 import sys
 sys.path.append('../comm')
-from serial_udp_bridge import Sample
+import binlog
+import protocol
+
+
+TRANSDUCER_BUFFER_SIZE = 1024 # samples, initial Transducer buffer size
+MARSHAL_CHUNK_SIZE = 4096 # records per put_many() call in marshal logs
 
 
 class Transducer(metaclass=abc.ABCMeta):
+    """Samples of the fields _fields of a transducer.
 
-    def __new__(cls, name, filepath):
+    Samples are added with put() or put_many() to float32 buffers, which
+    grow geometrically, and update() makes the time and data views of the
+    samples added so far. Angles and angular rates are converted to degrees
+    when added. Each field is also available as an attribute.
+    """
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
         def prop(x):
             return property(lambda self: self.get_field(x))
         for f in cls._fields:
             setattr(cls, f, prop(f))
-        return super().__new__(cls)
 
     def __init__(self, name, filepath=''):
         self._name = name
         self._filename = filepath
         self._sample_size = len(self.__class__._fields)
-        self._data_str = self._sample_size * ['0']
-        self._time_str = ['0']
+        self._deg = [i for i, f in enumerate(self._fields)
+                     if units(f).startswith('deg')]
+        self._size = 0 # number of samples in the buffers
+        self._time_buffer = np.zeros(TRANSDUCER_BUFFER_SIZE, np.float32)
+        self._data_buffer = np.zeros((TRANSDUCER_BUFFER_SIZE,
+                                      self._sample_size), np.float32)
         self._time = np.zeros(0)
         self._data = np.zeros(0)
         self._start_time = None
@@ -45,14 +63,45 @@ class Transducer(metaclass=abc.ABCMeta):
     def put(self, timestamp, data):
         if len(data) != self._sample_size:
             raise ValueError
-        self._time_str.append(timestamp)
-        self._data_str.extend(data)
+        self._reserve(1)
+        n = self._size
+        self._time_buffer[n] = timestamp
+        self._data_buffer[n] = data
+        self._convert_rad_deg(self._data_buffer[n:n + 1])
+        self._size = n + 1
+
+    def put_many(self, timestamps, data):
+        """Add samples from a sequence of timestamps and a sequence of
+        samples (samples, fields).
+        """
+        timestamps = np.asarray(timestamps, np.float32)
+        data = np.asarray(data, np.float32)
+        if data.shape != (len(timestamps), self._sample_size):
+            raise ValueError
+        self._reserve(len(timestamps))
+        n = self._size
+        m = n + len(timestamps)
+        self._time_buffer[n:m] = timestamps
+        self._data_buffer[n:m] = data
+        self._convert_rad_deg(self._data_buffer[n:m])
+        self._size = m
 
     def update(self):
-        self._update_time()
-        self._update_data()
+        """Update time and data to views of the samples added so far."""
+        self._time = self._time_buffer[:self._size]
+        self._data = self._data_buffer[:self._size]
+        self._update_dt()
+
+    def set_data(self, time, data):
+        """Set time and data from arrays, replacing data added with put()."""
+        self._time = np.array(time, np.float32)
+        self._data = np.array(data, np.float32).reshape((self._time.shape[0],
+                                                         self._sample_size))
+        self._convert_rad_deg(self._data)
+        self._time_buffer = self._time
+        self._data_buffer = self._data
+        self._size = len(self._time)
         self._update_dt()
-        self._convert_rad_deg()
 
     def get_field(self, fieldname):
         if len(self._time) == 0:
@@ -104,31 +153,36 @@ class Transducer(metaclass=abc.ABCMeta):
     def dt(self):
         return self._dt
 
-    def _update_time(self):
-        # ignore first sample
-        self._time = np.array(self._time_str[1:], np.float32)
-
-    def _update_data(self):
-        self._data = np.array(self._data_str[self._sample_size:],
-                              np.float32).reshape((self._time.shape[0],
-                                                   self._sample_size))
+    def _reserve(self, n):
+        """Grow the buffers to hold n more samples. Views made by update()
+        keep the old buffers.
+        """
+        size = len(self._time_buffer)
+        if self._size + n <= size:
+            return
+        size = max(2*size, self._size + n, TRANSDUCER_BUFFER_SIZE)
+        time_buffer = np.zeros(size, np.float32)
+        data_buffer = np.zeros((size, self._sample_size), np.float32)
+        time_buffer[:self._size] = self._time_buffer[:self._size]
+        data_buffer[:self._size] = self._data_buffer[:self._size]
+        self._time_buffer = time_buffer
+        self._data_buffer = data_buffer
 
     def _update_dt(self):
         # don't include the last element
         self._dt = (np.roll(self.time, -1) - self.time)[:-1]
 
-    def _convert_rad_deg(self):
-        for i, f in enumerate(self._fields):
-            if units(f).startswith('deg'):
-                self._data[:, i] = 180/np.pi*self._data[:, i]
+    def _convert_rad_deg(self, data):
+        for i in self._deg:
+            data[:, i] = 180/np.pi*data[:, i]
 
 
 class Sensor(Transducer):
-    _fields = ('delta', 'deltad', 'cadence', 'brake')
+    _fields = protocol.SENSOR_FIELDS
 
 
 class Actuator(Transducer):
-    _fields = ('torque', 'phi')
+    _fields = binlog.ACTUATOR_FIELDS
 
 
 class Log(object):
@@ -139,7 +193,8 @@ class Log(object):
         sensor, actuator = parse_log(path)
         self._filepath = path
         self._logname = os.path.basename(path)
-        parts = self._logname.split('_')
+        # files rotated within the same second have a .N suffix
+        parts = os.path.splitext(self._logname)[0].split('_')
         self._subject_code = parts[-2]
         self._feedback_enabled = bool(int(parts[-1])) == Log.FEEDBACK_ENABLED
         self._sensor = sensor
@@ -513,7 +568,7 @@ def set_torque_enabled_legend(ax, prop=None):
 
 
 def parse_log_dir(dirname):
-    pattern = re.compile('^log_\d{6}_\d{6}_UTC_\d{3}_[01]$')
+    pattern = re.compile('^log_\d{6}_\d{6}_UTC_\d{3}_[01](\.\d+)?$')
     subjects = dict()
     log_count = 0
     for f in os.listdir(dirname):
@@ -536,8 +591,48 @@ def parse_log_dir(dirname):
 
 
 def parse_log(path):
+    if binlog.is_binary_log(path):
+        return parse_binary_log(path)
+    return parse_marshal_log(path)
+
+
+def parse_binary_log(path):
+    header, end_time, streams = binlog.read_log(path)
+    start_time = time.gmtime(header['start_time'])
+    if end_time is not None:
+        end_time = time.gmtime(end_time)
+    sensor = Sensor('sensor', path)
+    actuator = Actuator('actuator', path)
+    for transducer in (sensor, actuator):
+        records = streams[transducer.name]
+        transducer._start_time = start_time
+        transducer._end_time = end_time
+        transducer.set_data(records['time'], rfn.structured_to_unstructured(
+            records[list(transducer.fields)], np.float32))
+    return sensor, actuator
+
+
+def parse_marshal_log(path):
+    """Parse a log written by the bridge before the binary log format."""
     sensor = Sensor('sensor', path)
     actuator = Actuator('actuator', path)
+    # records are added in chunks of MARSHAL_CHUNK_SIZE records
+    chunks = {t: (array.array('d'), array.array('d'))
+              for t in (sensor, actuator)}
+    def put(transducer, timestamp, data):
+        timestamps, samples = chunks[transducer]
+        if len(data) != len(transducer.fields):
+            raise ValueError
+        timestamps.append(timestamp)
+        samples.extend(data)
+        if len(timestamps) >= MARSHAL_CHUNK_SIZE:
+            flush(transducer)
+    def flush(transducer):
+        timestamps, samples = chunks[transducer]
+        transducer.put_many(timestamps, np.frombuffer(samples).reshape(
+            (len(timestamps), len(transducer.fields))))
+        del timestamps[:]
+        del samples[:]
     with open(path, 'rb') as f:
         while True:
             try:
@@ -559,13 +654,14 @@ def parse_log(path):
             else:
                 timestamp, source, data = p
                 if source == 'sensor':
-                    sensor.put(timestamp, data)
+                    put(sensor, timestamp, data)
                 elif source == 'actuator':
-                    actuator.put(timestamp, data)
+                    put(actuator, timestamp, data)
                 else:
                     print('Unmarshalled unexpected type: {}'.format(type(data)))
-    sensor.update()
-    actuator.update()
+    for transducer in (sensor, actuator):
+        flush(transducer)
+        transducer.update()
     return sensor, actuator
 
 
@@ -2,14 +2,30 @@
 # -*- coding: utf-8 -*-
 """Calculate the pitch needed to maintain contact between the front wheel and
 ground.
+
+Deriving and simplifying the constraint takes a while, so the expressions are
+cached on disk together with the generated Python evaluator, keyed by the
+parameters and a hash of this script. Generated code computes common
+subexpressions once (sympy.cse):
+    $ ./pitch_constraint.py
+    $ ./pitch_constraint.py --benchmark
 """
-from sympy import simplify, symbols
-from sympy import Symbol
+import argparse
+import os
+import sys
+import time
+from collections import namedtuple
+
+import numpy as np
+from mpmath import findroot
+from sympy import Float, S, cse, simplify, srepr, symbols, sympify
 from sympy.physics.mechanics import ReferenceFrame, Point
 from sympy.physics.mechanics import msprint
-from sympy.mpmath import findroot
 from sympy.utilities import lambdify
-from sympy.printing import ccode
+from sympy.printing.c import C99CodePrinter
+from sympy.printing.numpy import NumPyPrinter
+
+import param_cache
 
 
 ## define coordinates
@@ -33,77 +49,232 @@ benchmark_parameters = {
     cF: 0.0320714267276193,
 }
 
-## define reference frames
-# N: inertial frame
-# B: rear aseembly frame
-# H: front assembly frame
-N = ReferenceFrame('N')
-B = N.orientnew('B', 'body', [0, phi, theta], 'zxy') # yaw is ignored
-H = B.orientnew('H', 'axis', [delta, B.z])
+# names of the coordinates in generated code
+code_symbols = dict(zip([phi, theta, delta], symbols('lean pitch steer')))
 
-## define points
-# rear wheel/ground contact point
-pP = Point('P')
 
-# define unit vectors from rear/front wheel centers to ground
-# along the wheel plane
-R_z = ((B.y ^ N.z) ^ B.y).normalize()
-F_z = ((H.y ^ N.z) ^ H.y).normalize()
+# frames and points of the bicycle, see kinematics()
+Kinematics = namedtuple('Kinematics', 'N B H P Rs Rh Fh Fs Q')
 
-# define rear wheel center point
-pRs = pP.locatenew('R*', -rR*R_z)
 
-# "top" of steer axis, point of SA closest to R*
-# orthogonal projection of rear wheel center on steer axis
-pRh = pRs.locatenew('R^', cR*B.x)
+def kinematics(lean=phi, pitch=theta, steer=delta, yaw=0):
+    """Return the Kinematics frames and points of the bicycle for the given
+    coordinates, symbols or dynamicsymbols. Point positions are defined
+    relative to the rear wheel contact point P.
+    """
+    ## define reference frames
+    # N: inertial frame
+    # B: rear aseembly frame
+    # H: front assembly frame
+    N = ReferenceFrame('N')
+    B = N.orientnew('B', 'body', [yaw, lean, pitch], 'zxy')
+    H = B.orientnew('H', 'axis', [steer, B.z])
 
-# orthogonal projection of front wheel center on steer axis
-pFh = pRh.locatenew('S^', ls*B.z)
+    ## define points
+    # rear wheel/ground contact point
+    pP = Point('P')
 
-# front wheel center point
-pFs = pFh.locatenew('S*', cF*H.x)
+    # define unit vectors from rear/front wheel centers to ground
+    # along the wheel plane
+    R_z = ((B.y ^ N.z) ^ B.y).normalize()
+    F_z = ((H.y ^ N.z) ^ H.y).normalize()
 
-# front wheel/ground contact point
-pQ = pFs.locatenew('Q', rF*F_z)
+    # define rear wheel center point
+    pRs = pP.locatenew('R*', -rR*R_z)
 
-# N.z component of vector to pQ from pP
-# this is our configuration constraint
-f = simplify(pQ.pos_from(pP) & N.z)
+    # "top" of steer axis, point of SA closest to R*
+    # orthogonal projection of rear wheel center on steer axis
+    pRh = pRs.locatenew('R^', cR*B.x)
 
-print("f = {}\n".format(msprint(f)))
+    # orthogonal projection of front wheel center on steer axis
+    pFh = pRh.locatenew('S^', ls*B.z)
 
-# calculate the derivative of f for use with newton-raphson
-df = simplify(f.diff(theta))
-print("df/dθ = {}\n".format(msprint(df)))
+    # front wheel center point
+    pFs = pFh.locatenew('S*', cF*H.x)
 
-# constraint function for zero steer/lean configuration and 
-# using the benchmark parameters
-f0 = lambdify(theta, f.subs({phi: 0, delta: 0}).subs(benchmark_parameters))
-df0 = lambdify(theta, df.subs({phi: 0, delta: 0}).subs(benchmark_parameters))
+    # front wheel/ground contact point
+    pQ = pFs.locatenew('Q', rF*F_z)
+    return Kinematics(N, B, H, pP, pRs, pRh, pFh, pFs, pQ)
 
-print("verifying constraint equations are correct")
-print("for zero steer/lean, pitch should be pi/10")
-findroot(f0, 0.3, solver="newton", tol=1e-8, verbose=True, df=df0)
 
-c_sym = [Symbol('lean'), Symbol('pitch'), Symbol('steer')]
-c_sym_dict = dict(zip([phi, theta, delta], c_sym))
+def constraint():
+    """Return the front wheel contact constraint f(φ, θ, δ), the height of
+    the front wheel contact point above the ground, and df/dθ.
+    """
+    k = kinematics() # yaw is ignored
 
-fc = ccode(f.subs(c_sym_dict))
-dfc = ccode(df.subs(c_sym_dict))
+    # N.z component of vector to pQ from pP
+    # this is our configuration constraint
+    f = simplify(k.Q.pos_from(k.P) & k.N.z)
 
-cs_math = {
-    'cos': 'Math.Cos',
-    'sin': 'Math.Sin',
-    'pow': 'Math.Pow',
-    'sqrt': 'Math.Sqrt'
-}
+    # calculate the derivative of f for use with newton-raphson
+    df = simplify(f.diff(theta))
+    return f, df
+
+
+def check_benchmark(f, df, parameters=benchmark_parameters):
+    """Solve the constraint for zero steer/lean with the benchmark
+    parameters, for which the pitch should be pi/10.
+    """
+    # constraint function for zero steer/lean configuration and
+    # using the benchmark parameters
+    f0 = lambdify(theta, f.subs({phi: 0, delta: 0}).subs(parameters),
+                  'mpmath')
+    df0 = lambdify(theta, df.subs({phi: 0, delta: 0}).subs(parameters),
+                   'mpmath')
+    return findroot(f0, 0.3, solver="newton", tol=1e-8, verbose=True, df=df0)
+
+
+class CSharpCodePrinter(C99CodePrinter):
+    """C99 code printer with the System.Math functions of C#."""
+    _math = {
+        'sin': 'Math.Sin',
+        'cos': 'Math.Cos',
+        'tan': 'Math.Tan',
+        'Abs': 'Math.Abs',
+    }
+
+    def __init__(self, settings=None):
+        settings = dict(settings or {})
+        settings.setdefault('user_functions', {}).update(self._math)
+        super().__init__(settings)
+
+    def _print_Pow(self, expr):
+        if expr.exp == S.Half:
+            return 'Math.Sqrt({})'.format(self._print(expr.base))
+        if expr.exp == -S.Half:
+            return '1.0/Math.Sqrt({})'.format(self._print(expr.base))
+        if expr.exp == 2 and expr.base.is_Symbol:
+            return '{0}*{0}'.format(self.parenthesize(expr.base, 100))
+        if expr.exp == -1:
+            return '1.0/{}'.format(self.parenthesize(expr.base, 100))
+        return 'Math.Pow({}, {})'.format(self._print(expr.base),
+                                         self._print(S(expr.exp).evalf()))
+
+
+def python_code(f, df, parameters=benchmark_parameters):
+    """Return the source of a NumPy function pitch_constraint(lean, pitch,
+    steer) returning f and df/dθ with the given parameters.
+    """
+    # 17 significant digits print the parameters exactly
+    values = {k: Float(v, 17) for k, v in parameters.items()}
+    exprs = [e.subs(values).subs(code_symbols) for e in (f, df)]
+    replacements, (fr, dfr) = cse(exprs)
+    printer = NumPyPrinter()
+    lines = [
+        'import numpy',
+        '',
+        '',
+        'def pitch_constraint(lean, pitch, steer):',
+        '    """Return f and df/dθ of the front wheel contact constraint."""',
+    ]
+    lines += ['    {} = {}'.format(x, printer.doprint(e))
+              for x, e in replacements]
+    lines.append('    return ({}, {})'.format(printer.doprint(fr),
+                                              printer.doprint(dfr)))
+    return '\n'.join(lines) + '\n'
+
+
+def compile_evaluator(source):
+    """Return the function defined by the source of python_code()."""
+    namespace = {}
+    exec(compile(source, '<pitch_constraint>', 'exec'), namespace)
+    return namespace['pitch_constraint']
+
+
+def csharp_code(f, df):
+    """Return C# statements computing f and df/dθ in terms of lean, pitch
+    and steer, with common subexpressions computed once.
+    """
+    exprs = [e.subs(code_symbols) for e in (f, df)]
+    replacements, (fr, dfr) = cse(exprs)
+    printer = CSharpCodePrinter()
+    lines = ['double {} = {};'.format(x, printer.doprint(e))
+             for x, e in replacements]
+    lines.append('double f = {};'.format(printer.doprint(fr)))
+    lines.append('double df = {};'.format(printer.doprint(dfr)))
+    return '\n'.join(lines)
+
+
+def load_constraint(parameters=benchmark_parameters, use_cache=True):
+    """Return f, df/dθ and the python_code() source for the given
+    parameters, from the disk cache if this script and the parameters have
+    not changed.
+    """
+    key = param_cache.param_hash(
+        param_cache.file_hash(os.path.abspath(__file__)),
+        sorted((str(k), float(v)) for k, v in parameters.items()))
+    if use_cache:
+        cached = param_cache.load('pitch_constraint', key)
+        if cached is not None:
+            return (sympify(str(cached['f'])), sympify(str(cached['df'])),
+                    str(cached['source']))
+    f, df = constraint()
+    source = python_code(f, df, parameters)
+    if use_cache:
+        param_cache.save('pitch_constraint', key, f=np.array(srepr(f)),
+                         df=np.array(srepr(df)), source=np.array(source))
+    return f, df, source
+
+
+def benchmark(f, df, source, parameters=benchmark_parameters, n=100000,
+              repeat=5):
+    """Print the time to evaluate f and df/dθ with plain lambdify and with
+    the generated evaluator, for arrays of n points and for single points.
+    """
+    args = (phi, theta, delta)
+    f_lambdify = lambdify(args, f.subs(parameters), 'numpy')
+    df_lambdify = lambdify(args, df.subs(parameters), 'numpy')
+    evaluate = compile_evaluator(source)
+
+    rng = np.random.RandomState(0)
+    lean, steer = rng.uniform(-np.pi/3, np.pi/3, (2, n))
+    pitch = rng.uniform(0.2, 0.4, n)
+    def timed(func, *a):
+        best = np.inf
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            func(*a)
+            best = min(best, time.perf_counter() - t0)
+        return best
+    lambdified = lambda *a: (f_lambdify(*a), df_lambdify(*a))
+    error = np.abs(np.array(lambdified(lean, pitch, steer)) -
+                   np.array(evaluate(lean, pitch, steer))).max()
+    m = 1000
+    for name, func in (('lambdify', lambdified), ('cse', evaluate)):
+        t_array = timed(func, lean, pitch, steer)
+        t_scalar = timed(lambda: [func(float(lean[i]), float(pitch[i]),
+                                       float(steer[i])) for i in range(m)])
+        print('{:>8}: {:8.3f} ms for {} points, {:6.2f} us per point '
+              'call'.format(name, t_array*1e3, n, t_scalar/m*1e6))
+    print('max difference {:.3e}'.format(error))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=
+        'Derive the front wheel contact constraint and generate code.')
+    parser.add_argument('--no_cache',
+        help='do not read or write the cached derivation',
+        action='store_true')
+    parser.add_argument('-b', '--benchmark',
+        help='compare the generated evaluator with lambdify',
+        action='store_true')
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    f, df, source = load_constraint(use_cache=not args.no_cache)
+    print("derived in {:.3f} s\n".format(time.perf_counter() - t0))
+    print("f = {}\n".format(msprint(f)))
+    print("df/dθ = {}\n".format(msprint(df)))
 
-fcs = fc
-dfcs = dfc
+    print("verifying constraint equations are correct")
+    print("for zero steer/lean, pitch should be pi/10")
+    check_benchmark(f, df)
+    print()
 
-for k, v in cs_math.items():
-    fcs = fcs.replace(k, v)
-    dfcs = dfcs.replace(k, v)
-    
-print(fcs)
-print(dfcs)
\ No newline at end of file
+    print(csharp_code(f, df))
+    print()
+    print(source)
+    if args.benchmark:
+        benchmark(f, df, source)
+    sys.exit(0)
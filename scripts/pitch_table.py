@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pitch of the benchmark bicycle over a grid of lean and steer angles.
+
+The front wheel contact constraint of pitch_constraint.py and its derivative
+are evaluated with the generated NumPy code of pitch_constraint.py and solved
+for the pitch with a Newton iteration over whole arrays of (lean, steer) at
+once. The solutions on a grid are interpolated with a bicubic spline, and
+the max interpolation error is measured against Newton solutions on a grid
+with ERROR_SUBDIVISIONS points per cell and angle. Tables are cached on disk
+by a hash of pitch_constraint.py, the parameters and the grid, and can be
+saved to a file:
+    $ ./pitch_table.py
+    $ ./pitch_table.py -o pitch_table.npz
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from scipy import interpolate
+
+import bicycle_model as bm
+import param_cache
+import pitch_constraint as pc
+
+
+PITCH_TABLE_VERSION = 2 # increment to invalidate cached tables
+LEAN_LIMIT = np.pi/3 # rad, the table covers [-LEAN_LIMIT, LEAN_LIMIT]
+STEER_LIMIT = np.pi/3 # rad, the table covers [-STEER_LIMIT, STEER_LIMIT]
+TABLE_SIZE = 41 # number of grid points per angle
+PITCH_GUESS = bm.STEER_AXIS_TILT # rad, pitch for zero lean and steer
+NEWTON_TOL = 1e-12 # rad, max Newton step at convergence
+NEWTON_MAX_ITER = 50
+ERROR_SUBDIVISIONS = 8 # check points per grid cell and angle
+
+
+def pitch_function(parameters=pc.benchmark_parameters):
+    """Return a NumPy function of (lean, pitch, steer) returning f and df/dθ
+    of the constraint with the given parameters.
+    """
+    _, _, source = pc.load_constraint(parameters)
+    return pc.compile_evaluator(source)
+
+
+def solve_pitch(lean, steer, function, pitch0=PITCH_GUESS, tol=NEWTON_TOL,
+                max_iter=NEWTON_MAX_ITER):
+    """Return the pitch for arrays of lean and steer angles with a Newton
+    iteration on all points at once, points stop iterating when they have
+    converged. function is the constraint of pitch_function(). Raises
+    ValueError if a point does not converge in max_iter iterations.
+    """
+    lean, steer = np.broadcast_arrays(np.asarray(lean, dtype=np.float64),
+                                      np.asarray(steer, dtype=np.float64))
+    pitch = np.full(lean.shape, pitch0, dtype=np.float64)
+    active = np.flatnonzero(np.ones(lean.shape, dtype=bool))
+    lean = lean.ravel()
+    steer = steer.ravel()
+    theta = pitch.reshape(-1) # view of pitch
+    for _ in range(max_iter):
+        l, s, t = lean[active], steer[active], theta[active]
+        f, df = function(l, t, s)
+        step = f/df
+        theta[active] = t - step
+        active = active[~(np.abs(step) <= tol)]
+        if not len(active):
+            return pitch
+    raise ValueError('pitch did not converge for {} of {} points'.format(
+        len(active), theta.size))
+
+
+class PitchTable(object):
+    """Bicubic spline of the pitch over a grid of lean and steer angles. error
+    is the max interpolation error on the check grid of build_table(), an
+    estimate of the error bound of the table.
+    """
+    def __init__(self, leans, steers, pitch, error=np.nan):
+        self.leans = leans
+        self.steers = steers
+        self.pitch = pitch
+        self.error = error
+        self._spline = interpolate.RectBivariateSpline(leans, steers, pitch)
+
+    def __call__(self, lean, steer):
+        """Return the pitch at lean and steer angles, which may be arrays.
+        Raises ValueError outside the table.
+        """
+        lean = np.asarray(lean, dtype=np.float64)
+        steer = np.asarray(steer, dtype=np.float64)
+        if (np.any(np.abs(lean) > self.leans[-1]) or
+            np.any(np.abs(steer) > self.steers[-1])):
+            raise ValueError('angles outside pitch table')
+        return self._spline(lean, steer, grid=False)
+
+    def save(self, path):
+        np.savez(path, leans=self.leans, steers=self.steers, pitch=self.pitch,
+                 error=self.error)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['leans'], f['steers'], f['pitch'], float(f['error']))
+
+
+def build_table(parameters=pc.benchmark_parameters, lean_limit=LEAN_LIMIT,
+                steer_limit=STEER_LIMIT, size=TABLE_SIZE, use_cache=True):
+    """Return a PitchTable of size x size points for the constraint with the
+    given parameters.
+    """
+    leans = np.linspace(-lean_limit, lean_limit, size)
+    steers = np.linspace(-steer_limit, steer_limit, size)
+    key = param_cache.param_hash(
+        PITCH_TABLE_VERSION,
+        param_cache.file_hash(os.path.abspath(pc.__file__)),
+        sorted((str(k), float(v)) for k, v in parameters.items()),
+        leans, steers)
+    if use_cache:
+        cached = param_cache.load('pitch_table', key)
+        if cached is not None:
+            return PitchTable(leans, steers, cached['pitch'],
+                              float(cached['error']))
+
+    function = pitch_function(parameters)
+    pitch = solve_pitch(leans[:, None], steers[None, :], function)
+    table = PitchTable(leans, steers, pitch)
+
+    n = ERROR_SUBDIVISIONS*(size - 1) + 1
+    lean, steer = np.meshgrid(np.linspace(-lean_limit, lean_limit, n),
+                              np.linspace(-steer_limit, steer_limit, n),
+                              indexing='ij')
+    exact = solve_pitch(lean, steer, function)
+    table.error = float(np.abs(table(lean, steer) - exact).max())
+    if use_cache:
+        param_cache.save('pitch_table', key, pitch=pitch,
+                         error=np.array(table.error))
+    return table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=
+        'Build a pitch table of the benchmark bicycle.')
+    parser.add_argument('-n', '--size',
+        help='number of grid points per angle ({})'.format(TABLE_SIZE),
+        default=TABLE_SIZE, type=int)
+    parser.add_argument('-l', '--lean_limit',
+        help='max lean angle in rad ({:.4f})'.format(LEAN_LIMIT),
+        default=LEAN_LIMIT, type=float)
+    parser.add_argument('-s', '--steer_limit',
+        help='max steer angle in rad ({:.4f})'.format(STEER_LIMIT),
+        default=STEER_LIMIT, type=float)
+    parser.add_argument('-o', '--output',
+        help='save the table to this .npz file',
+        default=None)
+    parser.add_argument('--no_cache',
+        help='do not read or write cached tables',
+        action='store_true')
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    table = build_table(lean_limit=args.lean_limit,
+                        steer_limit=args.steer_limit, size=args.size,
+                        use_cache=not args.no_cache)
+    print('{0}x{0} pitch table in {1:.3f} s, max interpolation error '
+          '{2:.3e} rad'.format(args.size, time.perf_counter() - t0,
+                               table.error))
+    print('pitch at zero lean and steer {:.12f} rad, pi/10 = {:.12f}'.format(
+        float(table(0, 0)), np.pi/10))
+    if args.output is not None:
+        table.save(args.output)
+        print('table saved to {}'.format(args.output))
+    sys.exit(0)
@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Discrete-time simulation of the linearized benchmark bicycle.
+
+The continuous system x' = Ax + Bu is discretized with an exact zero-order
+hold once per (speed, step size) and the whole input sequence is propagated
+with the recurrence
+
+    x[i] = Phi(h[i]) x[i - 1] + Gamma(h[i]) u[i],    x[-1] = x0
+
+which is the convention of the RK4 loop of test_simulator.py: sample i is the
+state after applying u[i] for h[i] seconds, with h[0] = h[1].
+
+Runs of samples with the same step size are propagated in modal coordinates,
+where each mode is a first order recursive filter evaluated with
+scipy.signal.lfilter. Short runs, and systems with ill-conditioned
+eigenvectors, are propagated with the cached Phi and Gamma matrices.
+
+simulate_profiles() propagates many torque profiles at once, at one speed or
+at a speed per profile, and spreads large batches over a process pool.
+
+For a varying speed, ScheduledSimulator interpolates Phi and Gamma from a
+SpeedSchedule precomputed over a speed grid instead of discretizing at every
+step.
+
+Run this module to check the results against RK4 and, if python-control is
+installed, lsim:
+    $ ./simulation.py
+"""
+import os
+import sys
+import time
+from concurrent import futures
+
+import numpy as np
+from numpy import linalg as la
+from scipy import linalg as sla
+from scipy import signal as sig
+
+import bicycle_model as bm
+import stability
+
+
+STEP_RESOLUTION = 1e-6 # seconds, step sizes are rounded before caching
+MIN_MODAL_RUN = 16 # min number of samples propagated in modal coordinates
+MAX_MODAL_CONDITION = 1e8 # max eigenvector condition number for modal form
+DISCRETIZATION_CACHE_SIZE = 256 # max number of cached discretizations
+LSIM_UPSAMPLING = 50 # lsim input samples per step in check()
+PROFILE_CHUNK_SIZE = 4096 # max number of torque profiles per process
+SCHEDULE_VMIN = 0.0 # m/s, speed range and step of SpeedSchedule grids
+SCHEDULE_VMAX = 15.0 # m/s
+SCHEDULE_DV = 0.0025 # m/s
+
+
+def step_sizes(t):
+    """Return the step size of each sample at times t, with h[0] = h[1],
+    rounded to STEP_RESOLUTION.
+    """
+    h = np.diff(t)
+    h = np.insert(h, 0, h[0] if len(h) else 0)
+    return np.round(h/STEP_RESOLUTION)*STEP_RESOLUTION
+
+
+def constant_step_runs(h):
+    """Return (start, stop) index pairs of runs with a constant step size."""
+    bounds = np.concatenate(([0], np.flatnonzero(np.diff(h)) + 1, [len(h)]))
+    return zip(bounds[:-1], bounds[1:])
+
+
+class Discretization(object):
+    """Zero-order hold discretization of (A, B) for a step size h, with the
+    modal form of Phi if the eigenvectors of A are well conditioned.
+    """
+    def __init__(self, A, B, h):
+        self.h = h
+        self.Phi, self.Gamma = bm.discretize(A, B, h)
+        w, V = la.eig(A)
+        if la.cond(V) < MAX_MODAL_CONDITION:
+            self.poles = np.exp(w*h) # eigenvalues of Phi
+            self.V = V
+            self.Vinv = la.inv(V)
+            self.modal_Gamma = self.Vinv.dot(self.Gamma)
+        else:
+            self.poles = None
+
+    @property
+    def modal(self):
+        return self.poles is not None
+
+
+class Simulator(object):
+    """Simulate x' = Ax + Bu with cached zero-order hold discretizations."""
+    def __init__(self, A, B):
+        self.A = np.asarray(A, dtype=np.float64)
+        self.B = np.asarray(B, dtype=np.float64).reshape((self.A.shape[0], -1))
+        self._cache = {}
+
+    def discretization(self, h):
+        h = round(h/STEP_RESOLUTION)*STEP_RESOLUTION
+        d = self._cache.get(h)
+        if d is None:
+            if len(self._cache) >= DISCRETIZATION_CACHE_SIZE:
+                self._cache.clear()
+            d = self._cache[h] = Discretization(self.A, self.B, h)
+        return d
+
+    def simulate(self, t, u, x0=None):
+        """Return the states (len(t), n) for inputs u (len(t), m) or (len(t),)
+        at times t.
+        """
+        t = np.asarray(t, dtype=np.float64)
+        u = np.asarray(u, dtype=np.float64).reshape((len(t), -1))
+        n = self.A.shape[0]
+        x = np.empty((len(t), n))
+        if len(t) == 0:
+            return x
+        h = step_sizes(t)
+        xi = np.zeros(n) if x0 is None else np.asarray(x0, dtype=np.float64)
+        for start, stop in constant_step_runs(h):
+            d = self.discretization(h[start])
+            if d.modal and stop - start >= MIN_MODAL_RUN:
+                self._propagate_modal(d, u[start:stop], xi, x[start:stop])
+            else:
+                self._propagate(d, u[start:stop], xi, x[start:stop])
+            xi = x[stop - 1]
+        return x
+
+    @staticmethod
+    def _propagate(d, u, x0, x):
+        Phi = d.Phi
+        Gu = u.dot(d.Gamma.T)
+        xi = x0
+        for i in range(len(u)):
+            xi = Phi.dot(xi) + Gu[i]
+            x[i] = xi
+
+    @staticmethod
+    def _propagate_modal(d, u, x0, x):
+        # modal coordinates z = V^-1 x, z[i] = p z[i - 1] + V^-1 Gamma u[i]
+        Gu = u.dot(d.modal_Gamma.T)
+        z0 = d.Vinv.dot(x0)
+        z = np.empty(Gu.shape, dtype=np.complex128)
+        for k, p in enumerate(d.poles):
+            z[:, k], _ = sig.lfilter([1], [1, -p], Gu[:, k], zi=[p*z0[k]])
+        x[:] = z.dot(d.V.T).real
+
+
+def bicycle_simulator(v, g=bm.G):
+    """Return a Simulator of the benchmark bicycle at speed v."""
+    A, B = bm.state_matrices(v, g)
+    return Simulator(A, B)
+
+
+def discretize_speeds(v, h, g=bm.G):
+    """Return the zero-order hold discretizations Phi (n, 4, 4) and Gamma
+    (n, 4) of the benchmark bicycle at n speeds v for step size h.
+    """
+    A = stability.state_matrices(v, g=g)
+    _, B = bm.state_matrices(0, g)
+    F = np.zeros((A.shape[0], 5, 5))
+    F[:, :4, :4] = A
+    F[:, :4, 4:] = B
+    E = sla.expm(F*h)
+    return E[:, :4, :4], E[:, :4, 4]
+
+
+class SpeedSchedule(object):
+    """Matrices precomputed over a uniform speed grid from vmin to vmax with
+    step dv and linearly interpolated, so a lookup costs the same at any
+    speed. matrices(v) returns the stacked matrices (n, ...) at n speeds.
+    """
+    def __init__(self, matrices, vmin=SCHEDULE_VMIN, vmax=SCHEDULE_VMAX,
+                 dv=SCHEDULE_DV):
+        n = int(round((vmax - vmin)/dv)) + 1
+        self.vmin = vmin
+        self.vmax = vmax
+        self.speeds = np.linspace(vmin, vmax, n)
+        self.dv = self.speeds[1] - self.speeds[0]
+        self.values = np.asarray(matrices(self.speeds))
+        self.slopes = np.diff(self.values, axis=0)
+
+    def covers(self, v):
+        return self.vmin <= v <= self.vmax
+
+    def __call__(self, v):
+        """Return the matrices at speed v, or stacked (n, ...) at an array of
+        n speeds. Raises ValueError for speeds outside the grid.
+        """
+        if np.ndim(v) == 0:
+            if not self.covers(v):
+                raise ValueError('speed {} outside schedule range [{}, '
+                                 '{}]'.format(v, self.vmin, self.vmax))
+            s = (v - self.vmin)/self.dv
+            i = min(int(s), len(self.slopes) - 1)
+            return self.values[i] + (s - i)*self.slopes[i]
+        v = np.asarray(v, dtype=np.float64)
+        if np.any((v < self.vmin) | (v > self.vmax)):
+            raise ValueError('speeds outside schedule range [{}, {}]'.format(
+                self.vmin, self.vmax))
+        s = (v - self.vmin)/self.dv
+        i = np.minimum(s.astype(int), len(self.slopes) - 1)
+        f = (s - i).reshape(v.shape + (1,)*(self.values.ndim - 1))
+        return self.values[i] + f*self.slopes[i]
+
+    def error(self, matrices):
+        """Return the max absolute interpolation error, evaluated with
+        matrices() at the midpoints of the grid.
+        """
+        mid = self.speeds[:-1] + self.dv/2
+        return np.abs(self(mid) - np.asarray(matrices(mid))).max()
+
+
+def discretization_schedule(h, g=bm.G, vmin=SCHEDULE_VMIN,
+                            vmax=SCHEDULE_VMAX, dv=SCHEDULE_DV):
+    """Return a SpeedSchedule of the matrices [Phi Gamma] (4, 5) of the
+    benchmark bicycle for step size h.
+    """
+    def matrices(v):
+        Phi, Gamma = discretize_speeds(v, h, g)
+        return np.concatenate((Phi, Gamma[:, :, None]), axis=2)
+    return SpeedSchedule(matrices, vmin, vmax, dv)
+
+
+class ScheduledSimulator(object):
+    """Simulate the benchmark bicycle at a varying speed, with discretizations
+    interpolated from a SpeedSchedule per step size.
+    """
+    def __init__(self, g=bm.G, vmin=SCHEDULE_VMIN, vmax=SCHEDULE_VMAX,
+                 dv=SCHEDULE_DV):
+        self.g = g
+        self.vmin = vmin
+        self.vmax = vmax
+        self.dv = dv
+        self._cache = {}
+
+    def schedule(self, h):
+        h = round(h/STEP_RESOLUTION)*STEP_RESOLUTION
+        s = self._cache.get(h)
+        if s is None:
+            if len(self._cache) >= DISCRETIZATION_CACHE_SIZE:
+                self._cache.clear()
+            s = self._cache[h] = discretization_schedule(
+                h, self.g, self.vmin, self.vmax, self.dv)
+        return s
+
+    def simulate(self, t, u, v, x0=None):
+        """Return the states (len(t), 4) for inputs u (len(t),) at times t and
+        speeds v (len(t),), with the sample convention of Simulator.simulate:
+        sample i is the state after applying u[i] at speed v[i] for h[i]
+        seconds.
+        """
+        t = np.asarray(t, dtype=np.float64)
+        u = np.asarray(u, dtype=np.float64).reshape(len(t))
+        v = np.broadcast_to(np.asarray(v, dtype=np.float64), (len(t),))
+        x = np.empty((len(t), 4))
+        if len(t) == 0:
+            return x
+        h = step_sizes(t)
+        xi = np.zeros(4) if x0 is None else np.asarray(x0, dtype=np.float64)
+        for start, stop in constant_step_runs(h):
+            E = self.schedule(h[start])(v[start:stop])
+            Phi = E[:, :, :4]
+            Gu = E[:, :, 4]*u[start:stop, None]
+            for i in range(stop - start):
+                xi = Phi[i].dot(xi) + Gu[i]
+                x[start + i] = xi
+        return x
+
+
+def simulate_profiles(t, torque, v, x0=None, g=bm.G, processes=None,
+                      chunk_size=PROFILE_CHUNK_SIZE):
+    """Simulate the benchmark bicycle for n torque profiles (n, len(t)) at
+    times t, at a speed v or at speeds v (n,), from initial states x0 (4,) or
+    (n, 4), zero if None. Returns the states (n, len(t), 4) in the order
+    bm.STATES, with the sample convention of Simulator.simulate.
+
+    All profiles are propagated together, the states are stored time major
+    and the returned array is a transposed view. More than chunk_size
+    profiles are split into chunks simulated in a pool of processes, by
+    default one per CPU.
+    """
+    t = np.asarray(t, dtype=np.float64)
+    torque = np.atleast_2d(np.asarray(torque, dtype=np.float64))
+    n = torque.shape[0]
+    if torque.shape[1] != len(t):
+        raise ValueError('torque profiles have {} samples, expected {}'.format(
+            torque.shape[1], len(t)))
+    v = np.broadcast_to(np.asarray(v, dtype=np.float64), (n,))
+    if x0 is None:
+        x0 = np.zeros(4)
+    x0 = np.broadcast_to(np.asarray(x0, dtype=np.float64), (n, 4))
+    if processes is None:
+        processes = os.cpu_count() or 1
+
+    if processes == 1 or n <= chunk_size:
+        x = _simulate_profiles(t, torque, v, x0, g)
+    else:
+        x = np.empty((len(t), n, 4))
+        with futures.ProcessPoolExecutor(processes) as pool:
+            chunks = {pool.submit(_simulate_profiles, t,
+                                  torque[i:i + chunk_size],
+                                  v[i:i + chunk_size],
+                                  x0[i:i + chunk_size], g): i
+                      for i in range(0, n, chunk_size)}
+            for f in futures.as_completed(chunks):
+                i = chunks[f]
+                x[:, i:i + chunk_size] = f.result()
+    return x.transpose(1, 0, 2)
+
+
+def _simulate_profiles(t, torque, v, x0, g):
+    # returns the time major states (len(t), n, 4)
+    x = np.empty((len(t), torque.shape[0], 4))
+    if len(t) == 0:
+        return x
+    u = np.ascontiguousarray(torque.T)
+    h = step_sizes(t)
+    speeds, profile_speed = np.unique(v, return_inverse=True)
+    if len(speeds) == 1:
+        sim = bicycle_simulator(speeds[0], g)
+    xi = x0
+    for start, stop in constant_step_runs(h):
+        if len(speeds) == 1:
+            d = sim.discretization(h[start])
+            Phi, Gamma = d.Phi, d.Gamma[:, 0]
+        else:
+            Phi, Gamma = discretize_speeds(speeds, h[start], g)
+            Phi, Gamma = Phi[profile_speed], Gamma[profile_speed]
+        _propagate_profiles(Phi, Gamma, u[start:stop], xi, x[start:stop])
+        xi = x[stop - 1]
+    return x
+
+
+def _propagate_profiles(Phi, Gamma, u, x0, x):
+    # x[i] = Phi x[i - 1] + Gamma u[i] for all profiles at once, with a
+    # matrix Phi (4, 4) for all profiles or one per profile (n, 4, 4)
+    PhiT = Phi.T
+    xi = x0
+    for i in range(len(u)):
+        if Phi.ndim == 2:
+            np.dot(xi, PhiT, out=x[i])
+        else:
+            np.einsum('nij,nj->ni', Phi, xi, out=x[i])
+        x[i] += Gamma*u[i, :, None]
+        xi = x[i]
+
+
+def rungekutta4(f, y0, t0, h, u=0):
+    k1 = f(t0, y0, u)
+    k2 = f(t0 + h/2, y0 + h/2*k1, u)
+    k3 = f(t0 + h/2, y0 + h/2*k2, u)
+    k4 = f(t0 + h, y0 + h*k3, u)
+    return y0 + h/6*(k1 + 2*k2 + 2*k3 + k4)
+
+
+def simulate_rk4(A, B, t, u):
+    """Reference RK4 integration with the step convention of Simulator. A is
+    a state matrix or a state matrix per sample (len(t), n, n).
+    """
+    A = np.asarray(A)
+    n = A.shape[-1]
+    B = np.asarray(B).reshape((n, -1))
+    u = np.asarray(u, dtype=np.float64).reshape((len(t), -1))
+    x = np.zeros((len(t), n))
+    h = np.diff(t)
+    h = np.insert(h, 0, h[0])
+    y = np.zeros(n)
+    for i, (ti, hi, ui) in enumerate(zip(t, h, u)):
+        Ai = A[i] if A.ndim == 3 else A
+        f = lambda t, y, u: Ai.dot(y) + B.dot(u)
+        y = rungekutta4(f, y, ti, hi, ui)
+        x[i] = y
+    return x
+
+
+def relative_error(x, x_ref):
+    """Return the max absolute error relative to the max absolute value of
+    the reference.
+    """
+    return np.abs(x - x_ref).max()/np.abs(x_ref).max()
+
+
+def check(v=4.0, duration=10.0, h=0.02, jitter=0.0, seed=0):
+    """Compare Simulator with RK4 and, if available, lsim for a random
+    torque sequence and print the relative state errors and run times.
+    Sample times are rounded to milliseconds, as in the simulator test files,
+    after adding a uniform jitter of +-jitter*h.
+    """
+    rng = np.random.RandomState(seed)
+    n = int(duration/h)
+    t = np.round(np.cumsum(h + jitter*h*rng.uniform(-1, 1, n)), 3)
+    u = np.convolve(rng.normal(0, 1, n), np.ones(10)/10, 'same')
+    A, B = bm.state_matrices(v)
+
+    t0 = time.perf_counter()
+    x = Simulator(A, B).simulate(t, u)
+    t_zoh = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    x_rk4 = simulate_rk4(A, B, t, u)
+    t_rk4 = time.perf_counter() - t0
+    print('v = {} m/s, {} samples, h = {} s, jitter = {}'.format(
+        v, n, h, jitter))
+    print('  zoh {:.4f} s, rk4 {:.4f} s, relative error rk4 {:.3e}'.format(
+        t_zoh, t_rk4, relative_error(x, x_rk4)))
+    try:
+        import control as ctrl
+    except ImportError:
+        print('  python-control not installed, lsim comparison skipped')
+        return
+    # lsim interpolates the input linearly between samples, so the zero-order
+    # hold input is upsampled for the interpolation error to be negligible
+    ss = ctrl.ss(A, B, np.eye(A.shape[0]), 0)
+    h = np.diff(t)
+    tt = np.insert(t, 0, t[0] - h[0]) # u[i] is applied from tt[i] to tt[i + 1]
+    k = np.arange(LSIM_UPSAMPLING)/LSIM_UPSAMPLING
+    fine = np.append((tt[:-1, None] + k*np.diff(tt)[:, None]).ravel(), tt[-1])
+    uf = np.append(np.repeat(u, LSIM_UPSAMPLING), u[-1])
+    _, _, x_lsim = ctrl.matlab.lsim(ss, uf, fine - fine[0])
+    x_lsim = np.asarray(x_lsim)[LSIM_UPSAMPLING::LSIM_UPSAMPLING]
+    print('  relative error lsim {:.3e}'.format(relative_error(x, x_lsim)))
+
+
+def check_schedule(h=0.02, duration=60.0, seed=0):
+    """Print the build time and interpolation error of a discretization
+    schedule and compare ScheduledSimulator with RK4 for a random torque
+    sequence while the speed ramps over the schedule range.
+    """
+    rng = np.random.RandomState(seed)
+    n = int(duration/h)
+    t = np.arange(1, n + 1)*h
+    u = np.convolve(rng.normal(0, 1, n), np.ones(10)/10, 'same')
+    v = np.linspace(SCHEDULE_VMIN + 1, SCHEDULE_VMAX - 1, n)
+
+    sim = ScheduledSimulator()
+    t0 = time.perf_counter()
+    schedule = sim.schedule(h)
+    t_build = time.perf_counter() - t0
+    error = schedule.error(lambda v: discretization_schedule(
+        h, vmin=v[0], vmax=v[-1], dv=v[1] - v[0]).values)
+    t0 = time.perf_counter()
+    x = sim.simulate(t, u, v)
+    t_sim = time.perf_counter() - t0
+    _, B = bm.state_matrices(0)
+    x_rk4 = simulate_rk4(stability.state_matrices(v), B, t, u)
+    print('schedule h = {} s, {} speeds, built in {:.4f} s, max '
+          'interpolation error {:.3e}'.format(h, len(schedule.speeds),
+                                             t_build, error))
+    print('  {} samples, v from {} to {} m/s, {:.2f} us/step, relative error '
+          'rk4 {:.3e}'.format(n, v[0], v[-1], t_sim/n*1e6,
+                              relative_error(x, x_rk4)))
+
+
+if __name__ == "__main__":
+    for v in (2.0, 4.0, 6.0):
+        check(v)
+    check(4.0, jitter=0.1)
+    check(4.0, duration=1000.0)
+    check_schedule()
+    sys.exit(0)
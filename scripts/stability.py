@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Eigenvalue and stability analysis of the benchmark bicycle over speed.
+
+The state matrix A(v) is built for all speeds at once as a stacked (n, 4, 4)
+array using its linear structure in v, with M^-1 C1, M^-1 K0 and M^-1 K2
+computed once. Eigenvalues are computed with a single batched
+np.linalg.eigvals call. The weave speed is where an oscillatory mode becomes
+stable and the capsize speed is where a real mode becomes unstable, the
+self-stable speed range lies between them. Results are cached on disk by a
+hash of the model parameters and the speed grid:
+    $ ./stability.py
+    $ ./stability.py --vmin 0 --vmax 10 -n 10001 --plot
+"""
+import argparse
+import sys
+
+import numpy as np
+from numpy import linalg as la
+from scipy import optimize
+
+import bicycle_model as bm
+import param_cache
+
+
+STABILITY_VERSION = 1 # increment to invalidate cached results
+DEFAULT_VMIN = 0.0 # m/s
+DEFAULT_VMAX = 10.0 # m/s
+DEFAULT_NUM_SPEEDS = 10001
+BOUNDARY_XTOL = 1e-12 # m/s, tolerance of refined stability boundaries
+OSCILLATORY_IMAG = 1e-9 # rad/s, min imaginary part of an oscillatory mode
+
+
+def state_matrices(v, M=bm.M, C1=bm.C1, K0=bm.K0, K2=bm.K2, g=bm.G):
+    """Return the state matrices A(v) for an array of n speeds as an (n, 4, 4)
+    array. The state is [leanrate, steerrate, lean, steer].
+    """
+    v = np.asarray(v, dtype=np.float64).reshape(-1, 1, 1)
+    MC1 = la.solve(M, C1)
+    MK0 = la.solve(M, K0)
+    MK2 = la.solve(M, K2)
+    A = np.zeros((v.shape[0], 4, 4))
+    A[:, :2, :2] = -v*MC1
+    A[:, :2, 2:] = -(g*MK0 + v*v*MK2)
+    A[:, 2, 0] = 1
+    A[:, 3, 1] = 1
+    return A
+
+
+def eigenvalues(v, *params):
+    """Return the eigenvalues (n, 4) of A(v) for an array of n speeds, sorted
+    by decreasing real part.
+    """
+    w = la.eigvals(state_matrices(v, *params))
+    i = np.argsort(-w.real, axis=1, kind='stable')
+    return np.take_along_axis(w, i, axis=1)
+
+
+class StabilityResult(object):
+    """Eigenvalues over a speed grid and the stability boundaries.
+
+    boundaries is a list of (speed, kind, stable above) tuples, kind is
+    'weave' for a complex pair or 'capsize' for a real eigenvalue crossing
+    the imaginary axis.
+    """
+    def __init__(self, speeds, eigenvalues, boundaries):
+        self.speeds = speeds
+        self.eigenvalues = eigenvalues
+        self.boundaries = boundaries
+
+    @property
+    def stable(self):
+        """Boolean array, True at speeds where all eigenvalues have negative
+        real parts.
+        """
+        return self.eigenvalues.real.max(axis=1) < 0
+
+    @property
+    def weave_speed(self):
+        return self._boundary('weave', True)
+
+    @property
+    def capsize_speed(self):
+        return self._boundary('capsize', False)
+
+    @property
+    def stable_ranges(self):
+        """List of (min speed, max speed) ranges of self-stability within the
+        speed grid.
+        """
+        ranges = []
+        lower = self.speeds[0] if self.stable[0] else None
+        for v, _, stable_above in self.boundaries:
+            if stable_above:
+                lower = v
+            elif lower is not None:
+                ranges.append((lower, v))
+                lower = None
+        if lower is not None:
+            ranges.append((lower, self.speeds[-1]))
+        return ranges
+
+    def _boundary(self, kind, stable_above):
+        for v, k, s in self.boundaries:
+            if k == kind and s == stable_above:
+                return v
+        return None
+
+
+def _max_real(v, params):
+    return eigenvalues([v], *params)[0, 0].real
+
+
+def find_boundaries(speeds, w, *params):
+    """Return the stability boundaries in a speed grid with eigenvalues w
+    (n, 4), refined with Brent's method.
+    """
+    max_real = w[:, 0].real
+    boundaries = []
+    for i in np.flatnonzero(np.diff(np.sign(max_real))):
+        lo, hi = speeds[i], speeds[i + 1]
+        if max_real[i] == 0:
+            v = lo
+        elif max_real[i + 1] == 0:
+            continue # boundary is handled as the lower point of the next pair
+        else:
+            v = optimize.brentq(_max_real, lo, hi, args=(params,),
+                                xtol=BOUNDARY_XTOL)
+        # the eigenvalue crossing zero is the one with the smallest real part
+        # magnitude between the grid points
+        wv = eigenvalues([v], *params)[0]
+        crossing = wv[np.argmin(np.abs(wv.real))]
+        kind = 'weave' if abs(crossing.imag) > OSCILLATORY_IMAG else 'capsize'
+        boundaries.append((v, kind, bool(max_real[i + 1] < 0)))
+    return boundaries
+
+
+def analyze(speeds=None, M=bm.M, C1=bm.C1, K0=bm.K0, K2=bm.K2, g=bm.G,
+            use_cache=True):
+    """Return a StabilityResult for a speed grid (default DEFAULT_NUM_SPEEDS
+    speeds from DEFAULT_VMIN to DEFAULT_VMAX).
+    """
+    if speeds is None:
+        speeds = np.linspace(DEFAULT_VMIN, DEFAULT_VMAX, DEFAULT_NUM_SPEEDS)
+    speeds = np.asarray(speeds, dtype=np.float64)
+    params = (M, C1, K0, K2, g)
+    key = param_cache.param_hash(STABILITY_VERSION, speeds, *params)
+    if use_cache:
+        cached = param_cache.load('stability', key)
+        if cached is not None:
+            boundaries = [(float(v), str(k), bool(s)) for v, k, s in
+                          zip(cached['boundary_speeds'],
+                              cached['boundary_kinds'],
+                              cached['boundary_stable_above'])]
+            return StabilityResult(speeds, cached['eigenvalues'], boundaries)
+
+    w = eigenvalues(speeds, *params)
+    boundaries = find_boundaries(speeds, w, *params)
+    if use_cache:
+        param_cache.save('stability', key, eigenvalues=w,
+                         boundary_speeds=np.array([b[0] for b in boundaries]),
+                         boundary_kinds=np.array([b[1] for b in boundaries]),
+                         boundary_stable_above=np.array(
+                             [b[2] for b in boundaries], dtype=bool))
+    return StabilityResult(speeds, w, boundaries)
+
+
+def plot_eigenvalues(result):
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots()
+    v = result.speeds
+    w = result.eigenvalues
+    for i in range(w.shape[1]):
+        ax.plot(v, w[:, i].real, 'k.', markersize=1)
+        ax.plot(v, np.abs(w[:, i].imag), 'b.', markersize=1)
+    for lo, hi in result.stable_ranges:
+        ax.axvspan(lo, hi, color='g', alpha=0.1)
+    ax.axhline(0, color='k', linewidth=0.5)
+    ax.set_xlabel('speed [m/s]')
+    ax.set_ylabel('eigenvalue real part (black), |imaginary part| (blue)')
+    ax.set_ylim([-10, 10])
+    return fig
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=
+        'Eigenvalue and stability analysis of the benchmark bicycle.')
+    parser.add_argument('--vmin',
+        help='min speed in m/s ({})'.format(DEFAULT_VMIN),
+        default=DEFAULT_VMIN, type=float)
+    parser.add_argument('--vmax',
+        help='max speed in m/s ({})'.format(DEFAULT_VMAX),
+        default=DEFAULT_VMAX, type=float)
+    parser.add_argument('-n', '--num_speeds',
+        help='number of speeds ({})'.format(DEFAULT_NUM_SPEEDS),
+        default=DEFAULT_NUM_SPEEDS, type=int)
+    parser.add_argument('--no_cache',
+        help='do not read or write cached results',
+        action='store_true')
+    parser.add_argument('--plot',
+        help='plot eigenvalues over speed',
+        action='store_true')
+    args = parser.parse_args()
+
+    speeds = np.linspace(args.vmin, args.vmax, args.num_speeds)
+    result = analyze(speeds, use_cache=not args.no_cache)
+    for v, kind, stable_above in result.boundaries:
+        print('{:>8} speed {:.6f} m/s, {} above'.format(
+            kind, v, 'stable' if stable_above else 'unstable'))
+    for lo, hi in result.stable_ranges:
+        print('self-stable from {:.6f} to {:.6f} m/s'.format(lo, hi))
+    if args.plot:
+        import matplotlib.pyplot as plt
+        plot_eigenvalues(result)
+        plt.show()
+    sys.exit(0)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Regression test of Unity3d bicycle simulator traces against the Python model.
+
+Each trace is read with unity_trace, its torque input is simulated with the
+linearized benchmark bicycle at the speed of the trace and the per-state max
+and RMS errors of the recorded states are compared with tolerances. Traces
+with a varying wheel rate are simulated with the state matrix of each sample
+(rk4) or a speed scheduled discretization (zoh). Traces are spread over a
+pool of processes and the results are printed as a table or as JSON. The
+exit status is 1 if a trace fails or cannot be read or simulated:
+    $ ./trace_regression.py ../bikesim/data
+    $ ./trace_regression.py --json --max_error 1e-6 traces/*.txt
+
+The Unity simulator integrates with RK4, so traces are simulated with RK4 by
+default; --method zoh uses the exact discretization of simulation.py.
+"""
+import argparse
+import functools
+import glob
+import json
+import os
+import sys
+from concurrent import futures
+
+import numpy as np
+
+import bicycle_model as bm
+import simulation
+import stability
+import unity_trace
+
+
+DEFAULT_PATTERN = 'test_*.txt'
+DEFAULT_METHOD = 'rk4'
+METHODS = ('rk4', 'zoh')
+DEFAULT_MAX_ERROR = 1e-5 # max absolute state error, rad or rad/s
+DEFAULT_RMS_ERROR = 1e-6 # max RMS state error, rad or rad/s
+TRACES_PER_TASK = 4 # traces per process pool task
+
+
+def trace_paths(paths, pattern=DEFAULT_PATTERN):
+    """Return the files in paths, with directories expanded to the files
+    matching pattern in them, in sorted order.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(f for f in glob.glob(os.path.join(path, pattern))
+                                if os.path.isfile(f)))
+        else:
+            files.append(path)
+    return files
+
+
+def compare_trace(path, method=DEFAULT_METHOD):
+    """Simulate a trace and return a dict with the path, number of samples,
+    speed and the max and RMS error of each state, or the path and an error
+    message if the trace cannot be read or simulated.
+    """
+    try:
+        d = unity_trace.read_trace(path, constant_wheelrate=False)
+        state_idx = [d.map[s] for s in bm.STATES]
+    except KeyError as e:
+        return {'path': path, 'error': '{}: state {} missing'.format(path, e)}
+    except (OSError, ValueError) as e:
+        return {'path': path, 'error': str(e)}
+    t = d.data[:, d.map[unity_trace.TIME_FIELD]]
+    u = d.data[:, d.map[unity_trace.STEERTORQUE_FIELD]]
+    x = d.data[:, state_idx]
+    A, B = bm.state_matrices(d.v, d.g)
+    if d.constant_speed:
+        if method == 'rk4':
+            x_model = simulation.simulate_rk4(A, B, t, u)
+        else:
+            x_model = simulation.Simulator(A, B).simulate(t, u)
+    else:
+        v = d.speeds
+        if method == 'rk4':
+            x_model = simulation.simulate_rk4(
+                stability.state_matrices(v, g=d.g), B, t, u)
+        else:
+            try:
+                x_model = simulation.ScheduledSimulator(d.g).simulate(t, u, v)
+            except ValueError as e: # speed outside the schedule
+                return {'path': path, 'error': '{}: {}'.format(path, e)}
+    e = x_model - x
+    return {
+        'path': path,
+        'samples': len(t),
+        'speed': d.v,
+        'max_error': dict(zip(bm.STATES, np.abs(e).max(axis=0).tolist())),
+        'rms_error': dict(zip(bm.STATES,
+                              np.sqrt((e*e).mean(axis=0)).tolist())),
+    }
+
+
+def check(result, max_error=DEFAULT_MAX_ERROR, rms_error=DEFAULT_RMS_ERROR):
+    """Add the pass/fail results of each state and of the trace to a result
+    of compare_trace() and return it.
+    """
+    if 'error' in result:
+        result['passed'] = False
+        return result
+    result['state_passed'] = {
+        s: (result['max_error'][s] <= max_error and
+            result['rms_error'][s] <= rms_error) for s in bm.STATES}
+    result['passed'] = all(result['state_passed'].values())
+    return result
+
+
+def run(paths, method=DEFAULT_METHOD, processes=None):
+    """Return the compare_trace() results of paths, in order. Traces are
+    compared in a pool of processes, by default one per CPU.
+    """
+    compare = functools.partial(compare_trace, method=method)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes == 1 or len(paths) <= 1:
+        return [compare(p) for p in paths]
+    with futures.ProcessPoolExecutor(processes) as pool:
+        return list(pool.map(compare, paths, chunksize=TRACES_PER_TASK))
+
+
+def format_table(results):
+    width = max([len('trace')] +
+                [len(os.path.basename(r['path'])) for r in results])
+    lines = ['{:<{w}}  {:>7}  {:>8}  {:<9}  {:>10}  {:>10}  {}'.format(
+        'trace', 'samples', 'v [m/s]', 'state', 'max error', 'rms error',
+        'result', w=width)]
+    for r in results:
+        name = os.path.basename(r['path'])
+        if 'error' in r:
+            lines.append('{:<{w}}  error: {}'.format(name, r['error'],
+                                                     w=width))
+            continue
+        for i, s in enumerate(bm.STATES):
+            lines.append('{:<{w}}  {:>7}  {:>8}  {:<9}  {:>10.3e}  {:>10.3e}  '
+                         '{}'.format(
+                             name if i == 0 else '',
+                             r['samples'] if i == 0 else '',
+                             '{:.4f}'.format(r['speed']) if i == 0 else '',
+                             s, r['max_error'][s], r['rms_error'][s],
+                             'pass' if r['state_passed'][s] else 'FAIL',
+                             w=width))
+    failed = sum(not r['passed'] for r in results)
+    lines.append('{} traces, {} passed, {} failed'.format(
+        len(results), len(results) - failed, failed))
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=
+        'Compare Unity3d bicycle simulator traces with the Python model.')
+    parser.add_argument('paths', nargs='+',
+        help='trace files or directories of trace files')
+    parser.add_argument('-g', '--glob',
+        help='pattern of trace files in directories ({})'.format(
+            DEFAULT_PATTERN),
+        default=DEFAULT_PATTERN)
+    parser.add_argument('-m', '--method',
+        help='integration method of the model ({})'.format(DEFAULT_METHOD),
+        default=DEFAULT_METHOD, choices=METHODS)
+    parser.add_argument('--max_error',
+        help='max absolute state error ({})'.format(DEFAULT_MAX_ERROR),
+        default=DEFAULT_MAX_ERROR, type=float)
+    parser.add_argument('--rms_error',
+        help='max RMS state error ({})'.format(DEFAULT_RMS_ERROR),
+        default=DEFAULT_RMS_ERROR, type=float)
+    parser.add_argument('-j', '--processes',
+        help='number of worker processes (number of CPUs)',
+        default=None, type=int)
+    parser.add_argument('--json',
+        help='print the results as JSON',
+        action='store_true')
+    args = parser.parse_args()
+
+    paths = trace_paths(args.paths, args.glob)
+    if not paths:
+        print('no trace files found')
+        sys.exit(1)
+    results = [check(r, args.max_error, args.rms_error)
+               for r in run(paths, args.method, args.processes)]
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        print(format_table(results))
+    sys.exit(0 if all(r['passed'] for r in results) else 1)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Reader for test trace files of the Unity3d bicycle simulator.
+
+A trace is a whitespace separated table with a header line of field names,
+e.g. bikesim/data/test_torque_pulse.txt:
+    time    wheelrate    steertorque    leanrate    steerrate    lean    steer
+
+Only the samples from the start of the torque disturbance, the first sample
+with a nonzero steer torque, are kept and the time is shifted to start at
+zero there. By default the wheel rate must be constant from that sample on,
+traces with a varying wheel rate are read with constant_wheelrate=False.
+
+The file is parsed in chunks of at most chunk_rows lines, so TraceReader
+iterates over traces of any size in bounded memory:
+    $ ./unity_trace.py ../bikesim/data/test_torque_pulse.txt
+"""
+import argparse
+import itertools
+import sys
+import time
+import warnings
+
+import numpy as np
+
+import bicycle_model as bm
+
+
+CHUNK_ROWS = 65536 # max number of lines parsed at once
+TIME_FIELD = 'time'
+WHEELRATE_FIELD = 'wheelrate'
+STEERTORQUE_FIELD = 'steertorque'
+
+
+class SimData(object):
+    radius = bm.REAR_RADIUS
+
+    def __init__(self, omega, field_map, data):
+        self.g = bm.G
+        self.v = -omega*self.radius # speed at the start of the disturbance
+        self.map = field_map
+        self.data = data
+
+    @property
+    def speeds(self):
+        """Speed of each sample."""
+        return bm.speed(self.data[:, self.map[WHEELRATE_FIELD]])
+
+    @property
+    def constant_speed(self):
+        return bool(np.all(self.data[:, self.map[WHEELRATE_FIELD]] ==
+                           self.data[0, self.map[WHEELRATE_FIELD]]))
+
+
+class TraceReader(object):
+    """Iterate over the samples of a trace file in chunks (rows, columns),
+    starting at the torque disturbance. The header is read on construction,
+    start_time and omega are set when the disturbance is found.
+
+    Raises ValueError if the file has no header, if the header lacks a
+    required field, if the number of columns is inconsistent or, if
+    constant_wheelrate is set, if the wheel rate changes after the
+    disturbance.
+    """
+    def __init__(self, path, chunk_rows=CHUNK_ROWS, constant_wheelrate=True):
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.constant_wheelrate = constant_wheelrate
+        self.start_time = None
+        self.omega = None # wheel rate (forward speed) at the disturbance
+        self._file = open(path)
+        self._line = 0 # number of lines read
+        try:
+            self.fields = self._read_header()
+            self.field_map = {f: i for i, f in enumerate(self.fields)}
+            for field in (TIME_FIELD, WHEELRATE_FIELD, STEERTORQUE_FIELD):
+                if field not in self.field_map:
+                    raise ValueError('{}: field {} missing from header'.format(
+                        path, field))
+        except BaseException:
+            self._file.close()
+            raise
+        self._time = self.field_map[TIME_FIELD]
+        self._wheelrate = self.field_map[WHEELRATE_FIELD]
+        self._steertorque = self.field_map[STEERTORQUE_FIELD]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def __iter__(self):
+        while True:
+            first_line = self._line + 1
+            lines = list(itertools.islice(self._file, self.chunk_rows))
+            if not lines:
+                return
+            self._line += len(lines)
+            chunk = self._parse(lines, first_line)
+            if chunk is None:
+                continue
+            if self.start_time is None:
+                disturbance = np.flatnonzero(chunk[:, self._steertorque])
+                if not len(disturbance):
+                    continue
+                chunk = chunk[disturbance[0]:]
+                self.start_time = chunk[0, self._time]
+                self.omega = chunk[0, self._wheelrate]
+            if self.constant_wheelrate:
+                changed = np.flatnonzero(chunk[:, self._wheelrate] !=
+                                         self.omega)
+                if len(changed):
+                    raise ValueError('{}: wheel rate is inconsistent at time '
+                                     '{}'.format(self.path,
+                                                 chunk[changed[0],
+                                                       self._time]))
+            chunk[:, self._time] -= self.start_time
+            yield chunk
+
+    def _read_header(self):
+        for line in self._file:
+            self._line += 1
+            words = line.split()
+            if not words:
+                continue
+            try:
+                [float(w) for w in words]
+            except ValueError:
+                return words
+            raise ValueError('{}: line {} precedes the header'.format(
+                self.path, self._line))
+        raise ValueError('{}: header not found'.format(self.path))
+
+    def _parse(self, lines, first_line):
+        # Returns the parsed lines (rows, columns) or None if all are blank.
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning) # blank chunk
+            try:
+                chunk = np.loadtxt(lines, ndmin=2)
+            except ValueError as e:
+                raise ValueError('{}: chunk starting at line {}: {}'.format(
+                    self.path, first_line, e))
+        if not chunk.size:
+            return None
+        if chunk.shape[1] != len(self.fields):
+            raise ValueError('{}: number of columns is inconsistent with the '
+                             'header in the chunk starting at line {}'.format(
+                                 self.path, first_line))
+        return chunk
+
+
+def read_trace(path, chunk_rows=CHUNK_ROWS, constant_wheelrate=True):
+    """Return the SimData of a trace file from the torque disturbance on.
+    Raises ValueError if the trace is invalid or has no torque disturbance.
+    """
+    with TraceReader(path, chunk_rows, constant_wheelrate) as reader:
+        chunks = list(reader)
+        if reader.start_time is None:
+            raise ValueError('{}: no torque disturbance'.format(path))
+        return SimData(reader.omega, reader.field_map, np.concatenate(chunks))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=
+        'Read Unity3d bicycle simulator test traces.')
+    parser.add_argument('paths', nargs='+', help='trace files')
+    parser.add_argument('-c', '--chunk_rows',
+        help='max number of lines parsed at once ({})'.format(CHUNK_ROWS),
+        default=CHUNK_ROWS, type=int)
+    parser.add_argument('-w', '--varying_wheelrate',
+        help='accept traces with a varying wheel rate',
+        action='store_true')
+    args = parser.parse_args()
+
+    status = 0
+    for path in args.paths:
+        t0 = time.perf_counter()
+        try:
+            d = read_trace(path, args.chunk_rows, not args.varying_wheelrate)
+        except (OSError, ValueError) as e:
+            print(e)
+            status = 1
+            continue
+        print('{}: {} samples, {} fields, v = {:.4f} m/s, read in {:.3f} '
+              's'.format(path, d.data.shape[0], d.data.shape[1], d.v,
+                         time.perf_counter() - t0))
+    sys.exit(status)
@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Nonlinear Whipple bicycle model derived from the frames and contact points of
+pitch_constraint.py.
+
+The rear frame, front frame and the two wheels are rigid bodies with the
+benchmark parameters, inertias and mass center offsets are given in upright
+benchmark axes (x forward, z down) relative to the wheel centers. Kane's
+equations are derived for all six generalized speeds
+    u = [yaw rate, lean rate, pitch rate, steer rate, rear wheel rate,
+         front wheel rate]
+as M(q) u' = F(q, u, T), with the rolling constraint of the front wheel
+A(q) u = 0 and its time derivative A u' + b(q, u) = 0. Solving for the
+dependent speeds symbolically makes the expressions explode, so M, F, A and b
+are generated as NumPy code with common subexpressions computed once
+(sympy.cse) and the yaw rate, pitch rate and front wheel rate are eliminated
+numerically, for whole arrays of states at once. The derivation takes a few
+minutes, so the generated code is cached on disk like that of
+pitch_constraint.py.
+
+States are integrated with fixed-step RK4 and the pitch is projected back on
+the holonomic constraint after each step:
+    $ ./whipple_model.py
+    $ ./whipple_model.py --speed 4.5 --duration 10
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from sympy import Float, Matrix, cse, symbols
+from sympy.physics.mechanics import (KanesMethod, ReferenceFrame, RigidBody,
+                                     dynamicsymbols, inertia)
+from sympy.printing.numpy import NumPyPrinter
+
+import bicycle_model as bm
+import param_cache
+import pitch_constraint as pc
+import pitch_table
+import simulation
+
+
+STATES = ['yaw', 'lean', 'pitch', 'steer', 'leanrate', 'wheelrate',
+          'steerrate']
+YAW, LEAN, PITCH, STEER, LEANRATE, WHEELRATE, STEERRATE = range(len(STATES))
+# indices of the independent (lean rate, rear wheel rate, steer rate) and
+# dependent (yaw rate, pitch rate, front wheel rate) generalized speeds
+INDEPENDENT_SPEEDS = [1, 4, 3]
+DEPENDENT_SPEEDS = [0, 2, 5]
+DEFAULT_STEP = 0.002 # s, RK4 step size
+DEFAULT_SPEED = 5.0 # m/s, in the stable speed range of the benchmark bicycle
+DEFAULT_DURATION = 5.0 # s
+FINITE_DIFFERENCE = 1e-6 # rad or rad/s, perturbation of the linearization
+PITCH_NEWTON_ITER = 2 # Newton steps of the pitch projection
+
+## define coordinates and speeds
+# psi: yaw
+# phi: roll
+# theta: pitch
+# delta: steer
+psi, phi, theta, delta = dynamicsymbols('psi phi theta delta')
+u_psi, u_phi, u_theta, u_delta, u_R, u_F = dynamicsymbols(
+    'u_psi u_phi u_theta u_delta u_R u_F')
+# T: steer torque
+T = symbols('T')
+# lam: steer axis tilt, the pitch of the upright bicycle
+# g: gravitational acceleration
+lam, g = symbols('lambda g')
+# mB, mH, mR, mF: rear frame, front frame, rear and front wheel masses
+mB, mH, mR, mF = symbols('mB mH mR mF')
+# xB, zB: rear frame mass center relative to the rear wheel center
+# xH, zH: front frame mass center relative to the front wheel center
+xB, zB, xH, zH = symbols('xB zB xH zH')
+# rear/front frame inertias about the mass centers
+IBxx, IByy, IBzz, IBxz = symbols('IBxx IByy IBzz IBxz')
+IHxx, IHyy, IHzz, IHxz = symbols('IHxx IHyy IHzz IHxz')
+# rear/front wheel inertias about the wheel centers
+IRxx, IRyy, IFxx, IFyy = symbols('IRxx IRyy IFxx IFyy')
+
+benchmark_parameters = dict(pc.benchmark_parameters)
+benchmark_parameters.update({
+    lam: bm.STEER_AXIS_TILT,
+    g: bm.G,
+    mB: 85.0,
+    xB: 0.3,
+    zB: -0.6,
+    IBxx: 9.2,
+    IByy: 11.0,
+    IBzz: 2.8,
+    IBxz: 2.4,
+    mH: 4.0,
+    xH: -0.12,
+    zH: -0.35,
+    IHxx: 0.05892,
+    IHyy: 0.06,
+    IHzz: 0.00708,
+    IHxz: -0.00756,
+    mR: 2.0,
+    IRxx: 0.0603,
+    IRyy: 0.12,
+    mF: 3.0,
+    IFxx: 0.1405,
+    IFyy: 0.28,
+})
+
+# names of the coordinates, speeds and input in generated code
+code_symbols = dict(zip(
+    [phi, theta, delta, u_psi, u_phi, u_theta, u_delta, u_R, u_F, T],
+    symbols('lean pitch steer u_yaw u_lean u_pitch u_steer u_rear u_front '
+            'torque')))
+
+
+def derive():
+    """Return the mass matrix M (6x6) and forcing F (6) of Kane's equations
+    and the constraint terms A (3x6) and b (3) of the front wheel contact.
+    """
+    speeds = [u_psi, u_phi, u_theta, u_delta, u_R, u_F]
+    k = pc.kinematics(phi, theta, delta, psi)
+    N, B, H = k.N, k.B, k.H
+    # heading frame of the front wheel contact velocity constraints
+    Y = N.orientnew('Y', 'axis', [psi, N.z])
+    # upright benchmark axes of the rear/front frame inertias
+    TB = B.orientnew('TB', 'axis', [-lam, B.y])
+    TH = H.orientnew('TH', 'axis', [-lam, H.y])
+    # rear/front wheel frames
+    WR = ReferenceFrame('WR')
+    WF = ReferenceFrame('WF')
+
+    qd = {psi.diff(): u_psi, phi.diff(): u_phi, theta.diff(): u_theta,
+          delta.diff(): u_delta}
+    B.set_ang_vel(N, B.ang_vel_in(N).subs(qd))
+    H.set_ang_vel(B, u_delta*B.z)
+    WR.set_ang_vel(B, u_R*B.y)
+    WF.set_ang_vel(H, u_F*H.y)
+
+    ## define mass centers and velocities
+    # the rear wheel rolls without slip on the ground
+    pBo = k.Rs.locatenew('Bo', xB*TB.x + zB*TB.z)
+    pHo = k.Fs.locatenew('Ho', xH*TH.x + zH*TH.z)
+    k.P.set_vel(N, 0)
+    k.Rs.v2pt_theory(k.P, N, WR)
+    k.Rh.v2pt_theory(k.Rs, N, B)
+    pBo.v2pt_theory(k.Rs, N, B)
+    k.Fh.v2pt_theory(k.Rh, N, B)
+    k.Fs.v2pt_theory(k.Fh, N, H)
+    pHo.v2pt_theory(k.Fs, N, H)
+    k.Q.v2pt_theory(k.Fs, N, WF)
+
+    bodies = [
+        RigidBody('B', pBo, B, mB, (inertia(TB, IBxx, IByy, IBzz, 0, 0, IBxz),
+                                    pBo)),
+        RigidBody('H', pHo, H, mH, (inertia(TH, IHxx, IHyy, IHzz, 0, 0, IHxz),
+                                    pHo)),
+        RigidBody('R', k.Rs, WR, mR, (inertia(B, IRxx, IRyy, IRxx), k.Rs)),
+        RigidBody('F', k.Fs, WF, mF, (inertia(H, IFxx, IFyy, IFxx), k.Fs)),
+    ]
+    # N.z points down, the steer torque acts between the frames
+    loads = [(pBo, mB*g*N.z), (pHo, mH*g*N.z), (k.Rs, mR*g*N.z),
+             (k.Fs, mF*g*N.z), (H, T*B.z), (B, -T*B.z)]
+
+    kane = KanesMethod(N, q_ind=[psi, phi, theta, delta], u_ind=speeds,
+                       kd_eqs=[qdot - u for qdot, u in qd.items()])
+    kane.kanes_equations(bodies, loads)
+
+    # front wheel contact point velocity, linear in the speeds
+    vc = Matrix([k.Q.vel(N) & Y.x, k.Q.vel(N) & Y.y, k.Q.vel(N) & Y.z])
+    A = vc.jacobian(speeds)
+    b = vc.diff(dynamicsymbols._t).subs({u.diff(): 0 for u in speeds}).subs(qd)
+    # the terms do not depend on the yaw angle, but the identities that
+    # cancel it are not simplified
+    return tuple(m.subs(psi, 0) for m in (kane.mass_matrix, kane.forcing, A,
+                                         b))
+
+
+def _assignments(name, matrix, printer):
+    # Returns lines assigning the nonzero elements of matrix to array name.
+    lines = []
+    for i in range(matrix.rows):
+        for j in range(matrix.cols):
+            if matrix[i, j] != 0:
+                index = '{}, {}'.format(i, j) if matrix.cols > 1 else str(i)
+                lines.append('    {}[..., {}] = {}'.format(
+                    name, index, printer.doprint(matrix[i, j])))
+    return lines
+
+
+def _function(name, doc, args, outputs, parameters, printer):
+    # Returns the lines of a NumPy function computing the matrices of outputs
+    # (name, matrix) for arrays of args, with common subexpressions
+    # computed once.
+    values = {k: Float(v, 17) for k, v in parameters.items()}
+    exprs = [m.subs(values).subs(code_symbols) for _, m in outputs]
+    replacements, reduced = cse(exprs)
+    lines = [
+        'def {}({}):'.format(name, ', '.join(args)),
+        '    """{}"""'.format(doc),
+        '    shape = numpy.broadcast({}).shape'.format(', '.join(args)),
+    ]
+    lines += ['    {} = {}'.format(x, printer.doprint(e))
+              for x, e in replacements]
+    for (output, m), r in zip(outputs, reduced):
+        shape = m.shape if m.cols > 1 else (m.rows,)
+        lines.append('    {} = numpy.zeros(shape + {})'.format(output, shape))
+        lines += _assignments(output, r, printer)
+    lines.append('    return {}'.format(', '.join(o for o, _ in outputs)))
+    return lines
+
+
+def python_code(M, F, A, b, parameters=benchmark_parameters):
+    """Return the source of the NumPy functions constraint_matrix(lean,
+    pitch, steer) returning A and dynamics(lean, pitch, steer, u_yaw, u_lean,
+    u_pitch, u_steer, u_rear, u_front, torque) returning M, F and b with the
+    given parameters. Arguments may be arrays of any broadcastable shape s,
+    the results have shape s + the shape of the matrix.
+    """
+    printer = NumPyPrinter()
+    q = ['lean', 'pitch', 'steer']
+    u = ['u_yaw', 'u_lean', 'u_pitch', 'u_steer', 'u_rear', 'u_front']
+    lines = ['import numpy', '', '']
+    lines += _function(
+        'constraint_matrix',
+        'Return A of the front wheel contact constraint A u = 0.',
+        q, [('A', A)], parameters, printer)
+    lines += ['', '']
+    lines += _function(
+        'dynamics',
+        "Return M, F of M u' = F and b of A u' + b = 0.",
+        q + u + ['torque'], [('M', M), ('F', F), ('b', b)], parameters,
+        printer)
+    return '\n'.join(lines) + '\n'
+
+
+def compile_functions(source):
+    """Return constraint_matrix and dynamics defined by the source of
+    python_code().
+    """
+    namespace = {}
+    exec(compile(source, '<whipple_model>', 'exec'), namespace)
+    return namespace['constraint_matrix'], namespace['dynamics']
+
+
+def load_source(parameters=benchmark_parameters, use_cache=True):
+    """Return the python_code() source for the given parameters, from the
+    disk cache if this script, pitch_constraint.py and the parameters have
+    not changed.
+    """
+    key = param_cache.param_hash(
+        param_cache.file_hash(os.path.abspath(__file__)),
+        param_cache.file_hash(os.path.abspath(pc.__file__)),
+        sorted((str(k), float(v)) for k, v in parameters.items()))
+    if use_cache:
+        cached = param_cache.load('whipple_model', key)
+        if cached is not None:
+            return str(cached['source'])
+    source = python_code(*derive(), parameters=parameters)
+    if use_cache:
+        param_cache.save('whipple_model', key, source=np.array(source))
+    return source
+
+
+class WhippleModel(object):
+    """Nonlinear Whipple bicycle with the state of STATES. States are arrays
+    (..., len(STATES)), all methods operate on whole arrays of states.
+    """
+    def __init__(self, parameters=benchmark_parameters, use_cache=True):
+        self.parameters = parameters
+        self.radius = float(parameters[pc.rR])
+        self._constraint_matrix, self._dynamics = compile_functions(
+            load_source(parameters, use_cache))
+        self._pitch_function = pitch_table.pitch_function(
+            {k: parameters[k] for k in pc.benchmark_parameters})
+
+    def state(self, speed, lean=0.0, steer=0.0, leanrate=0.0, steerrate=0.0,
+              yaw=0.0):
+        """Return states with the pitch satisfying the front wheel contact
+        constraint. Arguments may be arrays.
+        """
+        args = np.broadcast_arrays(*[np.asarray(a, dtype=np.float64) for a in
+                                     (speed, lean, steer, leanrate, steerrate,
+                                      yaw)])
+        speed, lean, steer, leanrate, steerrate, yaw = args
+        x = np.zeros(speed.shape + (len(STATES),))
+        x[..., YAW] = yaw
+        x[..., LEAN] = lean
+        x[..., PITCH] = pitch_table.solve_pitch(lean, steer,
+                                                self._pitch_function)
+        x[..., STEER] = steer
+        x[..., LEANRATE] = leanrate
+        x[..., WHEELRATE] = -speed/self.radius
+        x[..., STEERRATE] = steerrate
+        return x
+
+    def speeds(self, x):
+        """Return the generalized speeds u (..., 6) of states."""
+        return self._speeds(np.asarray(x, dtype=np.float64))[0]
+
+    def _speeds(self, x):
+        # Returns u and the (..., 6, 3) matrix N of u = N u_ind, with the
+        # inverse of A of the dependent speeds.
+        A = self._constraint_matrix(x[..., LEAN], x[..., PITCH],
+                                    x[..., STEER])
+        A_dep_inv = np.linalg.inv(A[..., DEPENDENT_SPEEDS])
+        Nm = np.zeros(A.shape[:-2] + (6, 3))
+        Nm[..., INDEPENDENT_SPEEDS, :] = np.eye(3)
+        Nm[..., DEPENDENT_SPEEDS, :] = -np.matmul(
+            A_dep_inv, A[..., INDEPENDENT_SPEEDS])
+        u_ind = x[..., [LEANRATE, WHEELRATE, STEERRATE]]
+        u = np.matmul(Nm, u_ind[..., None])[..., 0]
+        return u, Nm, A_dep_inv
+
+    def derivatives(self, x, torque=0.0):
+        """Return the time derivatives of states x for steer torques."""
+        x = np.asarray(x, dtype=np.float64)
+        u, Nm, A_dep_inv = self._speeds(x)
+        M, F, b = self._dynamics(x[..., LEAN], x[..., PITCH], x[..., STEER],
+                                 *np.moveaxis(u, -1, 0), torque)
+        # u' = N u_ind' + w on the constraint surface A u' + b = 0, with the
+        # independent equations of N^T M u' = N^T F
+        w = np.zeros(b.shape[:-1] + (6,))
+        w[..., DEPENDENT_SPEEDS] = -np.matmul(A_dep_inv, b[..., None])[..., 0]
+        Nt = np.swapaxes(Nm, -1, -2)
+        F = F - np.matmul(M, w[..., None])[..., 0]
+        ud = np.linalg.solve(np.matmul(Nt, np.matmul(M, Nm)),
+                             np.matmul(Nt, F[..., None]))[..., 0]
+        dx = np.empty(ud.shape[:-1] + (len(STATES),))
+        dx[..., :4] = u[..., :4]
+        dx[..., [LEANRATE, WHEELRATE, STEERRATE]] = ud
+        return dx
+
+    def project(self, x):
+        """Correct the pitch of states x in place with Newton steps on the
+        front wheel contact constraint.
+        """
+        for _ in range(PITCH_NEWTON_ITER):
+            f, df = self._pitch_function(x[..., LEAN], x[..., PITCH],
+                                         x[..., STEER])
+            x[..., PITCH] -= f/df
+        return x
+
+    def simulate(self, t, torque, x0):
+        """Integrate states x0 (..., len(STATES)) with RK4 and the step
+        convention of simulation.Simulator: torque[i] is applied over the
+        step to t[i] and x[i] is the state at t[i]. torque is (len(t),) or
+        broadcastable to (len(t),) + x0.shape[:-1], one torque per state.
+        Returns (len(t),) + the shape of x0.
+        """
+        x0 = np.asarray(x0, dtype=np.float64)
+        torque = np.asarray(torque, dtype=np.float64)
+        h = simulation.step_sizes(t)
+        x = np.empty((len(t),) + x0.shape)
+        y = x0
+        for i, hi in enumerate(h):
+            ui = torque[i]
+            k1 = self.derivatives(y, ui)
+            k2 = self.derivatives(y + hi/2*k1, ui)
+            k3 = self.derivatives(y + hi/2*k2, ui)
+            k4 = self.derivatives(y + hi*k3, ui)
+            y = self.project(y + hi/6*(k1 + 2*k2 + 2*k3 + k4))
+            x[i] = y
+        return x
+
+    def linearize(self, v, dx=FINITE_DIFFERENCE):
+        """Return the state and input matrices of the lean and steer
+        dynamics about upright motion at speed v, with the states of
+        bm.STATES, by central differences.
+        """
+        x0 = self.state(v)
+        columns = [LEANRATE, STEERRATE, LEAN, STEER]
+        perturbations = np.concatenate([np.eye(4), -np.eye(4)])*dx
+        kwargs = dict(zip(['leanrate', 'steerrate', 'lean', 'steer'],
+                          perturbations.T))
+        x = self.state(np.full(8, float(v)), **kwargs)
+        d = self.derivatives(x)[:, columns]
+        A = ((d[:4] - d[4:])/(2*dx)).T
+        d = self.derivatives(np.stack([x0, x0]), np.array([dx, -dx]))
+        B = (d[0, columns] - d[1, columns])/(2*dx)
+        return A, B
+
+
+def check_linearization(model, speeds=(1.0, 3.0, 5.0, 8.0)):
+    """Print the difference of the linearized model and bicycle_model."""
+    for v in speeds:
+        A, B = model.linearize(v)
+        A_ref, B_ref = bm.state_matrices(v)
+        print('v = {:4.1f} m/s: max difference A {:.3e}, B {:.3e}'.format(
+            v, np.abs(A - A_ref).max(), np.abs(B - B_ref[:, 0]).max()))
+
+
+def linear_error(model, v=DEFAULT_SPEED, duration=DEFAULT_DURATION,
+                 h=DEFAULT_STEP, leanrates=(0.01, 0.1, 0.5, 1.0, 2.0)):
+    """Print the max lean and steer error of the linear model relative to
+    the nonlinear model after an initial lean rate, for all lean rates at
+    once, and the simulation time.
+    """
+    t = np.arange(1, int(round(duration/h)) + 1)*h
+    leanrates = np.asarray(leanrates, dtype=np.float64)
+    x0 = model.state(v, leanrate=leanrates)
+    t0 = time.perf_counter()
+    x = model.simulate(t, np.zeros(len(t)), x0)
+    elapsed = time.perf_counter() - t0
+    simulator = simulation.Simulator(*bm.state_matrices(v))
+    print('{:>14}  {:>10}  {:>10}  {:>10}  {:>10}'.format(
+        'leanrate [r/s]', 'max lean', 'lean error', 'steer error',
+        'v end'))
+    for i, r in enumerate(leanrates):
+        x_lin = simulator.simulate(t, np.zeros(len(t)), [r, 0, 0, 0])
+        lean, steer = x[:, i, LEAN], x[:, i, STEER]
+        scale = np.abs(lean).max()
+        print('{:>14.3f}  {:>10.4f}  {:>10.3e}  {:>10.3e}  {:>10.4f}'.format(
+            r, scale, np.abs(x_lin[:, 2] - lean).max()/scale,
+            np.abs(x_lin[:, 3] - steer).max()/scale,
+            -x[-1, i, WHEELRATE]*model.radius))
+    print('{} states for {} s in {:.3f} s, {:.1f} times real time'.format(
+        len(leanrates), duration, elapsed, len(leanrates)*duration/elapsed))
+
+
+def benchmark(model, v=DEFAULT_SPEED, n=10000, steps=50, h=DEFAULT_STEP):
+    """Print the throughput of simulating n states at once."""
+    rng = np.random.RandomState(0)
+    x0 = model.state(v + rng.uniform(-1, 1, n), lean=rng.uniform(-0.5, 0.5, n),
+                     steer=rng.uniform(-0.2, 0.2, n))
+    t = np.arange(1, steps + 1)*h
+    t0 = time.perf_counter()
+    model.simulate(t, np.zeros(steps), x0)
+    elapsed = time.perf_counter() - t0
+    print('{} states for {} steps in {:.3f} s, {:.1f} times real time'.format(
+        n, steps, elapsed, n*steps*h/elapsed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=
+        'Derive and simulate the nonlinear Whipple bicycle model.')
+    parser.add_argument('-v', '--speed',
+        help='forward speed in m/s ({})'.format(DEFAULT_SPEED),
+        default=DEFAULT_SPEED, type=float)
+    parser.add_argument('-d', '--duration',
+        help='simulation duration in s ({})'.format(DEFAULT_DURATION),
+        default=DEFAULT_DURATION, type=float)
+    parser.add_argument('--step',
+        help='RK4 step size in s ({})'.format(DEFAULT_STEP),
+        default=DEFAULT_STEP, type=float)
+    parser.add_argument('--no_cache',
+        help='do not read or write the cached derivation',
+        action='store_true')
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    model = WhippleModel(use_cache=not args.no_cache)
+    print('model loaded in {:.3f} s\n'.format(time.perf_counter() - t0))
+
+    print('linearization about upright motion vs bicycle_model')
+    check_linearization(model)
+    print()
+
+    print('linear model error at v = {} m/s'.format(args.speed))
+    linear_error(model, args.speed, args.duration, args.step)
+    print()
+    benchmark(model, args.speed, h=args.step)
+    sys.exit(0)